@@ -17,11 +17,18 @@ import logging
 import sys
 import io
 
+# مجلدات داخل storage لا تُنسخ احتياطياً (مسارات نسبية لمجلد الملفات):
+# - uploads: عمليات رفع جزئية (data.part محجوز بالحجم الكامل حتى 200MB) تُستأنف أو تُحذف بعد يومين
+# - media: أغلفة ونسخ ويب وصور مصغرة يعاد إنشاؤها بـ db_maintenance.py process-media
+# - blobs/.staging: ملفات مؤقتة لرفع لم يكتمل
+BACKUP_EXCLUDED_STORAGE_DIRS = ("uploads", "media", os.path.join("blobs", ".staging"))
+
 class BackupManager:
     def __init__(self, db_path="data/app.db", storage_path="storage", backup_dir="backups"):
         self.db_path = db_path
         self.storage_path = storage_path
         self.backup_dir = backup_dir
+        self.excluded_dirs = BACKUP_EXCLUDED_STORAGE_DIRS
         self.max_backups = 30  # الاحتفاظ بآخر 30 نسخة
         
         # إنشاء مجلد النسخ الاحتياطي إذا لم يكن موجوداً
@@ -69,11 +76,7 @@ class BackupManager:
                 
                 # نسخ مجلد الملفات المرفوعة
                 if os.path.exists(self.storage_path):
-                    for root, dirs, files in os.walk(self.storage_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, os.path.dirname(self.storage_path))
-                            zipf.write(file_path, arcname)
+                    self._write_storage(zipf)
                     self.logger.info("تم نسخ الملفات المرفوعة بنجاح")
                 
                 # إضافة معلومات النسخة الاحتياطية
@@ -97,6 +100,16 @@ class BackupManager:
             self.logger.error(f"خطأ في إنشاء النسخة الاحتياطية: {str(e)}")
             return None
     
+    def _write_storage(self, zipf):
+        """إضافة ملفات مجلد التخزين للأرشيف مع تخطي المجلدات المؤقتة والمشتقة"""
+        excluded = {os.path.normpath(os.path.join(self.storage_path, d)) for d in self.excluded_dirs}
+        for root, dirs, files in os.walk(self.storage_path):
+            dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) not in excluded]
+            for file in files:
+                file_path = os.path.join(root, file)
+                arcname = os.path.relpath(file_path, os.path.dirname(self.storage_path))
+                zipf.write(file_path, arcname)
+    
     def _backup_database(self, source_db, target_db):
         """إنشاء نسخة آمنة من قاعدة البيانات"""
         source_conn = sqlite3.connect(source_db)
@@ -257,11 +270,7 @@ class BackupManager:
                     os.remove(temp_db)
                 
                 if os.path.exists(self.storage_path):
-                    for root, dirs, files in os.walk(self.storage_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, os.path.dirname(self.storage_path))
-                            zipf.write(file_path, arcname)
+                    self._write_storage(zipf)
                 
                 backup_info = f"""نسخة احتياطية أسبوعية
 تاريخ الإنشاء: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
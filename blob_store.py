@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+مخزن الملفات بحسب المحتوى (Content-addressed)
+================================================
+المستشفيات ترفع نفس الترخيص والبطاقة الضريبية والسجل التجاري لكل طلب (طلب لكل خدمة)،
+فبدلاً من نسخة لكل طلب يُخزن المحتوى مرة واحدة باسم بصمته SHA-256:
+
+    storage/blobs/ab/cd/abcd...<ext>
+
+- البصمة والحجم يُحسبان أثناء كتابة الدفعات (chunks) إلى ملف مؤقت، بدون قراءة الملف مرة ثانية،
+  ثم fsync ونشر ذري بـ os.replace.
+- جدول blobs يحفظ عدد المستندات التي تشير لكل ملف (ref_count)، وعمود documents.content_hash يربط المستند بالملف.
+- الحذف ينقص العداد فقط، والملف يُحذف من القرص عندما يصل العداد إلى صفر.
+- نشر الملف وتحديث العداد يتمان داخل نفس معاملة تحديث المستند، والحذف من القرص بعد الحفظ (commit).
+- acquire و purge يحجزان قفل الكتابة (BEGIN IMMEDIATE) قبل فحص الملف على القرص، فلا يحذف purge
+  ملفاً أعاد acquire استخدامه في معاملة لم تُحفظ بعد.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+
+CHUNK_SIZE = 4 * 1024 * 1024
+STAGING_DIR_NAME = ".staging"
+STAGING_MAX_AGE = 24 * 3600  # الملفات المؤقتة الأقدم من يوم بقايا رفع منقطع
+
+# ملف مؤقت مكتوب ومحسوبة بصمته، لم يُنشر بعد في المخزن
+StagedBlob = namedtuple("StagedBlob", ["digest", "temp_path", "size", "ext"])
+
+
+def _iter_views(stream, chunk_size):
+    """دفعات المحتوى كـ memoryview بدون نسخ إضافية.
+
+    - الملفات في الذاكرة (UploadedFile في Streamlit مبني على BytesIO): شرائح من getbuffer() مباشرة.
+    - الملفات على القرص: readinto في مخزن واحد يُعاد استخدامه.
+    """
+    if hasattr(stream, "getbuffer"):
+        with stream.getbuffer() as buffer:
+            start = stream.tell()
+            for offset in range(start, len(buffer), chunk_size):
+                with buffer[offset:offset + chunk_size] as view:
+                    yield view
+            stream.seek(len(buffer))
+        return
+    if hasattr(stream, "readinto"):
+        chunk = bytearray(chunk_size)
+        with memoryview(chunk) as whole:
+            while True:
+                n = stream.readinto(chunk)
+                if not n:
+                    break
+                with whole[:n] as view:
+                    yield view
+        return
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        yield memoryview(data)
+
+
+def _fsync_directory(directory):
+    """تثبيت عملية إعادة التسمية على القرص (غير مدعوم على Windows فيُتجاهل)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _begin_write(conn):
+    """حجز قفل الكتابة قبل أي قراءة إذا لم تكن هناك معاملة مفتوحة (المعاملة المفتوحة التي كتبت تملكه مسبقاً)"""
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+
+
+class BlobStore:
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+
+    def path_for(self, digest, ext=""):
+        return self.root / digest[:2] / digest[2:4] / f"{digest}{ext}"
+
+    def contains(self, path):
+        """هل المسار داخل المخزن؟ (المستندات القديمة قبل المخزن لها مسارات خاصة بالطلب)"""
+        try:
+            return self.root.resolve() in Path(path).resolve().parents
+        except (OSError, TypeError):
+            return False
+
+    # ------------------------------------------------------------------ #
+    def stage(self, stream, ext=""):
+        """كتابة المحتوى إلى ملف مؤقت داخل المخزن مع حساب البصمة والحجم في نفس المرور.
+
+        الملف المؤقت في نفس نظام الملفات مع الوجهة، فالنشر لاحقاً بـ os.replace ذري،
+        والانقطاع أثناء الكتابة لا يترك ملفاً نصف مكتوب في المخزن.
+        """
+        staging = self.root / STAGING_DIR_NAME
+        staging.mkdir(parents=True, exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(prefix="upload_", dir=staging)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for view in _iter_views(stream, self.chunk_size):
+                    digest.update(view)
+                    out.write(view)
+                    size += len(view)
+                out.flush()
+                os.fsync(out.fileno())
+        except BaseException:
+            self.discard_path(temp_name)
+            raise
+        return StagedBlob(digest.hexdigest(), Path(temp_name), size, ext.lower())
+
+    def stage_file(self, path, ext=""):
+        """نقل ملف مكتمل على نفس القرص (مثل رفع مجمّع من دفعات) إلى منطقة الانتظار بدون نسخه.
+
+        الملف يُقرأ مرة واحدة لحساب البصمة ثم يُنقل بـ os.replace.
+        """
+        staging = self.root / STAGING_DIR_NAME
+        staging.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for view in _iter_views(f, self.chunk_size):
+                digest.update(view)
+                size += len(view)
+        fd, temp_name = tempfile.mkstemp(prefix="upload_", dir=staging)
+        os.close(fd)
+        os.replace(path, temp_name)
+        return StagedBlob(digest.hexdigest(), Path(temp_name), size, ext.lower())
+
+    def discard(self, staged):
+        if staged is not None:
+            self.discard_path(staged.temp_path)
+
+    @staticmethod
+    def discard_path(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------ #
+    def acquire(self, conn, staged):
+        """نشر الملف المؤقت (أو إعادة استخدام نسخة موجودة بنفس البصمة) وزيادة العداد. العودة: مسار الملف في المخزن
+
+        العداد يُزاد أولاً (تحت قفل الكتابة) ثم يُفحص الملف على القرص، فـ purge المتزامن ينتظر حفظ هذه المعاملة
+        ثم يرى الصف ولا يحذف الملف. عند فشل النشر يجب على المستدعي إلغاء المعاملة (rollback).
+        """
+        _begin_write(conn)
+        conn.execute(
+            """INSERT INTO blobs (sha256, path, size, ref_count, created_at) VALUES (?, ?, ?, 1, ?)
+               ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1""",
+            (staged.digest, str(self.path_for(staged.digest, staged.ext)), staged.size, datetime.now().isoformat()),
+        )
+        path = Path(conn.execute("SELECT path FROM blobs WHERE sha256=?", (staged.digest,)).fetchone()[0])
+        if path.exists():
+            self.discard(staged)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(staged.temp_path, path)
+            _fsync_directory(path.parent)
+        return path
+
+    def release(self, conn, digest):
+        """إنقاص عداد الملف. العودة: True إذا لم يعد مستخدماً (يُحذف من القرص بـ purge بعد commit)"""
+        if not digest:
+            return False
+        conn.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256=? AND ref_count > 0", (digest,))
+        deleted = conn.execute("DELETE FROM blobs WHERE sha256=? AND ref_count <= 0", (digest,)).rowcount
+        return deleted > 0
+
+    def purge(self, conn, digests):
+        """حذف ملفات البصمات غير المستخدمة من القرص (مع التأكد أنها لم تُستخدم مجدداً بعد release).
+
+        الفحص والحذف تحت قفل الكتابة حتى يحفظ المستدعي (commit)، فلا يتداخل مع acquire في اتصال آخر.
+        """
+        removed = 0
+        digests = set(d for d in digests if d)
+        if digests:
+            _begin_write(conn)
+        for digest in digests:
+            if conn.execute("SELECT 1 FROM blobs WHERE sha256=?", (digest,)).fetchone():
+                continue
+            directory = self.root / digest[:2] / digest[2:4]
+            for path in directory.glob(f"{digest}*"):
+                try:
+                    path.unlink()
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    # ------------------------------------------------------------------ #
+    def rebuild_refcounts(self, conn):
+        """إعادة حساب العدادات من جدول المستندات. العودة: (عدد الملفات المستخدمة، بصمات غير مستخدمة تُمرر لـ purge بعد commit)"""
+        conn.execute("""
+            UPDATE blobs SET ref_count = (
+                SELECT COUNT(*) FROM documents d WHERE d.content_hash = blobs.sha256
+            )
+        """)
+        orphans = [r[0] for r in conn.execute("SELECT sha256 FROM blobs WHERE ref_count <= 0").fetchall()]
+        conn.execute("DELETE FROM blobs WHERE ref_count <= 0")
+        known = {r[0] for r in conn.execute("SELECT sha256 FROM blobs").fetchall()}
+        # ملفات مؤقتة متروكة من رفع انقطع أثناء الكتابة
+        cutoff = time.time() - STAGING_MAX_AGE
+        for path in (self.root / STAGING_DIR_NAME).glob("upload_*"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except OSError:
+                pass
+        # ملفات على القرص بدون صف (مثلاً انقطاع بين النشر والحفظ)
+        if self.root.exists():
+            for path in self.root.glob("??/??/*"):
+                digest = path.name.split(".", 1)[0]
+                if digest not in known:
+                    orphans.append(digest)
+        return len(known), orphans
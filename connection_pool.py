@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+تجمع اتصالات قاعدة البيانات
+===============================
+تجمع اتصالات SQLite محدود الحجم على مستوى العملية (process).
+
+- كل خيط تشغيل (Streamlit script thread) يحجز اتصالاً واحداً طوال فترة استخدامه،
+  والاستدعاءات المتداخلة لـ get_conn() داخل نفس الخيط تعيد نفس الاتصال.
+- إعدادات PRAGMA تُطبق مرة واحدة عند فتح الاتصال فقط.
+- يتم فحص صلاحية الاتصال عند سحبه من التجمع، وإعادة ضبطه (rollback) عند إرجاعه.
+- عند حدوث خطأ جسيم في الاتصال يتم إغلاقه بدلاً من إعادته للتجمع.
+
+ملاحظة: هذه الوحدة منفصلة عن الملف الرئيسي لأن Streamlit يعيد تنفيذ الملف الرئيسي
+في كل إعادة تشغيل (rerun)، بينما تبقى الوحدات المستوردة محمّلة مرة واحدة لكل عملية.
+"""
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle  # الحد الأقصى للاتصالات الخاملة لكل قاعدة بيانات
+        self._lock = threading.Lock()
+        self._idle = {}  # db_path -> [sqlite3.Connection]
+        self._local = threading.local()
+
+    def _connect(self, db_path, pragmas):
+        """فتح اتصال جديد وتطبيق إعدادات PRAGMA مرة واحدة"""
+        conn = sqlite3.connect(
+            db_path,
+            check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            timeout=30.0
+        )
+        conn.row_factory = sqlite3.Row
+        for k, v in pragmas:
+            try:
+                conn.execute(f"PRAGMA {k}={v}")
+            except Exception:
+                pass
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        """فحص سريع لصلاحية الاتصال قبل إعادة استخدامه"""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _is_fatal(error):
+        """أخطاء تجعل الاتصال غير صالح لإعادة الاستخدام (وليست أخطاء استعلام عادية)"""
+        return isinstance(error, sqlite3.Error) and not isinstance(
+            error, (sqlite3.OperationalError, sqlite3.IntegrityError)
+        )
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            print(f"Error closing database connection: {e}")
+
+    def _checkout(self, db_path, pragmas):
+        while True:
+            with self._lock:
+                idle = self._idle.get(db_path)
+                conn = idle.pop() if idle else None
+            if conn is None:
+                return self._connect(db_path, pragmas)
+            if self._is_healthy(conn):
+                conn.row_factory = sqlite3.Row
+                return conn
+            self._close(conn)
+
+    def _release(self, db_path, conn, discard=False):
+        if not discard:
+            try:
+                # أي معاملة لم يتم تثبيتها (commit) تُلغى كما كان يحدث عند إغلاق الاتصال
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                discard = True
+        if not discard:
+            with self._lock:
+                idle = self._idle.setdefault(db_path, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+        self._close(conn)
+
+    @contextmanager
+    def connection(self, db_path, pragmas=()):
+        """سحب اتصال من التجمع لمدة كتلة with ثم إعادته.
+
+        الاستدعاءات المتداخلة داخل نفس الخيط تحصل على نفس الاتصال،
+        ولا يُعاد الاتصال للتجمع إلا عند خروج الكتلة الخارجية.
+        """
+        db_path = str(db_path)
+        held = getattr(self._local, "held", None)
+        if held is not None and held["path"] == db_path:
+            held["depth"] += 1
+            try:
+                yield held["conn"]
+            finally:
+                held["depth"] -= 1
+            return
+
+        conn = self._checkout(db_path, pragmas)
+        owner = held is None
+        if owner:
+            self._local.held = {"path": db_path, "conn": conn, "depth": 1}
+        discard = False
+        try:
+            yield conn
+        except BaseException as e:
+            discard = self._is_fatal(e)
+            raise
+        finally:
+            if owner:
+                self._local.held = None
+            self._release(db_path, conn, discard=discard)
+
+    def close_all(self):
+        """إغلاق جميع الاتصالات الخاملة (مثلاً قبل استرجاع نسخة احتياطية)"""
+        with self._lock:
+            idle_lists = list(self._idle.values())
+            self._idle = {}
+        for idle in idle_lists:
+            for conn in idle:
+                self._close(conn)
+
+    def idle_count(self, db_path=None):
+        """عدد الاتصالات الخاملة (لأغراض المراقبة والاختبار)"""
+        with self._lock:
+            if db_path is not None:
+                return len(self._idle.get(str(db_path), []))
+            return sum(len(v) for v in self._idle.values())
+
+
+# إنشاء مثيل عام من تجمع الاتصالات
+connection_pool = ConnectionPool()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+أوامر صيانة قاعدة البيانات
+
+الاستخدام:
+    python db_maintenance.py rebuild-unread-counters
+    python db_maintenance.py rebuild-stats-rollup
+    python db_maintenance.py verify-schema
+    python db_maintenance.py migrate-blobs
+    python db_maintenance.py rebuild-blob-refcounts
+    python db_maintenance.py process-media
+"""
+import argparse
+import sys
+
+sys.path.append('.')
+
+
+def cmd_rebuild_unread_counters(args):
+    """إعادة بناء عدادات الإشعارات غير المقروءة من جدول الإشعارات"""
+    from waiting_list_contracts_app import ensure_notifications_table, rebuild_unread_counters
+    ensure_notifications_table()
+    count = rebuild_unread_counters()
+    print(f"[OK] تمت إعادة بناء {count} عداد إشعارات غير مقروءة")
+
+
+def cmd_rebuild_stats_rollup(args):
+    """إعادة بناء جدول تجميع الإحصائيات اليومية من جدول الطلبات"""
+    from waiting_list_contracts_app import run_ddl, rebuild_request_stats_daily
+    run_ddl()
+    count = rebuild_request_stats_daily()
+    print(f"[OK] تمت إعادة بناء {count} صف في request_stats_daily")
+
+
+def cmd_verify_schema(args):
+    """التحقق الكامل من البنية وتشغيل الترحيلات (بدون المسار السريع) وتحديث بصمة البنية"""
+    from waiting_list_contracts_app import run_ddl
+    migration_log = run_ddl(full=True)
+    print(f"[OK] اكتمل التحقق الكامل من البنية ({len(migration_log)} إجراء)")
+
+
+def cmd_migrate_blobs(args):
+    """نقل ملفات المستندات القديمة إلى مخزن المحتوى (الملفات المكررة تُحفظ مرة واحدة)"""
+    from waiting_list_contracts_app import run_ddl, migrate_documents_to_blob_store
+    run_ddl()
+    migrated, removed = migrate_documents_to_blob_store()
+    print(f"[OK] تم نقل {migrated} مستند إلى مخزن المحتوى وحذف {removed} ملف قديم")
+
+
+def cmd_rebuild_blob_refcounts(args):
+    """إعادة حساب عدادات مخزن المحتوى من جدول المستندات وحذف الملفات غير المستخدمة"""
+    from waiting_list_contracts_app import run_ddl, rebuild_blob_refcounts
+    run_ddl()
+    blob_count, removed = rebuild_blob_refcounts()
+    print(f"[OK] {blob_count} ملف مستخدم في المخزن، وتم حذف {removed} ملف غير مستخدم")
+
+
+def cmd_process_media(args):
+    """معالجة الفيديوهات وفهرسة ملفات PDF التي لم تُعالج بعد وانتظار انتهائها"""
+    from waiting_list_contracts_app import run_ddl, backfill_document_media, wait_document_media
+    run_ddl()
+    job_ids = backfill_document_media()
+    statuses = [wait_document_media(job_id)["result"] for job_id in job_ids]
+    print(f"[OK] تمت معالجة {len(job_ids)} ملف ({statuses.count('done')} بنجاح)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="أوامر صيانة قاعدة البيانات")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("rebuild-unread-counters", help="إعادة بناء جدول unread_counters").set_defaults(func=cmd_rebuild_unread_counters)
+    subparsers.add_parser("rebuild-stats-rollup", help="إعادة بناء جدول request_stats_daily").set_defaults(func=cmd_rebuild_stats_rollup)
+    subparsers.add_parser("verify-schema", help="التحقق الكامل من بنية قاعدة البيانات").set_defaults(func=cmd_verify_schema)
+    subparsers.add_parser("migrate-blobs", help="نقل الملفات القديمة إلى مخزن المحتوى").set_defaults(func=cmd_migrate_blobs)
+    subparsers.add_parser("rebuild-blob-refcounts", help="إعادة بناء عدادات جدول blobs").set_defaults(func=cmd_rebuild_blob_refcounts)
+    subparsers.add_parser("process-media", help="معالجة الفيديوهات وفهرسة ملفات PDF المرفوعة").set_defaults(func=cmd_process_media)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
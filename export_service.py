@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+خدمة تصدير الأرشيفات (ZIP)
+============================
+بناء أرشيفات ZIP لمرفقات الطلبات مباشرة على القرص بدلاً من io.BytesIO في الذاكرة.
+
+- الأرشيف يُكتب في ملف مؤقت بجانب الوجهة ثم يُنقل بـ os.replace (لا توجد أرشيفات نصف مكتوبة).
+- الملفات المضغوطة أصلاً (فيديو، PDF، صور...) تُخزن بـ ZIP_STORED بدون إعادة ضغط.
+- الأرشيف الناتج مخزن على القرص بمفتاح من (المسار، وقت التحديث، الحجم) لكل ملف،
+  فالتنزيل المتكرر لنفس الطلب بدون تغيير لا يعيد البناء.
+- للأرشيفات الكبيرة (التصدير الجماعي) تُقرأ الملفات الصغيرة مسبقاً بمجموعة خيوط
+  بينما يكتب الخيط الرئيسي الأرشيف بالترتيب، والملفات الكبيرة تُنسخ على دفعات بدون تحميلها كاملة.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# امتدادات ملفات مضغوطة أصلاً: إعادة ضغطها تستهلك المعالج بدون فائدة تذكر
+STORED_EXTENSIONS = {
+    ".mp4", ".webm", ".mov", ".avi", ".wmv", ".flv", ".mkv",
+    ".pdf", ".jpg", ".jpeg", ".png", ".gif", ".webp",
+    ".zip", ".rar", ".7z", ".gz", ".docx", ".xlsx", ".pptx",
+}
+
+
+PREFETCH_MAX_BYTES = 8 * 1024 * 1024  # الملفات الأكبر من ذلك تُنسخ على دفعات بدلاً من قراءتها مسبقاً
+
+
+def compress_type_for(path):
+    return zipfile.ZIP_STORED if Path(path).suffix.lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def archive_cache_key(entries):
+    """مفتاح الأرشيف من محتواه: entries = [(source_path, arcname, version)]"""
+    digest = hashlib.sha256()
+    for source, arcname, version in sorted(entries, key=lambda e: e[1]):
+        try:
+            size = os.path.getsize(source)
+        except OSError:
+            size = -1
+        digest.update(f"{arcname}\x1f{source}\x1f{version}\x1f{size}\x1e".encode("utf-8"))
+    return digest.hexdigest()[:20]
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _iter_prefetched(entries, max_workers):
+    """إرجاع (entry, future أو None) بنفس الترتيب، مع قراءة الملفات الصغيرة مسبقاً في نافذة محدودة"""
+    if max_workers <= 1:
+        for entry in entries:
+            yield entry, None
+        return
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="zip-read") as pool:
+        window = deque()
+        pending = iter(entries)
+
+        def _schedule(entry):
+            try:
+                small = os.path.getsize(entry[0]) <= PREFETCH_MAX_BYTES
+            except OSError:
+                small = False
+            window.append((entry, pool.submit(_read_file, entry[0]) if small else None))
+
+        for entry in pending:
+            _schedule(entry)
+            if len(window) >= max_workers * 2:
+                break
+        while window:
+            yield window.popleft()
+            entry = next(pending, None)
+            if entry is not None:
+                _schedule(entry)
+
+
+def write_archive(entries, dest, job=None, max_workers=1):
+    """كتابة الأرشيف إلى dest بشكل ذري. العودة: عدد الملفات المضافة.
+
+    job (اختياري): مهمة خلفية من job_manager لتحديث التقدم.
+    max_workers > 1: قراءة الملفات الصغيرة مسبقاً بمجموعة خيوط.
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=".building_", suffix=".zip", dir=dest.parent)
+    files_added = 0
+    if job:
+        job.update(processed=0, total=len(entries))
+    try:
+        with os.fdopen(fd, "wb") as raw, zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            for i, ((source, arcname, _), future) in enumerate(_iter_prefetched(entries, max_workers), start=1):
+                try:
+                    if future is None:
+                        zf.write(source, arcname=arcname, compress_type=compress_type_for(source))
+                    else:
+                        data = future.result()
+                        info = zipfile.ZipInfo.from_file(source, arcname=arcname)
+                        info.compress_type = compress_type_for(source)
+                        zf.writestr(info, data)
+                    files_added += 1
+                except OSError as e:
+                    print(f"Error adding file to ZIP: {e}")
+                if job:
+                    job.update(processed=i, rows=files_added)
+        if files_added:
+            os.replace(tmp_name, dest)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return files_added
+
+
+def build_cached_archive(entries, cache_dir, name_prefix):
+    """إرجاع (مسار الأرشيف، عدد الملفات) مع إعادة استخدام أرشيف مبني مسبقاً لنفس المحتوى.
+
+    الأرشيفات الأقدم لنفس البادئة (إصدارات سابقة من نفس الطلب) تُحذف بعد بناء الجديد.
+    """
+    entries = [e for e in entries if e[0] and os.path.isfile(e[0])]
+    if not entries:
+        return None, 0
+    cache_dir = Path(cache_dir)
+    dest = cache_dir / f"{name_prefix}_{archive_cache_key(entries)}.zip"
+    if dest.exists():
+        with zipfile.ZipFile(dest) as zf:
+            return dest, len(zf.infolist())
+    files_added = write_archive(entries, dest)
+    if not files_added:
+        return None, 0
+    for stale in cache_dir.glob(f"{name_prefix}_*.zip"):
+        if stale != dest:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+    return dest, files_added
+
+
+def prune_old_files(directory, max_age_seconds, pattern="*.zip"):
+    """حذف الملفات الأقدم من max_age_seconds (مثل أرشيفات التصدير الجماعي القديمة)"""
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for path in Path(directory).glob(pattern):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+خادم تنزيل الملفات
+====================
+خادم HTTP صغير يعمل في خيط خلفي لتنزيل مرفقات الطلبات بروابط موقعة بدلاً من
+قراءة الملف كاملاً في الذاكرة داخل st.download_button عند كل إعادة تشغيل للصفحة.
+
+- الصفحة تعرض رابطاً خفيفاً فقط، والبايتات تُقرأ من القرص على دفعات (chunks) عند الطلب.
+- الروابط موقعة بـ HMAC ولها مدة صلاحية، والمسار يجب أن يكون داخل المجلدات المسموحة.
+- دعم طلبات Range (استكمال التنزيل وتشغيل الفيديو من منتصفه).
+- إذا كان المنفذ مستخدماً من عملية أخرى لنفس التطبيق (بنفس المفتاح) تُستخدم روابطها مباشرة.
+- استقبال الرفع القابل للاستكمال على دفعات (/uploads/<token>) في سجل الرفع UploadJournal.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+HEALTH_PATH = "/files/health"
+UPLOADS_PREFIX = "/uploads/"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def parse_range(header, size):
+    """تحليل ترويسة Range (نطاق واحد فقط). العودة: (start, end) شاملة، أو None لكامل الملف، أو False لنطاق غير صالح"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text == "":
+            # آخر N بايت
+            length = int(end_text)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class FileServer:
+    def __init__(self, host="0.0.0.0", port=8502, link_ttl=3600):
+        self.host = host
+        self.port = port
+        self.link_ttl = link_ttl
+        self._secret = None
+        self._roots = []
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._external = False  # الخادم يعمل في عملية أخرى على نفس المنفذ
+        self.uploads = None  # UploadJournal لاستقبال الرفع على دفعات (اختياري)
+
+    def configure(self, roots, secret, host=None, port=None, link_ttl=None, uploads=None):
+        """تحديد المجلدات المسموح التنزيل منها ومفتاح التوقيع وسجل الرفع (قبل start)"""
+        self._roots = [Path(r).resolve() for r in roots]
+        self._secret = secret.encode("utf-8") if isinstance(secret, str) else secret
+        if host is not None:
+            self.host = host
+        if port is not None:
+            self.port = port
+        if link_ttl is not None:
+            self.link_ttl = link_ttl
+        if uploads is not None:
+            self.uploads = uploads
+
+    # ------------------------------------------------------------------ #
+    def _sign_payload(self, payload):
+        body = _b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        signature = _b64encode(hmac.new(self._secret, body.encode("ascii"), hashlib.sha256).digest()[:18])
+        return f"{body}.{signature}"
+
+    def _verify_payload(self, token):
+        if not self._secret or "." not in token:
+            return None
+        body, _, signature = token.partition(".")
+        expected = _b64encode(hmac.new(self._secret, body.encode("ascii"), hashlib.sha256).digest()[:18])
+        if not hmac.compare_digest(signature, expected):
+            return None
+        try:
+            payload = json.loads(_b64decode(body).decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        if payload.get("e", 0) < time.time():
+            return None
+        return payload
+
+    def sign(self, path, filename=None, mime=None, ttl=None):
+        """إنشاء رمز موقع لملف (يُستخدم في الرابط /files/<token>)"""
+        path = Path(path).resolve()
+        return self._sign_payload({
+            "p": str(path),
+            "n": filename or path.name,
+            "m": mime or mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+            "e": int(time.time()) + int(ttl or self.link_ttl),
+        })
+
+    def verify(self, token):
+        """التحقق من الرمز وإرجاع بياناته أو None (توقيع خاطئ، منتهي الصلاحية، أو مسار خارج المجلدات المسموحة)"""
+        payload = self._verify_payload(token)
+        if payload is None or "p" not in payload:
+            return None
+        path = Path(payload["p"]).resolve()
+        if not any(path == root or root in path.parents for root in self._roots):
+            return None
+        payload["p"] = path
+        return payload
+
+    def sign_upload(self, upload_id, max_size=None, ttl=None):
+        """رمز موقع لرفع قابل للاستكمال (/uploads/<token>) مرتبط بمعرّف رفع واحد"""
+        payload = {"u": upload_id, "e": int(time.time()) + int(ttl or self.link_ttl)}
+        if max_size:
+            payload["x"] = int(max_size)
+        return self._sign_payload(payload)
+
+    def verify_upload(self, token):
+        payload = self._verify_payload(token)
+        if payload is None or "u" not in payload:
+            return None
+        return payload
+
+    def url_path(self, path, filename=None, mime=None, ttl=None):
+        return f"/files/{self.sign(path, filename, mime, ttl)}"
+
+    # ------------------------------------------------------------------ #
+    def start(self):
+        """تشغيل الخادم مرة واحدة لكل عملية. العودة: True إذا كانت الروابط قابلة للاستخدام"""
+        with self._lock:
+            if self._server is not None or self._external:
+                return True
+            if not self._secret:
+                return False
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+            except OSError as e:
+                # المنفذ مستخدم: ربما عملية أخرى من نفس التطبيق تشغل الخادم
+                self._external = self._probe_existing()
+                if not self._external:
+                    logger.warning(f"File server could not start on port {self.port}: {e}")
+                return self._external
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            self._thread = threading.Thread(target=self._server.serve_forever, name="file-server", daemon=True)
+            self._thread.start()
+            return True
+
+    def _probe_existing(self):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.port}{HEALTH_PATH}", timeout=1) as resp:
+                return resp.read() == hashlib.sha256(self._secret).hexdigest()[:16].encode("ascii")
+        except Exception:
+            return False
+
+    @property
+    def available(self):
+        return self._server is not None or self._external
+
+    def stop(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+            self._server = None
+            self._thread = None
+            self._external = False
+
+    # ------------------------------------------------------------------ #
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logger.debug("file-server: " + format, *args)
+
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                if self.path.startswith(UPLOADS_PREFIX):
+                    return self._upload()
+                self._serve(send_body=True)
+
+            def do_POST(self):
+                self._upload()
+
+            def do_PUT(self):
+                self._upload()
+
+            def do_OPTIONS(self):
+                # طلب preflight من صفحة التطبيق (منفذ مختلف = أصل مختلف)
+                self.send_response(204)
+                self._cors_headers()
+                self.send_header("Access-Control-Allow-Methods", "GET, POST, PUT, OPTIONS")
+                self.send_header("Access-Control-Allow-Headers", "Content-Type")
+                self.send_header("Access-Control-Max-Age", "600")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _cors_headers(self):
+                # الصلاحية في الرمز الموقع داخل المسار وليس في ملفات تعريف الارتباط، فالسماح لأي أصل آمن
+                self.send_header("Access-Control-Allow-Origin", "*")
+
+            def _json(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self._cors_headers()
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-store")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _upload(self):
+                """GET: حالة الرفع، POST ?size=&name=&fp=: بدء رفع، PUT /<index>: دفعة"""
+                route, _, query = self.path.partition("?")
+                token, _, index = route[len(UPLOADS_PREFIX):].partition("/")
+                payload = server.verify_upload(token)
+                if payload is None or server.uploads is None:
+                    if self.command in ("POST", "PUT"):
+                        self.close_connection = True  # لا نقرأ جسم الطلب المرفوض
+                    return self._json(403, {"error": "forbidden"})
+                journal, upload_id = server.uploads, payload["u"]
+                try:
+                    if self.command == "GET":
+                        return self._json(200, journal.status(upload_id))
+                    if self.command == "POST":
+                        params = parse_qs(query)
+                        state = journal.create(upload_id, params.get("size", ["0"])[0], params.get("name", [""])[0],
+                                               params.get("fp", [""])[0], max_size=payload.get("x"))
+                        return self._json(200, state)
+                    length = int(self.headers.get("Content-Length") or 0)
+                    return self._json(200, journal.write_chunk(upload_id, index, self.rfile, length))
+                except (ValueError, OSError) as e:
+                    # خطأ في منتصف جسم الطلب: لا يمكن إعادة استخدام الاتصال
+                    self.close_connection = True
+                    return self._json(400, {"error": str(e)})
+
+            def _reply(self, status, text=b""):
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(text)))
+                self.end_headers()
+                if text and self.command != "HEAD":
+                    self.wfile.write(text)
+
+            def _serve(self, send_body):
+                route = self.path.split("?", 1)[0]
+                if route == HEALTH_PATH:
+                    return self._reply(200, hashlib.sha256(server._secret).hexdigest()[:16].encode("ascii"))
+                if not route.startswith("/files/"):
+                    return self._reply(404)
+                payload = server.verify(route[len("/files/"):])
+                if payload is None:
+                    return self._reply(403)
+                path = payload["p"]
+                try:
+                    size = path.stat().st_size
+                    handle = open(path, "rb")
+                except OSError:
+                    return self._reply(404)
+
+                with handle:
+                    byte_range = parse_range(self.headers.get("Range"), size)
+                    if byte_range is False:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    start, end = byte_range or (0, size - 1)
+                    length = max(0, end - start + 1)
+                    self.send_response(206 if byte_range else 200)
+                    self.send_header("Content-Type", payload["m"])
+                    self.send_header("Content-Length", str(length))
+                    self.send_header("Accept-Ranges", "bytes")
+                    self.send_header("Cache-Control", "private, max-age=300")
+                    self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(payload['n'])}")
+                    if byte_range:
+                        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                    self.end_headers()
+                    if not send_body:
+                        return
+                    handle.seek(start)
+                    remaining = length
+                    try:
+                        while remaining > 0:
+                            chunk = handle.read(min(CHUNK_SIZE, remaining))
+                            if not chunk:
+                                break
+                            self.wfile.write(chunk)
+                            remaining -= len(chunk)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass  # المتصفح أغلق الاتصال (مثلاً عند تقديم الفيديو)
+
+        return Handler
+
+
+# إنشاء مثيل عام من خادم الملفات
+file_server = FileServer()
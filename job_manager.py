@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+مدير المهام الخلفية
+=====================
+تشغيل المهام الطويلة (مثل إعادة حساب المستندات الاختيارية أو تصدير الأرشيفات)
+في خيوط خلفية حتى تعود واجهة Streamlit فوراً، مع متابعة التقدم وعدد الصفوف.
+
+- كل مهمة لها معرف وحالة (queued / running / done / failed) ونسبة تقدم ورسالة.
+- المهام التي لها نفس dedupe_key ولم تبدأ بعد لا تتكرر (المهمة المنتظرة ستقرأ أحدث الإعدادات).
+- الحالة محفوظة في الذاكرة على مستوى العملية (الوحدة تبقى محمّلة بين إعادات تشغيل Streamlit).
+- المدير مشترك بين كل الجلسات: المهام التي تخص مستخدماً (مثل أرشيف تصدير) تُسجل بمالك (owner)
+  وتُعرض نتائجها له فقط.
+"""
+
+import logging
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, kind, title, dedupe_key=None, owner=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.title = title
+        self.dedupe_key = dedupe_key
+        self.owner = owner
+        self.status = "queued"
+        self.processed = 0
+        self.total = 0
+        self.rows = 0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def update(self, processed=None, total=None, rows=None, message=None):
+        """تحديث تقدم المهمة (تُستدعى من داخل دالة المهمة)"""
+        with self._lock:
+            if processed is not None:
+                self.processed = processed
+            if total is not None:
+                self.total = total
+            if rows is not None:
+                self.rows = rows
+            if message is not None:
+                self.message = message
+
+    @property
+    def progress(self):
+        if self.status == "done":
+            return 1.0
+        if not self.total:
+            return 0.0
+        return min(1.0, self.processed / self.total)
+
+    @property
+    def is_active(self):
+        return self.status in ("queued", "running")
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id, "kind": self.kind, "title": self.title, "owner": self.owner, "status": self.status,
+                "processed": self.processed, "total": self.total, "rows": self.rows,
+                "progress": self.progress, "message": self.message, "result": self.result,
+                "error": self.error, "created_at": self.created_at,
+                "started_at": self.started_at, "finished_at": self.finished_at,
+            }
+
+
+class JobManager:
+    def __init__(self, max_workers=2, max_history=50):
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bg-job")
+        self._lock = threading.Lock()
+        self._jobs = {}  # id -> Job (بترتيب الإنشاء)
+
+    def submit(self, kind, title, func, *args, dedupe_key=None, owner=None, **kwargs):
+        """جدولة مهمة خلفية. func تستقبل job كأول معامل. تُرجع معرف المهمة.
+
+        owner (اختياري): صاحب المهمة، فـ list_jobs(owner=...) لا تعرض مهام المستخدمين الآخرين.
+        """
+        with self._lock:
+            if dedupe_key is not None:
+                for job in self._jobs.values():
+                    if job.dedupe_key == dedupe_key and job.status == "queued":
+                        return job.id
+            job = Job(kind, title, dedupe_key, owner)
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job.id
+
+    def _run(self, job, func, args, kwargs):
+        job.status = "running"
+        job.started_at = datetime.now().isoformat()
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+            logger.error(f"Background job {job.kind} ({job.id}) failed: {e}\n{traceback.format_exc()}")
+        finally:
+            job.finished_at = datetime.now().isoformat()
+
+    def _trim(self):
+        finished = [j for j in self._jobs.values() if not j.is_active]
+        while len(self._jobs) > self.max_history and finished:
+            self._jobs.pop(finished.pop(0).id, None)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job.to_dict() if job else None
+
+    def list_jobs(self, kind=None, owner=None):
+        """قائمة المهام (الأحدث أولاً). مع owner: مهام هذا المالك فقط"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [j.to_dict() for j in reversed(jobs)
+                if (kind is None or j.kind == kind) and (owner is None or j.owner == owner)]
+
+    def wait(self, job_id, timeout=None):
+        """انتظار انتهاء مهمة (للاختبارات وأوامر الصيانة)"""
+        import time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in ("done", "failed"):
+                return job
+            if deadline is not None and time.monotonic() > deadline:
+                return job
+            time.sleep(0.02)
+
+
+# إنشاء مثيل عام من مدير المهام
+job_manager = JobManager()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+خدمة معالجة الوسائط
+=====================
+فيديوهات غرف العمليات تُرفع بأي صيغة (.avi, .wmv, .mov...) وقد يصل حجمها لمئات الميجابايت.
+بعد الرفع تعمل مهمة خلفية (طابور منفصل بخيط واحد حتى لا يعطل التحويل مهام التصدير):
+
+1. فحص الحاوية (ffprobe): المدة والأبعاد والترميز.
+2. استخراج صورة غلاف (poster) من الفيديو.
+3. إذا توفر ffmpeg: إنشاء نسخة ويب (MP4 H.264/AAC) بأبعاد ومعدل بت محدودين،
+   فالمراجع يشاهد نسخة صغيرة بدلاً من تنزيل الملف الأصلي.
+
+الأدوات اختيارية: ffprobe/ffmpeg من PATH أو من متغيرات البيئة FFPROBE_PATH / FFMPEG_PATH.
+بدونها تُسجل الحالة 'unsupported' ويبقى التنزيل الأصلي متاحاً.
+النتائج مخزنة بحسب بصمة المحتوى، فالفيديو المكرر بين الطلبات يُعالج مرة واحدة.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from job_manager import JobManager
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm", ".mkv"}
+WEB_VIDEO_CODECS = {"h264"}
+WEB_AUDIO_CODECS = {"aac", "mp3", None}
+RENDITION_MAX_HEIGHT = 720
+RENDITION_VIDEO_KBPS = 1200
+RENDITION_MIN_VIDEO_KBPS = 250
+RENDITION_AUDIO_KBPS = 96
+RENDITION_MAX_BYTES = 60 * 1024 * 1024  # النسخة الأكبر من ذلك لا تُحفظ (الأصل يبقى متاحاً)
+PROBE_TIMEOUT = 60
+TRANSCODE_TIMEOUT = 30 * 60
+
+
+def find_tool(name):
+    """مسار أداة ffmpeg/ffprobe أو None"""
+    return os.environ.get(f"{name.upper()}_PATH") or shutil.which(name)
+
+
+def is_video(path):
+    return Path(path).suffix.lower() in VIDEO_EXTENSIONS
+
+
+def _run(args, timeout):
+    return subprocess.run(args, capture_output=True, timeout=timeout, check=True)
+
+
+def probe(path):
+    """معلومات الحاوية: {container, duration, width, height, video_codec, audio_codec, bit_rate} أو None بدون ffprobe"""
+    ffprobe = find_tool("ffprobe")
+    if not ffprobe:
+        return None
+    out = _run([ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", str(path)],
+               PROBE_TIMEOUT).stdout
+    info = json.loads(out or b"{}")
+    fmt = info.get("format", {})
+    video = next((s for s in info.get("streams", []) if s.get("codec_type") == "video"), {})
+    audio = next((s for s in info.get("streams", []) if s.get("codec_type") == "audio"), {})
+    duration = fmt.get("duration") or video.get("duration")
+    return {
+        "container": fmt.get("format_name"),
+        "duration": float(duration) if duration not in (None, "N/A") else None,
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "video_codec": video.get("codec_name"),
+        "audio_codec": audio.get("codec_name"),
+        "bit_rate": int(fmt["bit_rate"]) if str(fmt.get("bit_rate", "")).isdigit() else None,
+    }
+
+
+def needs_rendition(info, size):
+    """هل يحتاج الفيديو نسخة ويب؟ (صيغة لا يشغلها المتصفح، أو دقة/حجم أكبر من اللازم للمعاينة)"""
+    container = info.get("container") or ""
+    playable = ("mp4" in container or "mov" in container) and info.get("video_codec") in WEB_VIDEO_CODECS \
+        and info.get("audio_codec") in WEB_AUDIO_CODECS
+    too_large = (info.get("height") or 0) > RENDITION_MAX_HEIGHT or size > RENDITION_MAX_BYTES
+    return not playable or too_large
+
+
+def _atomic_output(dest, suffix):
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=".building_", suffix=suffix, dir=dest.parent)
+    os.close(fd)
+    return Path(tmp_name)
+
+
+def extract_poster(source, dest, duration=None):
+    """حفظ إطار من الفيديو كصورة JPEG (بعد 10% من المدة لتجنب الإطار الأسود الأول). العودة: True عند النجاح"""
+    ffmpeg = find_tool("ffmpeg")
+    if not ffmpeg:
+        return False
+    at = min(5.0, duration * 0.1) if duration else 0
+    tmp = _atomic_output(dest, ".jpg")
+    try:
+        _run([ffmpeg, "-y", "-v", "error", "-ss", f"{at:.2f}", "-i", str(source), "-frames:v", "1",
+              "-vf", "scale=-2:360", "-q:v", "4", str(tmp)], PROBE_TIMEOUT)
+        if tmp.stat().st_size == 0:
+            return False
+        os.replace(tmp, dest)
+        return True
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def rendition_video_kbps(duration):
+    """معدل بت الفيديو بحيث لا تتجاوز النسخة RENDITION_MAX_BYTES (مع هامش 10% لترويسات الحاوية)"""
+    if not duration:
+        return RENDITION_VIDEO_KBPS
+    budget = RENDITION_MAX_BYTES * 8 * 0.9 / 1000 / duration - RENDITION_AUDIO_KBPS
+    return int(max(RENDITION_MIN_VIDEO_KBPS, min(RENDITION_VIDEO_KBPS, budget)))
+
+
+def transcode_web(source, dest, duration=None):
+    """تحويل الفيديو إلى MP4 (H.264/AAC، حتى 720p، معدل بت محسوب من المدة، faststart للتشغيل أثناء التحميل).
+
+    العودة: حجم النسخة، أو None إذا تجاوزت RENDITION_MAX_BYTES أو لم يتوفر ffmpeg.
+    """
+    ffmpeg = find_tool("ffmpeg")
+    if not ffmpeg:
+        return None
+    kbps = rendition_video_kbps(duration)
+    tmp = _atomic_output(dest, ".mp4")
+    try:
+        _run([ffmpeg, "-y", "-v", "error", "-i", str(source),
+              "-vf", f"scale=-2:'min({RENDITION_MAX_HEIGHT},ih)'",
+              "-c:v", "libx264", "-preset", "veryfast", "-b:v", f"{kbps}k",
+              "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k", "-pix_fmt", "yuv420p",
+              "-c:a", "aac", "-b:a", f"{RENDITION_AUDIO_KBPS}k", "-ac", "2",
+              "-movflags", "+faststart", str(tmp)], TRANSCODE_TIMEOUT)
+        size = tmp.stat().st_size
+        if size == 0 or size > RENDITION_MAX_BYTES:
+            return None
+        os.replace(tmp, dest)
+        return size
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def process_video(source, output_dir):
+    """تشغيل خطوات المعالجة على ملف فيديو. العودة: dict بالحقول المسجلة في document_media"""
+    source = Path(source)
+    output_dir = Path(output_dir)
+    size = source.stat().st_size
+    info = probe(source)
+    if info is None:
+        return {"status": "unsupported", "error": "ffprobe غير متوفر"}
+    result = dict(info, status="done")
+    poster = output_dir / "poster.jpg"
+    if extract_poster(source, poster, info.get("duration")):
+        result["poster_path"] = str(poster)
+    if needs_rendition(info, size):
+        rendition = output_dir / "web.mp4"
+        rendition_size = transcode_web(source, rendition, info.get("duration"))
+        if rendition_size:
+            result.update(rendition_path=str(rendition), rendition_size=rendition_size)
+    return result
+
+
+# طابور مستقل لمعالجة الوسائط: خيط واحد حتى لا يستهلك التحويل المعالج أو يؤخر مهام التصدير
+media_jobs = JobManager(max_workers=1)
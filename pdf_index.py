@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+فهرسة ملفات PDF
+=================
+المراجع يفتح كل PDF في صفحة تفاصيل الطلب فقط ليتأكد أنه المستند الصحيح.
+بعد الرفع تعمل مهمة خلفية (طابور مستقل، فالفهرسة السريعة لا تنتظر خلف تحويل فيديو) تسجل:
+
+- عدد الصفحات وحجم الملف.
+- بصمة النص (SHA-256 للنص بعد توحيد المسافات): نفس المستند بنسخة PDF مختلفة البايتات له نفس البصمة.
+- صورة مصغرة للصفحة الأولى في مجلد الوسائط، فالصفحة تعرض صورة صغيرة بدلاً من قراءة الملف كاملاً.
+
+المكتبات اختيارية: PyMuPDF (fitz) ثم pypdfium2. بدونهما يُقدّر عدد الصفحات من بنية الملف فقط
+ولا تُنشأ صورة مصغرة، وتُسجل الحالة 'partial' لتُعاد الفهرسة بعد تثبيت إحداهما.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from job_manager import JobManager
+
+THUMBNAIL_WIDTH = 240
+FINGERPRINT_MAX_PAGES = 20  # بصمة النص من أول 20 صفحة تكفي للتمييز بين المستندات
+
+_PAGE_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+_COUNT_RE = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b", re.S)
+
+
+def available_backend():
+    """اسم مكتبة قراءة PDF المتاحة أو None"""
+    try:
+        import fitz  # noqa: F401
+        return "pymupdf"
+    except ImportError:
+        pass
+    try:
+        import pypdfium2  # noqa: F401
+        return "pypdfium2"
+    except ImportError:
+        return None
+
+
+def text_fingerprint(texts):
+    """بصمة نصية مستقلة عن ترميز الملف (المسافات وحالة الأحرف موحدة). None إذا لم يوجد نص (مستند ممسوح ضوئياً)"""
+    digest = hashlib.sha256()
+    found = False
+    for text in texts:
+        words = " ".join(text.split()).lower()
+        if words:
+            found = True
+            digest.update(words.encode("utf-8"))
+            digest.update(b"\x0c")
+    return digest.hexdigest()[:32] if found else None
+
+
+def count_pages_raw(path):
+    """تقدير عدد الصفحات من بنية الملف بدون مكتبة (لا يعمل مع object streams المضغوطة). None إذا تعذر"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            counts = [int(a or b) for a, b in _COUNT_RE.findall(data)]
+            if counts:
+                return max(counts)
+            pages = len(_PAGE_RE.findall(data))
+    return pages or None
+
+
+def _atomic_image(dest, save):
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=".building_", suffix=dest.suffix, dir=dest.parent)
+    os.close(fd)
+    try:
+        save(tmp_name)
+        os.replace(tmp_name, dest)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def _index_pymupdf(path, thumbnail):
+    import fitz
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
+        fingerprint = text_fingerprint(doc[i].get_text() for i in range(min(page_count, FINGERPRINT_MAX_PAGES)))
+        thumb = None
+        if page_count:
+            page = doc[0]
+            zoom = THUMBNAIL_WIDTH / max(page.rect.width, 1)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            _atomic_image(thumbnail, pixmap.save)
+            thumb = str(thumbnail)
+    return page_count, fingerprint, thumb
+
+
+def _index_pypdfium2(path, thumbnail):
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(str(path))
+    try:
+        page_count = len(pdf)
+
+        def _texts():
+            for i in range(min(page_count, FINGERPRINT_MAX_PAGES)):
+                page = pdf[i]
+                textpage = page.get_textpage()
+                try:
+                    yield textpage.get_text_range()
+                finally:
+                    textpage.close()
+                    page.close()
+
+        fingerprint = text_fingerprint(_texts())
+        thumb = None
+        if page_count:
+            page = pdf[0]
+            try:
+                image = page.render(scale=THUMBNAIL_WIDTH / max(page.get_width(), 1)).to_pil()
+                _atomic_image(thumbnail, lambda name: image.save(name, format="PNG"))
+                thumb = str(thumbnail)
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+    return page_count, fingerprint, thumb
+
+
+def index_pdf(path, output_dir):
+    """فهرسة ملف PDF. العودة: dict بالحقول المسجلة في document_media"""
+    path = Path(path)
+    thumbnail = Path(output_dir) / "thumb.png"
+    backend = available_backend()
+    result = {"status": "done" if backend else "partial", "byte_size": path.stat().st_size}
+    if backend == "pymupdf":
+        page_count, fingerprint, thumb = _index_pymupdf(path, thumbnail)
+    elif backend == "pypdfium2":
+        page_count, fingerprint, thumb = _index_pypdfium2(path, thumbnail)
+    else:
+        page_count, fingerprint, thumb = count_pages_raw(path), None, None
+    result.update(page_count=page_count, text_fingerprint=fingerprint, poster_path=thumb)
+    return result
+
+
+# طابور مستقل لفهرسة PDF: تستغرق أجزاء من الثانية ولا يجب أن تنتظر تحويل فيديو قد يستمر 30 دقيقة في media_jobs
+pdf_jobs = JobManager(max_workers=1)
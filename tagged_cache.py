@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+ذاكرة تخزين مؤقت موسومة (Tagged Cache)
+=========================================
+ذاكرة مؤقتة على مستوى العملية تدعم الإبطال الجزئي حسب الوسوم (tags).
+
+- كل مدخل مرتبط بمجموعة وسوم (key -> tags) وكل وسم يعرف مدخلاته (tag -> keys).
+- إبطال وسم يحذف فقط المدخلات المرتبطة به بدلاً من تفريغ الذاكرة بالكامل.
+- حد أقصى لعدد المدخلات مع إزالة الأقدم استخداماً (LRU) ومدة صلاحية (TTL) لكل مدخل.
+- الدوال المخزنة المتداخلة ترث وسوم الدوال الداخلية تلقائياً، فإبطال وسم "meta"
+  مثلاً يبطل أيضاً get_hospital_types التي تعتمد على cached_query بوسم meta.
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+def _freeze(value):
+    """تحويل المعاملات القابلة للتعديل (list/dict/set) إلى صيغة قابلة للاستخدام كمفتاح"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
+
+class TaggedCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tag_index = {}  # tag -> set(keys)
+        self._local = threading.local()
+        self._versions = {}  # scope -> آخر إصدار معروف من جدول cache_versions
+
+    # ------------------------------------------------------------------ #
+    def _collectors(self):
+        stack = getattr(self._local, "collectors", None)
+        if stack is None:
+            stack = self._local.collectors = []
+        return stack
+
+    def _propagate(self, tags):
+        """إضافة الوسوم لكل الدوال المخزنة الجاري حسابها في نفس الخيط"""
+        for collected in self._collectors():
+            collected.update(tags)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tag_index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_index[tag]
+
+    # ------------------------------------------------------------------ #
+    def get(self, key):
+        """إرجاع (True, value) عند وجود مدخل صالح وإلا (False, None)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value, tags = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._drop(key)
+                return False, None
+            self._entries.move_to_end(key)
+        self._propagate(tags)
+        return True, copy.deepcopy(value)
+
+    def set(self, key, value, tags=(), ttl=None):
+        tags = frozenset(tags)
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (expires_at, copy.deepcopy(value), tags)
+            for tag in tags:
+                self._tag_index.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+        self._propagate(tags)
+
+    def invalidate_tags(self, tags):
+        """إبطال كل المدخلات المرتبطة بأي من الوسوم المحددة"""
+        removed = 0
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tag_index.get(tag, ())):
+                    self._drop(key)
+                    removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tag_index.clear()
+
+    def sync_versions(self, versions):
+        """مقارنة إصدارات النطاقات المخزنة في قاعدة البيانات بآخر إصدارات معروفة لهذه العملية،
+        وإبطال وسوم النطاقات التي تغيرت (بواسطة أي عملية أخرى). تُرجع قائمة النطاقات المتغيرة.
+        """
+        with self._lock:
+            changed = [scope for scope, version in versions.items() if self._versions.get(scope) != version]
+            self._versions.update(versions)
+            if changed:
+                self.invalidate_tags(changed)
+        return changed
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    # ------------------------------------------------------------------ #
+    def cached(self, ttl=None, tags=None):
+        """مزخرف لتخزين نتائج دالة.
+
+        tags: قائمة وسوم ثابتة أو دالة تستقبل نفس معاملات الدالة وتعيد قائمة وسوم.
+        كل دالة مخزنة لها وسم تلقائي باسمها، ويمكن تفريغها بـ func.clear().
+        """
+        def decorator(func):
+            func_tag = f"fn:{func.__module__}.{func.__qualname__}"
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                key = (func_tag, _freeze(args), _freeze(kwargs))
+                hit, value = self.get(key)
+                if hit:
+                    return value
+                entry_tags = {func_tag}
+                if callable(tags):
+                    entry_tags.update(t for t in tags(*args, **kwargs) if t)
+                elif tags:
+                    entry_tags.update(tags)
+                stack = self._collectors()
+                stack.append(entry_tags)
+                try:
+                    value = func(*args, **kwargs)
+                finally:
+                    stack.pop()
+                self.set(key, value, entry_tags, ttl)
+                return value
+
+            wrapper.clear = lambda: self.invalidate_tags([func_tag])
+            return wrapper
+        return decorator
+
+
+# إنشاء مثيل عام من الذاكرة المؤقتة
+query_cache = TaggedCache()
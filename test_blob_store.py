@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات مخزن الملفات بحسب المحتوى (البصمة وعدادات المراجع)
+"""
+
+import hashlib
+import io
+import sqlite3
+import sys
+
+sys.path.append('.')
+
+import pytest
+
+from blob_store import BlobStore
+
+
+@pytest.fixture
+def store_db(tmp_path):
+    conn = sqlite3.connect(tmp_path / "blobs.db")
+    conn.execute("CREATE TABLE blobs (sha256 TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL DEFAULT 0, ref_count INTEGER NOT NULL DEFAULT 0, created_at TEXT)")
+    conn.execute("CREATE TABLE documents (id INTEGER PRIMARY KEY, content_hash TEXT)")
+    yield BlobStore(tmp_path / "blobs", chunk_size=7), conn
+    conn.close()
+
+
+def test_identical_content_is_stored_once(store_db):
+    store, conn = store_db
+    data = b"%PDF-1.4 license" * 10
+    first = store.acquire(conn, store.stage(io.BytesIO(data), ".PDF"))
+    second = store.acquire(conn, store.stage(io.BytesIO(data), ".pdf"))
+    assert first == second and first.name == hashlib.sha256(data).hexdigest() + ".pdf"
+    assert first.read_bytes() == data
+    assert conn.execute("SELECT ref_count, size FROM blobs").fetchone() == (2, len(data))
+    assert not list((store.root / ".staging").iterdir())
+
+
+def test_file_is_removed_only_when_last_reference_is_released(store_db):
+    store, conn = store_db
+    staged = store.stage(io.BytesIO(b"tax card"), ".pdf")
+    path = store.acquire(conn, staged)
+    store.acquire(conn, store.stage(io.BytesIO(b"tax card"), ".pdf"))
+    assert store.release(conn, staged.digest) is False
+    assert store.purge(conn, [staged.digest]) == 0 and path.exists()
+    assert store.release(conn, staged.digest) is True
+    assert store.purge(conn, [staged.digest]) == 1 and not path.exists()
+
+
+def test_rebuild_refcounts_from_documents(store_db):
+    store, conn = store_db
+    kept = store.stage(io.BytesIO(b"kept"), ".pdf")
+    dropped = store.stage(io.BytesIO(b"dropped"), ".pdf")
+    kept_path, dropped_path = store.acquire(conn, kept), store.acquire(conn, dropped)
+    conn.executemany("INSERT INTO documents (content_hash) VALUES (?)", [(kept.digest,), (kept.digest,), (kept.digest,)])
+    orphan = store.path_for("ab" * 32, ".pdf")
+    orphan.parent.mkdir(parents=True)
+    orphan.write_bytes(b"x")
+    blob_count, orphans = store.rebuild_refcounts(conn)
+    assert blob_count == 1
+    assert conn.execute("SELECT ref_count FROM blobs WHERE sha256=?", (kept.digest,)).fetchone()[0] == 3
+    assert store.purge(conn, orphans) == 2
+    assert kept_path.exists() and not dropped_path.exists() and not orphan.exists()
+
+
+def test_purge_waits_for_uncommitted_acquire(store_db, tmp_path):
+    """purge في اتصال آخر لا يحذف ملفاً أعاد acquire استخدامه قبل حفظ معاملته"""
+    store, conn = store_db
+    staged = store.stage(io.BytesIO(b"license"), ".pdf")
+    path = store.acquire(conn, staged)
+    assert store.release(conn, staged.digest) is True
+    conn.commit()
+    store.acquire(conn, store.stage(io.BytesIO(b"license"), ".pdf"))  # لم تُحفظ بعد
+    other = sqlite3.connect(tmp_path / "blobs.db", timeout=0.1)
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            store.purge(other, [staged.digest])
+    finally:
+        other.close()
+    conn.commit()
+    assert path.exists()
+    assert conn.execute("SELECT ref_count FROM blobs").fetchone()[0] == 1
+
+
+class _ReadOnlyStream:
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, n):
+        return self._data.read(n)
+
+
+def test_stage_hashes_every_stream_kind_in_one_pass(store_db, tmp_path):
+    store, _ = store_db
+    data = bytes(range(256)) * 3
+    source = tmp_path / "source.bin"
+    source.write_bytes(data)
+    memory = io.BytesIO(data)
+    memory.seek(0)
+    with open(source, "rb") as disk:
+        staged = [store.stage(memory), store.stage(disk), store.stage(_ReadOnlyStream(data))]
+    assert {s.digest for s in staged} == {hashlib.sha256(data).hexdigest()}
+    assert all(s.size == len(data) and s.temp_path.read_bytes() == data for s in staged)
+    memory.write(b"!")  # لا يبقى memoryview مفتوحاً على المخزن المؤقت بعد الكتابة
+
+
+def test_failed_stage_leaves_no_partial_file(store_db):
+    store, _ = store_db
+
+    class _Broken(_ReadOnlyStream):
+        def read(self, n):
+            if self._data.tell() > 10:
+                raise ConnectionResetError("upload dropped")
+            return super().read(n)
+
+    with pytest.raises(ConnectionResetError):
+        store.stage(_Broken(b"x" * 100))
+    assert not list((store.root / ".staging").iterdir())
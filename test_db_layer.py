@@ -0,0 +1,958 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبار طبقة قاعدة البيانات (تجمع الاتصالات)
+"""
+
+import io
+import sqlite3
+import sys
+from datetime import date
+from pathlib import Path
+sys.path.append('.')
+
+import pytest
+
+from connection_pool import ConnectionPool
+from tagged_cache import TaggedCache
+
+
+@pytest.fixture
+def pool():
+    p = ConnectionPool(max_idle=2)
+    yield p
+    p.close_all()
+
+
+def test_connection_is_reused(pool, tmp_path):
+    """الاتصال يعود للتجمع ويُعاد استخدامه في الطلب التالي"""
+    db = tmp_path / "pool.db"
+    with pool.connection(db) as first:
+        first.execute("CREATE TABLE t (id INTEGER)")
+        first.commit()
+    assert pool.idle_count(db) == 1
+    with pool.connection(db) as second:
+        assert second is first
+
+
+def test_nested_checkout_shares_connection(pool, tmp_path):
+    """الاستدعاءات المتداخلة في نفس الخيط تحصل على نفس الاتصال"""
+    db = tmp_path / "pool.db"
+    with pool.connection(db) as outer:
+        with pool.connection(db) as inner:
+            assert inner is outer
+        assert pool.idle_count(db) == 0
+    assert pool.idle_count(db) == 1
+
+
+def test_uncommitted_work_is_rolled_back(pool, tmp_path):
+    """المعاملات غير المثبتة تُلغى عند إعادة الاتصال للتجمع"""
+    db = tmp_path / "pool.db"
+    with pool.connection(db) as conn:
+        conn.execute("CREATE TABLE t (id INTEGER)")
+        conn.commit()
+        conn.execute("INSERT INTO t VALUES (1)")
+    with pool.connection(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+
+def test_pragmas_applied_once_and_row_factory(pool, tmp_path):
+    """إعدادات PRAGMA تُطبق عند فتح الاتصال"""
+    db = tmp_path / "pool.db"
+    with pool.connection(db, (("journal_mode", "WAL"),)) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        assert conn.row_factory is sqlite3.Row
+
+
+def test_broken_connection_is_discarded(pool, tmp_path):
+    """الاتصال المغلق أو التالف لا يُعاد استخدامه"""
+    db = tmp_path / "pool.db"
+    with pool.connection(db) as conn:
+        pass
+    conn.close()
+    with pool.connection(db) as fresh:
+        assert fresh is not conn
+        assert fresh.execute("SELECT 1").fetchone()[0] == 1
+
+
+def test_idle_pool_is_bounded(pool, tmp_path):
+    """عدد الاتصالات الخاملة لا يتجاوز الحد الأقصى"""
+    import threading
+    db = tmp_path / "pool.db"
+    barrier = threading.Barrier(4)
+
+    def worker():
+        with pool.connection(db):
+            barrier.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert pool.idle_count(db) == 2
+
+
+# ---------------------------- الذاكرة المؤقتة الموسومة ---------------------------- #
+
+def test_tag_invalidation_is_partial():
+    """إبطال وسم لا يمس المدخلات المرتبطة بوسوم أخرى"""
+    cache = TaggedCache()
+    calls = []
+
+    @cache.cached(tags=lambda name: [f"t:{name}"])
+    def load(name):
+        calls.append(name)
+        return [name]
+
+    load("a"), load("b")
+    cache.invalidate_tags(["t:a"])
+    load("a"), load("b")
+    assert calls == ["a", "b", "a"]
+
+
+def test_nested_functions_inherit_tags():
+    """الدالة الخارجية تُبطل عند إبطال وسم الدالة الداخلية"""
+    cache = TaggedCache()
+    calls = []
+
+    @cache.cached(tags=["inner"])
+    def inner():
+        calls.append("inner")
+        return 1
+
+    @cache.cached()
+    def outer():
+        calls.append("outer")
+        return inner() + 1
+
+    assert outer() == 2
+    assert outer() == 2
+    cache.invalidate_tags(["inner"])
+    assert outer() == 2
+    assert calls == ["outer", "inner", "outer", "inner"]
+
+
+def test_lru_eviction_and_copy_on_return():
+    """إزالة الأقدم استخداماً، والقيم المعادة نسخ مستقلة"""
+    cache = TaggedCache(max_entries=2)
+
+    @cache.cached()
+    def load(n):
+        return {"n": n, "items": []}
+
+    load(1)["items"].append("x")
+    assert load(1)["items"] == []
+    load(2)
+    load(1)
+    load(3)
+    assert len(cache) == 2
+    hit, _ = cache.get(("fn:" + load.__module__ + "." + load.__qualname__, (2,), ()))
+    assert not hit
+
+
+def test_function_clear_and_unhashable_args():
+    """دعم المعاملات من نوع list ومسح دالة واحدة بـ clear()"""
+    cache = TaggedCache()
+    calls = []
+
+    @cache.cached()
+    def load(key, default):
+        calls.append(key)
+        return default
+
+    assert load("k", ["x"]) == ["x"]
+    load("k", ["x"])
+    load.clear()
+    load("k", ["x"])
+    assert calls == ["k", "k"]
+
+
+def test_sync_versions_invalidates_changed_scopes_only():
+    """تغيّر إصدار نطاق في قاعدة البيانات يبطل وسمه فقط"""
+    cache = TaggedCache()
+    cache.set("a", 1, tags=["meta:sectors"])
+    cache.set("b", 2, tags=["services"])
+    cache.sync_versions({"meta:sectors": 1, "services": 1})
+    cache.set("a", 1, tags=["meta:sectors"])
+    cache.set("b", 2, tags=["services"])
+    assert cache.sync_versions({"meta:sectors": 2, "services": 1}) == ["meta:sectors"]
+    assert cache.get("a") == (False, None)
+    assert cache.get("b") == (True, 2)
+
+
+# ---------------------------- قاعدة بيانات التطبيق (مؤقتة) ---------------------------- #
+@pytest.fixture
+def app_db(tmp_path, monkeypatch):
+    """تشغيل دوال التطبيق على قاعدة بيانات مؤقتة منفصلة"""
+    import waiting_list_contracts_app as app
+    monkeypatch.setattr(app, "DB_PATH", tmp_path / "app.db")
+    app.query_cache.clear()
+    app.run_ddl()
+    app.ensure_notifications_table()
+    yield app
+    app.query_cache.clear()
+    app.close_db_pool()
+
+
+def test_setter_bumps_cache_version_for_other_processes(app_db):
+    """تعديل القطاعات يزيد إصدار النطاق فتُبطل الذاكرة المؤقتة في العمليات الأخرى"""
+    app = app_db
+    app.sync_cache_versions()
+    before = app.get_sectors()
+    # محاكاة عملية أخرى: كتابة مباشرة + زيادة الإصدار دون إبطال الذاكرة المحلية
+    with app.get_conn() as conn:
+        conn.execute("INSERT INTO meta(key,value) VALUES('sectors', 'قطاع أ') ON CONFLICT(key) DO UPDATE SET value=excluded.value")
+        app.bump_cache_versions(conn, ["meta:sectors"])
+        conn.commit()
+    assert app.get_sectors() == before
+    assert app.sync_cache_versions() == ["meta:sectors"]
+    assert app.get_sectors() == ["قطاع أ"]
+
+
+# ---------------------------- صفحات الإشعارات (keyset) ---------------------------- #
+def test_notifications_keyset_pages_are_ordered_and_complete(app_db):
+    """التنقل بالمؤشر يمر على كل الإشعارات بالترتيب بدون تكرار أو فقد"""
+    app = app_db
+    for i in range(7):
+        app.create_notification(user_id=5, user_role="hospital", title=f"إشعار {i}", message=f"رسالة {i}",
+                                entity_type="request", entity_id=100 + i)
+    app.mark_notification_read(2)
+
+    seen_ids = []
+    cursor = None
+    while True:
+        page, cursor = app.get_notifications_page(5, "hospital", limit=3, cursor=cursor)
+        seen_ids.extend(n["id"] for n in page)
+        if cursor is None:
+            break
+    assert seen_ids == sorted(seen_ids, reverse=True)
+    assert len(seen_ids) == 7
+    assert [n["id"] for n in app.get_user_notifications(5, "hospital", limit=2, offset=1)] == seen_ids[1:3]
+    assert len(app.get_user_notifications(5, "hospital", unread_only=True, limit=0)) == 6
+
+
+def test_fanned_out_events_appear_once_per_feed(app_db):
+    """الحدث الموزع على عدة أدوار يظهر مرة واحدة في كل قائمة، والصفحات تُقسم بلا تخطٍ أو تكرار"""
+    app = app_db
+    audiences = [{"user_role": role, "title": "طلب جديد", "message": "طلب"}
+                 for role in ("admin", "reviewer_general", "reviewer_sector")]
+    for request_id in range(1, 5):
+        app.send_notifications(f"req_created:{request_id}", audiences, entity_type="request",
+                               entity_id=request_id, sector="القاهرة")
+    for role, sector in (("admin", None), ("reviewer_general", None), ("reviewer_sector", "القاهرة")):
+        first, cursor = app.get_notifications_page(1, role, sector, limit=2)
+        second, last_cursor = app.get_notifications_page(1, role, sector, limit=2, cursor=cursor)
+        assert [n["role"] for n in first + second] == [role] * 4
+        assert len({n["event_key"] for n in first + second}) == 4
+        assert last_cursor is None
+
+
+def test_notifications_feed_uses_composite_indexes(app_db):
+    """استعلام كل دور يستخدم الفهرس المركب الخاص بقاعدة الرؤية"""
+    app = app_db
+    expected = {
+        "hospital": "idx_notifications_user_read_created",
+        "reviewer_sector": "idx_notifications_sector_read_created",
+        "reviewer_general": "idx_notifications_entity_read_created",
+        "admin": "idx_notifications_read_created",
+    }
+    with app.get_conn() as conn:
+        for role, index_name in expected.items():
+            query, params = app._build_notifications_query_for_user(1, role, "قطاع", limit=20, cursor=("2025-01-01T00:00:00", 10))
+            plan = " ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall())
+            assert index_name in plan, (role, plan)
+
+
+# ---------------------------- عدادات غير المقروء ---------------------------- #
+def test_unread_counters_track_create_and_mark_read(app_db):
+    """العدادات المخزنة تطابق COUNT المباشر بعد الإنشاء والقراءة"""
+    app = app_db
+    app.create_notification(user_id=7, user_role="hospital", title="أ", message="١", entity_type="request", entity_id=1, sector="القاهرة")
+    app.create_notification(user_id=7, user_role="hospital", title="ب", message="٢", entity_type="request", entity_id=2, sector="القاهرة")
+    app.create_notification(user_role="admin", title="ج", message="٣", entity_type="system", sector="الجيزة")
+    with app.get_conn() as conn:
+        first_id = conn.execute("SELECT MIN(id) as i FROM notifications").fetchone()['i']
+    app.mark_notification_read(first_id)
+    app.mark_notification_read(first_id)  # قراءة مكررة لا تنقص العداد مرتين
+
+    assert app.get_unread_count(7, "hospital") == 1
+    assert app.get_unread_count(1, "admin") == 2
+    assert app.get_unread_count(1, "reviewer_general") == 1
+    assert app.get_unread_count(1, "reviewer_sector", "القاهرة") == 1
+    assert app.get_unread_count(1, "reviewer_sector", "الجيزة") == 1
+
+    with app.get_conn() as conn:
+        before = [tuple(r) for r in conn.execute("SELECT * FROM unread_counters ORDER BY audience, sector, user_id")]
+    app.rebuild_unread_counters()
+    with app.get_conn() as conn:
+        after = [tuple(r) for r in conn.execute("SELECT * FROM unread_counters WHERE unread > 0 ORDER BY audience, sector, user_id")]
+    assert [r for r in before if r[3] > 0] == after
+
+
+# ---------------------------- منع تكرار الإشعارات ---------------------------- #
+def test_send_notifications_is_idempotent_per_event_and_role(app_db):
+    """نفس الحدث لا يُدرج مرتين لنفس الدور، وكل دور يحصل على إشعاره"""
+    app = app_db
+    audiences = [
+        {"user_role": "admin", "title": "طلب جديد", "message": "طلب رقم 1"},
+        {"user_role": "reviewer_general", "title": "طلب للمراجعة", "message": "طلب رقم 1"},
+        {"user_role": "reviewer_sector", "title": "طلب في قطاعك", "message": "طلب رقم 1"},
+    ]
+    assert app.send_notifications("req_created:1", audiences, entity_type="request", entity_id=1, sector="القاهرة") == 3
+    assert app.send_notifications("req_created:1", audiences, entity_type="request", entity_id=1, sector="القاهرة") == 0
+    assert app.send_notification_once("req_created:1", user_role="admin", title="x", message="y") is False
+    with app.get_conn() as conn:
+        assert conn.execute("SELECT COUNT(1) as c FROM notifications").fetchone()['c'] == 3
+    # الحدث الواحد يُعد مرة واحدة لكل جمهور (القائمة تعرضه مرة واحدة)
+    assert app.get_unread_count(1, "admin") == 1
+    assert app.get_unread_count(1, "reviewer_general") == 1
+    assert app.get_unread_count(1, "reviewer_sector", "القاهرة") == 1
+    assert len(app.get_user_notifications(1, "admin", unread_only=True, limit=0)) == 1
+
+
+def test_reading_event_only_clears_own_audience(app_db):
+    """قراءة إشعار حدث تعلّم صف دور القارئ فقط: الجماهير الأخرى تبقى غير مقروءة وتطابق إعادة البناء"""
+    app = app_db
+    audiences = [{"user_role": role, "title": "طلب جديد", "message": "طلب رقم 2"}
+                 for role in ("admin", "reviewer_general", "reviewer_sector")]
+    app.send_notifications("req_created:2", audiences, entity_type="request", entity_id=2, sector="القاهرة")
+    app.send_notifications("req_created:3", audiences, entity_type="request", entity_id=3, sector="القاهرة")
+    app.send_notifications("req_status:2:تمت الموافقة",
+                           [{"user_id": 7, "user_role": "hospital", "title": "تحديث", "message": "طلبك"}] + audiences,
+                           entity_type="request", entity_id=2, sector="القاهرة")
+    notif = next(n for n in app.get_user_notifications(1, "reviewer_sector", "القاهرة", limit=0)
+                 if n["event_key"] == "req_created:2")
+    assert app.mark_notification_read(notif["id"], 1, "reviewer_sector", "القاهرة")
+    assert app.get_unread_count(1, "reviewer_sector", "القاهرة") == 2
+    for role in ("admin", "reviewer_general"):
+        assert app.get_unread_count(1, role) == 3
+
+    hospital_notif = app.get_user_notifications(7, "hospital", limit=0)[0]
+    assert app.mark_notification_read(hospital_notif["id"], 7, "hospital")
+    assert app.get_unread_count(7, "hospital") == 0
+    assert app.get_unread_count(1, "reviewer_sector", "القاهرة") == 2
+    with app.get_conn() as conn:
+        unread = {r["role"] for r in conn.execute("SELECT role FROM notifications WHERE event_key = 'req_status:2:تمت الموافقة' AND is_read = 0")}
+        assert unread == {"admin", "reviewer_general", "reviewer_sector"}
+        before = [tuple(r) for r in conn.execute("SELECT * FROM unread_counters WHERE unread > 0 ORDER BY audience, sector, user_id")]
+    app.rebuild_unread_counters()
+    with app.get_conn() as conn:
+        after = [tuple(r) for r in conn.execute("SELECT * FROM unread_counters WHERE unread > 0 ORDER BY audience, sector, user_id")]
+    assert before == after
+
+
+def test_existing_duplicates_are_removed_before_unique_index(app_db):
+    """الإشعارات المكررة القديمة تُحذف عند إنشاء الفهرس الفريد وتُعاد العدادات"""
+    app = app_db
+    with app.get_conn() as conn:
+        conn.execute("DROP INDEX idx_notifications_event_role")
+        for _ in range(3):
+            conn.execute("INSERT INTO notifications (role, title, message, event_key, is_read, created_at) VALUES ('admin', 't', 'm', 'dup:1', 0, '2025-01-01')")
+        conn.commit()
+    app.ensure_notifications_table()
+    with app.get_conn() as conn:
+        assert conn.execute("SELECT COUNT(1) as c FROM notifications WHERE event_key = 'dup:1'").fetchone()['c'] == 1
+    assert app.get_unread_count(1, "admin") == 1
+
+
+# ---------------------------- مستندات الطلب ---------------------------- #
+def _create_request(app, hospital_type="خاص"):
+    with app.get_conn() as conn:
+        hospital_id = conn.execute("INSERT INTO hospitals (name, type, sector) VALUES ('مستشفى تجريبي', ?, 'القاهرة')", (hospital_type,)).lastrowid
+        request_id = conn.execute("INSERT INTO requests (hospital_id, service_id, status, created_at, sector) VALUES (?, 1, 'طلب غير مرسل', '2025-01-01T10:00:00', 'القاهرة')",
+                                  (hospital_id,)).lastrowid
+        conn.commit()
+    return hospital_id, request_id
+
+
+def test_ensure_request_docs_is_noop_when_config_unchanged(app_db):
+    """المزامنة تُنشئ المستندات مرة واحدة ولا تكتب شيئاً في المرات التالية"""
+    app = app_db
+    _, request_id = _create_request(app)
+    assert app.ensure_request_docs(request_id, "خاص") is True
+    with app.get_conn() as conn:
+        docs = {r['doc_type']: r['required'] for r in conn.execute("SELECT doc_type, required FROM documents WHERE request_id=?", (request_id,))}
+        changes_before = conn.total_changes
+        assert app.ensure_request_docs(request_id, "خاص") is False
+        assert conn.total_changes == changes_before
+    assert len(docs) == len(app.get_document_types())
+    optional = app.get_optional_docs_for_type("خاص")
+    assert all(docs[name] == (0 if name in optional else 1) for name in docs)
+
+
+def test_ensure_request_docs_resyncs_after_optional_docs_change(app_db):
+    """تغيير المستندات الاختيارية يغير بصمة الإعدادات فتُعاد المزامنة"""
+    app = app_db
+    _, request_id = _create_request(app)
+    app.ensure_request_docs(request_id, "خاص")
+    target = app.get_document_types()[0]['name']
+    job_id = app.set_optional_docs_for_type("خاص", [target])
+    app.job_manager.wait(job_id, timeout=10)
+    assert app.ensure_request_docs(request_id, "خاص") is True
+    with app.get_conn() as conn:
+        rows = {r['doc_type']: r['required'] for r in conn.execute("SELECT doc_type, required FROM documents WHERE request_id=?", (request_id,))}
+        assert conn.execute("SELECT COUNT(1) as c FROM documents WHERE request_id=?", (request_id,)).fetchone()['c'] == len(rows)
+    assert rows[target] == 0
+    assert sum(1 for v in rows.values() if v == 0) == 1
+
+
+def test_optional_docs_recompute_runs_as_background_job(app_db):
+    """تغيير المستندات الاختيارية يعيد حساب required لكل الطلبات الموجودة في مهمة خلفية"""
+    app = app_db
+    request_ids = [_create_request(app)[1] for _ in range(3)]
+    for request_id in request_ids:
+        app.ensure_request_docs(request_id, "خاص")
+    doc_names = [d['name'] for d in app.get_document_types()][:2]
+
+    job_id = app.set_optional_docs_for_type("خاص", doc_names)
+    job = app.job_manager.wait(job_id, timeout=10)
+    assert job["status"] == "done"
+    assert job["processed"] == job["total"] == 1
+    with app.get_conn() as conn:
+        optional_rows = conn.execute("SELECT COUNT(1) as c FROM documents WHERE required = 0").fetchone()['c']
+    assert optional_rows == 2 * len(request_ids)
+    # إعادة التشغيل بدون تغيير لا تعدل أي صف
+    assert app.update_existing_requests_optional_docs(hospital_type="خاص") == 0
+
+
+# ---------------------------- متصفح الطلبات ---------------------------- #
+def test_admin_requests_keyset_pages_cover_all_rows(app_db):
+    """صفحات keyset للطلبات لا تكرر ولا تفقد صفوفاً مع ترتيب فيه قيم متساوية"""
+    app = app_db
+    with app.get_conn() as conn:
+        hospital_id = conn.execute("INSERT INTO hospitals (name, type, sector) VALUES ('مستشفى', 'خاص', 'القاهرة')").lastrowid
+        for i in range(23):
+            conn.execute("INSERT INTO requests (hospital_id, service_id, status, created_at) VALUES (?, 1, ?, ?)",
+                         (hospital_id, "مقبول" if i % 2 else "مرفوض", f"2025-01-{1 + i // 3:02d}T10:00:00"))
+        conn.commit()
+    columns_sql = "r.id, r.status, r.created_at"
+    from_sql = "requests r JOIN hospitals h ON h.id=r.hospital_id JOIN services s ON s.id=r.service_id"
+    conditions, params = ["r.deleted_at IS NULL"], []
+    assert app.count_keyset_rows(from_sql, conditions, params) == 23
+
+    for sort_column in app.REQUEST_SORT_OPTIONS.values():
+        for descending in (True, False):
+            seen, cursor = [], None
+            with app.get_conn() as conn:
+                while True:
+                    rows, cursor = app.fetch_keyset_page(conn, columns_sql, from_sql, conditions, params,
+                                                         sort_column, descending, 10, cursor)
+                    assert len(rows) <= 10
+                    seen.extend(rows)
+                    if cursor is None:
+                        break
+            assert sorted(r['id'] for r in seen) == sorted({r['id'] for r in seen})
+            assert len(seen) == 23
+            key = sort_column.split(".")[1]
+            keys = [(r[key], r['id']) for r in seen]
+            assert keys == sorted(keys, reverse=descending)
+
+
+# ---------------------------- فلاتر التاريخ ---------------------------- #
+def test_date_range_conditions_are_half_open_and_match_date_semantics(app_db):
+    """النطاق نصف المفتوح يعطي نفس نتيجة DATE(col) BETWEEN مع شمول اليوم الأخير"""
+    app = app_db
+    conditions, params = app.date_range_conditions("timestamp", date(2025, 1, 2), "2025-01-03")
+    assert conditions == ["timestamp >= ?", "timestamp < ?"]
+    assert params == ["2025-01-02", "2025-01-04"]
+    assert app.date_range_conditions("timestamp") == ([], [])
+
+    with app.get_conn() as conn:
+        for ts in ["2025-01-01T23:59:59", "2025-01-02T00:00:00", "2025-01-02 08:00:00",
+                   "2025-01-03T23:59:59.999999", "2025-01-04T00:00:00"]:
+            conn.execute("INSERT INTO activity_log (timestamp, action) VALUES (?, 'x')", (ts,))
+        conn.commit()
+        where = " AND ".join(conditions)
+        ranged = conn.execute(f"SELECT timestamp FROM activity_log WHERE {where}", params).fetchall()
+        legacy = conn.execute("SELECT timestamp FROM activity_log WHERE DATE(timestamp) >= ? AND DATE(timestamp) <= ?",
+                              ("2025-01-02", "2025-01-03")).fetchall()
+    assert sorted(r['timestamp'] for r in ranged) == sorted(r['timestamp'] for r in legacy)
+    assert len(ranged) == 3
+
+
+@pytest.mark.parametrize("table,column,index", [
+    ("requests", "created_at", "idx_requests_created_at"),
+    ("audit_log", "timestamp", "idx_audit_log_timestamp"),
+    ("activity_log", "timestamp", "idx_activity_log_timestamp"),
+])
+def test_date_range_filters_use_timestamp_indexes(app_db, table, column, index):
+    """فلاتر التاريخ تستخدم فهرس العمود (SEARCH) بدلاً من مسح الجدول كاملاً"""
+    app = app_db
+    conditions, params = app.date_range_conditions(column, date(2025, 1, 1), date(2025, 1, 31))
+    with app.get_conn() as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE {' AND '.join(conditions)} ORDER BY {column} DESC",
+                            params).fetchall()
+    details = " | ".join(row['detail'] for row in plan)
+    assert f"SEARCH {table} USING INDEX {index}" in details
+
+
+# ---------------------------- محرك الإحصائيات ---------------------------- #
+def test_request_statistics_single_pass_matches_group_by(app_db):
+    """التوزيعات المشتقة من المسح الواحد تطابق استعلامات GROUP BY المنفصلة"""
+    app = app_db
+    with app.get_conn() as conn:
+        h1 = conn.execute("INSERT INTO hospitals (name, type, sector, governorate) VALUES ('أ', 'خاص', 'القاهرة', 'الجيزة')").lastrowid
+        h2 = conn.execute("INSERT INTO hospitals (name, type, sector) VALUES ('ب', 'حكومي', NULL)").lastrowid
+        for i in range(12):
+            conn.execute("INSERT INTO requests (hospital_id, service_id, status, created_at) VALUES (?, ?, ?, '2025-01-01T10:00:00')",
+                         (h1 if i % 3 else h2, 1 + i % 2, "مقبول" if i % 4 else "مرفوض"))
+        conn.commit()
+        where, params = "r.deleted_at IS NULL", []
+        stats = app.compute_request_statistics(where, params, "COALESCE(r.governorate, h.governorate)")
+        for key, (column, expr) in {"status": ("status", "r.status"), "service": ("name", "s.name"),
+                                    "type": ("type", "h.type"), "sector": ("sector", "h.sector")}.items():
+            expected = {r[0]: r[1] for r in conn.execute(
+                f"SELECT {expr}, COUNT(*) FROM requests r JOIN hospitals h ON r.hospital_id = h.id "
+                f"JOIN services s ON r.service_id = s.id WHERE {where} GROUP BY {expr}")}
+            assert {row[column]: row["count"] for row in stats[key]} == expected
+    assert stats["governorate"] == [{"governorate": "الجيزة", "count": 8}]
+    assert sum(row["count"] for row in stats["comprehensive"]) == 12
+    counts = [row["count"] for row in stats["status"]]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_request_stats_rollup_tracks_incremental_changes(app_db):
+    """جدول التجميع اليومي يبقى مطابقاً للمسح التفصيلي بعد الإنشاء وتغيير الحالة والحذف والاسترجاع"""
+    app = app_db
+    with app.get_conn() as conn:
+        hospital_id = conn.execute("INSERT INTO hospitals (name, type, sector, governorate) VALUES ('أ', 'خاص', 'القاهرة', 'الجيزة')").lastrowid
+        request_ids = []
+        for i in range(6):
+            request_id = conn.execute("INSERT INTO requests (hospital_id, service_id, status, created_at) VALUES (?, ?, 'طلب غير مرسل', ?)",
+                                      (hospital_id, 1 + i % 2, f"2025-01-0{1 + i % 3}T10:00:00")).lastrowid
+            app.update_request_stats(conn, request_id, 1)
+            request_ids.append(request_id)
+        # تغيير حالة وحذف واسترجاع
+        app.update_request_stats(conn, request_ids[0], -1)
+        conn.execute("UPDATE requests SET status='مقبول' WHERE id=?", (request_ids[0],))
+        app.update_request_stats(conn, request_ids[0], 1)
+        app.update_request_stats(conn, request_ids[1], -1)
+        conn.execute("UPDATE requests SET deleted_at='2025-02-01' WHERE id=?", (request_ids[1],))
+        # تعديل قطاع المستشفى
+        app.update_hospital_request_stats(conn, hospital_id, -1)
+        conn.execute("UPDATE hospitals SET sector='الإسكندرية' WHERE id=?", (hospital_id,))
+        app.update_hospital_request_stats(conn, hospital_id, 1)
+        conn.commit()
+        incremental = {tuple(r)[:-1]: r['count'] for r in conn.execute("SELECT * FROM request_stats_daily WHERE count > 0")}
+
+    app.rebuild_request_stats_daily()
+    with app.get_conn() as conn:
+        rebuilt = {tuple(r)[:-1]: r['count'] for r in conn.execute("SELECT * FROM request_stats_daily")}
+    assert incremental == rebuilt
+
+    for filters in ({}, {"status": "مقبول"}, {"sector": "الإسكندرية", "date_from": date(2025, 1, 2), "date_to": date(2025, 1, 2)}):
+        where, params = ["r.deleted_at IS NULL"], []
+        for key, column in (("status", "r.status"), ("sector", "h.sector")):
+            if key in filters:
+                where.append(f"{column} = ?")
+                params.append(filters[key])
+        conditions, date_params = app.date_range_conditions("r.created_at", filters.get("date_from"), filters.get("date_to"))
+        detailed = app.compute_request_statistics(" AND ".join(where + conditions), params + date_params,
+                                                  "COALESCE(r.governorate, h.governorate)")
+        rollup = app.compute_request_statistics_from_rollup(filters)
+        for key in app.STATS_DIMENSIONS:
+            assert sorted(rollup[key], key=str) == sorted(detailed[key], key=str)
+
+
+# ---------------------------- سجل إمكانيات البنية ---------------------------- #
+def test_schema_capabilities_cached_until_migrations_run(app_db):
+    """سجل البنية يُقرأ مرة واحدة ولا يُحدّث إلا بعد تشغيل الترحيلات"""
+    app = app_db
+    caps = app.get_schema_capabilities()
+    assert caps.has_column("requests", "governorate")
+    assert caps.has_table("request_stats_daily")
+    assert not caps.has_column("requests", "no_such_column")
+    with app.get_conn() as conn:
+        assert app.column_exists(conn, "requests", "governorate")
+        assert not app.column_exists(conn, "no_such_table", "id")
+        conn.execute("ALTER TABLE requests ADD COLUMN probe_col TEXT")
+        conn.commit()
+    # بدون ترحيلات تبقى اللقطة المخزنة كما هي
+    assert not app.get_schema_capabilities().has_column("requests", "probe_col")
+    app.run_ddl()
+    assert app.get_schema_capabilities().has_column("requests", "probe_col")
+
+
+# ---------------------------- المسار السريع لبدء التشغيل ---------------------------- #
+def test_run_ddl_fast_path_skips_verifier_when_schema_current(app_db, monkeypatch):
+    """إذا كان الإصدار والبصمة مطابقين لا يعمل التحقق الكامل، وأي تغيير في البنية يعيد تشغيله"""
+    app = app_db
+    assert app.schema_is_current()
+    calls = []
+    original = app.verify_and_auto_migrate_schema
+    monkeypatch.setattr(app, "verify_and_auto_migrate_schema", lambda: calls.append(1) or original())
+
+    assert app.run_ddl() == []
+    assert calls == []
+
+    with app.get_conn() as conn:
+        conn.execute("DROP INDEX idx_requests_status")
+        conn.commit()
+    assert not app.schema_is_current()
+    app.run_ddl()
+    assert calls == [1]
+    with app.get_conn() as conn:
+        assert app.index_exists(conn, "idx_requests_status")
+    assert app.schema_is_current()
+
+    # التحقق الكامل متاح دائماً
+    app.run_ddl(full=True)
+    assert calls == [1, 1]
+
+    app.set_schema_version(app.DB_SCHEMA_VERSION - 1)
+    assert not app.schema_is_current()
+
+
+# ---------------------------- الملفات الثابتة ---------------------------- #
+def test_static_asset_src_encodes_once_and_tracks_mtime(app_db, tmp_path, monkeypatch):
+    """الصورة تُرمز مرة واحدة لكل عملية، وتغيير الملف (mtime) يعطي نسخة جديدة، ومع الخدمة الثابتة يُستخدم رابط"""
+    import os
+    app = app_db
+    monkeypatch.setattr(app, "RESOURCES_DIR", tmp_path)
+    monkeypatch.setattr(app, "_static_serving_enabled", lambda: False)
+    image = tmp_path / "logo.png"
+    image.write_bytes(b"first")
+    reads = []
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda f, *a, **k: reads.append(str(f)) or real_open(f, *a, **k))
+
+    first = app.static_asset_src(image)
+    assert first.startswith("data:image/png;base64,")
+    assert app.static_asset_src(image) == first
+    assert reads.count(str(image)) == 1
+
+    image.write_bytes(b"second")
+    os.utime(image, ns=(1, 2_000_000_000))
+    assert app.static_asset_src(image) != first
+    assert app.static_asset_src(tmp_path / "missing.png") is None
+
+    monkeypatch.setattr(app, "_static_serving_enabled", lambda: True)
+    assert app.static_asset_src(image) == "app/static/logo.png?v=2000000000"
+
+
+# ---------------------------- تجهيز التنزيل عند الطلب ---------------------------- #
+def test_prepared_downloads_lru_is_capped_by_bytes(app_db, tmp_path, monkeypatch):
+    """الملفات المجهزة تبقى في ذاكرة الجلسة حتى الحد الأقصى للحجم ثم يُزال الأقدم استخداماً"""
+    app = app_db
+    monkeypatch.setattr(app, "PREPARED_DOWNLOADS_MAX_BYTES", 25)
+    app.st.session_state.pop("prepared_downloads", None)
+    files = {}
+    for name in "abc":
+        path = tmp_path / f"{name}.pdf"
+        path.write_bytes(name.encode() * 10)
+        files[name] = (str(path), path.stat().st_mtime_ns, 10), path
+
+    assert app.get_prepared_download(files["a"][0]) is None
+    assert app.prepare_download(*files["a"]) == b"a" * 10
+    app.prepare_download(*files["b"])
+    assert app.get_prepared_download(files["a"][0]) == b"a" * 10  # a أصبح الأحدث استخداماً
+    app.prepare_download(*files["c"])
+    assert app.get_prepared_download(files["b"][0]) is None
+    assert app.get_prepared_download(files["a"][0]) is not None
+    assert app.get_prepared_download(files["c"][0]) is not None
+
+    big = tmp_path / "big.pdf"
+    big.write_bytes(b"x" * 30)
+    big_key = (str(big), big.stat().st_mtime_ns, 30)
+    assert app.prepare_download(big_key, big) == b"x" * 30  # أكبر من الحد: تُعاد البيانات دون تخزين
+    assert app.get_prepared_download(big_key) is None
+    assert app.get_prepared_download(files["c"][0]) is not None
+    app.st.session_state.pop("prepared_downloads", None)
+
+
+# ---------------------------- التصدير الجماعي ---------------------------- #
+def test_bulk_export_job_builds_folder_per_request(app_db, tmp_path, monkeypatch):
+    """مهمة التصدير الجماعي تستخدم فلاتر متصفح الطلبات وتبني مجلداً لكل طلب"""
+    import zipfile
+    app = app_db
+    monkeypatch.setattr(app, "BULK_EXPORTS_DIR", tmp_path / "bulk")
+    _, first = _create_request(app)
+    _, second = _create_request(app)
+    with app.get_conn() as conn:
+        for request_id in (first, second):
+            path = tmp_path / f"doc_{request_id}.pdf"
+            path.write_bytes(b"%PDF-" + bytes([request_id]))
+            conn.execute("INSERT INTO documents (request_id, doc_type, file_path, satisfied) VALUES (?, 'عقد', ?, 1)",
+                         (request_id, str(path)))
+        conn.commit()
+    from_sql = "requests r JOIN hospitals h ON h.id=r.hospital_id JOIN services s ON s.id=r.service_id"
+    job_id = app.job_manager.submit("bulk_export", "test", app.bulk_export_requests, from_sql, ["r.id = ?"], [second])
+    job = app.job_manager.wait(job_id, timeout=10)
+    assert job["status"] == "done", job["error"]
+    with zipfile.ZipFile(job["result"]) as zf:
+        names = zf.namelist()
+    assert len(names) == 1 and names[0].startswith(f"request_{second}_") and names[0].endswith("/عقد.pdf")
+
+
+def test_request_zip_cache_drops_archives_older_than_a_day(app_db, tmp_path, monkeypatch):
+    """ذاكرة أرشيفات الطلبات تُنظف حسب العمر وليس فقط لنفس الطلب"""
+    import os
+    app = app_db
+    monkeypatch.setattr(app, "ZIP_CACHE_DIR", tmp_path / "zip_cache")
+    stale = tmp_path / "zip_cache" / "request_99_old.zip"
+    stale.parent.mkdir()
+    stale.write_bytes(b"PK")
+    os.utime(stale, (0, 0))
+    doc = tmp_path / "license.pdf"
+    doc.write_bytes(b"%PDF-1.4")
+    path, files_added = app.export_request_zip(1, [{"file_path": str(doc), "doc_type": "ترخيص", "updated_at": "v1"}])
+    assert files_added == 1 and path.exists() and not stale.exists()
+
+
+def test_bulk_export_jobs_are_listed_for_their_owner_only(app_db):
+    """أرشيف التصدير مبني بفلاتر صاحبه، فلا يظهر في قائمة مهام مستخدم آخر"""
+    app = app_db
+    job_id = app.job_manager.submit("bulk_export", "owned", lambda job: None, owner="admin:1")
+    app.job_manager.wait(job_id, timeout=10)
+    assert job_id in [j["id"] for j in app.job_manager.list_jobs("bulk_export", owner="admin:1")]
+    assert job_id not in [j["id"] for j in app.job_manager.list_jobs("bulk_export", owner="reviewer_sector:2")]
+
+
+# ---------------------------- مخزن الملفات بحسب المحتوى ---------------------------- #
+def _upload(app, request_id, doc_type, data, name="file.pdf"):
+    import io
+    with app.get_conn() as conn:
+        doc = conn.execute("SELECT * FROM documents WHERE request_id=? AND doc_type=?", (request_id, doc_type)).fetchone()
+        if doc is None:
+            doc_id = conn.execute("INSERT INTO documents (request_id, doc_type) VALUES (?, ?)", (request_id, doc_type)).lastrowid
+            conn.commit()
+            doc = conn.execute("SELECT * FROM documents WHERE id=?", (doc_id,)).fetchone()
+    upload = io.BytesIO(data)
+    upload.name, upload.size = name, len(data)
+    assert app.save_uploaded_file(upload, {"id": 1}, request_id, doc)
+    for job in app.media_jobs.list_jobs("media") + app.pdf_jobs.list_jobs("media"):
+        app.wait_document_media(job["id"], timeout=10)
+    with app.get_conn() as conn:
+        return conn.execute("SELECT * FROM documents WHERE id=?", (doc['id'],)).fetchone()
+
+
+def test_duplicate_uploads_share_one_blob_until_last_delete(app_db, tmp_path, monkeypatch):
+    """نفس الترخيص المرفوع لطلبين يُخزن مرة واحدة، ويُحذف من القرص مع آخر مستند يشير إليه"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    _, first = _create_request(app)
+    _, second = _create_request(app)
+    license_pdf = b"%PDF-1.4 license" * 100
+    doc_a = _upload(app, first, "ترخيص", license_pdf)
+    doc_b = _upload(app, second, "ترخيص", license_pdf)
+    assert doc_a['file_path'] == doc_b['file_path'] and doc_a['file_name'] == "ترخيص.pdf"
+    with app.get_conn() as conn:
+        assert conn.execute("SELECT ref_count FROM blobs WHERE sha256=?", (doc_a['content_hash'],)).fetchone()[0] == 2
+
+    # استبدال الملف في الطلب الأول يحرر مرجعه فقط
+    replaced = _upload(app, first, "ترخيص", b"%PDF-1.4 renewed")
+    assert replaced['file_path'] != doc_a['file_path']
+    assert Path(doc_b['file_path']).exists()
+
+    app._callback_delete_document_admin(doc_b['id'], doc_b['file_path'])
+    assert not Path(doc_b['file_path']).exists()
+    with app.get_conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 1
+    assert app.rebuild_blob_refcounts() == (1, 0)
+
+
+def test_legacy_documents_are_migrated_into_blob_store(app_db, tmp_path, monkeypatch):
+    """الملفات القديمة المكررة تُنقل إلى المخزن وتُحذف نسخها الخاصة بكل طلب"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    _, request_id = _create_request(app)
+    with app.get_conn() as conn:
+        for i in range(2):
+            legacy = tmp_path / f"legacy_{i}.pdf"
+            legacy.write_bytes(b"%PDF-1.4 same")
+            conn.execute("INSERT INTO documents (request_id, doc_type, file_path, satisfied) VALUES (?, ?, ?, 1)",
+                         (request_id, f"نوع {i}", str(legacy)))
+        conn.commit()
+    assert app.migrate_documents_to_blob_store() == (2, 2)
+    with app.get_conn() as conn:
+        paths = {r['file_path'] for r in conn.execute("SELECT file_path FROM documents WHERE request_id=?", (request_id,))}
+        assert conn.execute("SELECT ref_count FROM blobs").fetchone()[0] == 2
+    assert len(paths) == 1 and Path(paths.pop()).read_bytes() == b"%PDF-1.4 same"
+
+
+def test_deduped_documents_release_their_blobs(app_db, tmp_path, monkeypatch):
+    """حذف صفوف المستندات المكررة أثناء الترحيل ينقص عدادات المخزن ويحذف الملف غير المستخدم"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    _, request_id = _create_request(app)
+    kept = _upload(app, request_id, "ترخيص", b"%PDF-1.4 kept")
+    dropped = app.blob_store.stage(io.BytesIO(b"%PDF-1.4 dropped"), ".pdf")
+    with app.get_conn() as conn:
+        conn.execute("DROP INDEX idx_documents_request_doc_type")
+        path = app.blob_store.acquire(conn, dropped)
+        conn.execute("INSERT INTO documents (request_id, doc_type, file_path, content_hash, uploaded_at) VALUES (?, 'ترخيص', ?, ?, '2000-01-01')",
+                     (request_id, str(path), dropped.digest))
+        conn.commit()
+    app.run_ddl(full=True)
+    with app.get_conn() as conn:
+        assert [r[0] for r in conn.execute("SELECT sha256 FROM blobs")] == [kept['content_hash']]
+    assert not path.exists() and Path(kept['file_path']).exists()
+    assert app.rebuild_blob_refcounts() == (1, 0)
+
+
+# ---------------------------- روابط خادم الملفات ---------------------------- #
+def test_file_server_url_requires_known_plain_http_host(app_db, monkeypatch):
+    """بدون FILE_SERVER_PUBLIC_URL لا يُبنى رابط إلا من ترويسة Host لطلب http (وإلا التنزيل من داخل التطبيق)"""
+    from types import SimpleNamespace
+    app = app_db
+    monkeypatch.setattr(app, "FILE_SERVER_PUBLIC_URL", "")
+    monkeypatch.delattr(app.st, "context", raising=False)
+    assert app._file_server_base_url() is None
+    monkeypatch.setattr(app.st, "context", SimpleNamespace(headers={"Host": "apps.example.org:8501"}), raising=False)
+    assert app._file_server_base_url() == f"http://apps.example.org:{app.file_server.port}"
+    monkeypatch.setattr(app.st, "context", SimpleNamespace(
+        headers={"Host": "apps.example.org", "X-Forwarded-Proto": "https"}), raising=False)
+    assert app._file_server_base_url() is None
+    monkeypatch.setattr(app, "FILE_SERVER_PUBLIC_URL", "https://files.example.org")
+    assert app._file_server_base_url() == "https://files.example.org"
+
+
+# ---------------------------- الرفع القابل للاستكمال ---------------------------- #
+def test_backup_skips_partial_uploads_and_derived_media(app_db):
+    """النسخ الاحتياطي لا ينسخ الرفع الجزئي ونواتج المعالجة والملفات المؤقتة"""
+    app = app_db
+    assert app._backup_ignore(str(app.STORAGE_DIR), ["blobs", "uploads", "media", "legacy"]) == ["uploads", "media"]
+    assert app._backup_ignore(str(app.BLOBS_DIR), [".staging", "ab"]) == [".staging"]
+
+
+
+def test_completed_resumable_upload_is_recorded_as_document(app_db, tmp_path, monkeypatch):
+    """الرفع المكتمل الدفعات يُنقل إلى مخزن المحتوى ويحدّث المستند مثل الرفع العادي"""
+    import io
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "storage" / "blobs"))
+    monkeypatch.setattr(app, "upload_journal", app.UploadJournal(tmp_path / "storage" / "uploads", chunk_size=1000))
+    _, request_id = _create_request(app)
+    with app.get_conn() as conn:
+        doc_id = conn.execute("INSERT INTO documents (request_id, doc_type) VALUES (?, 'فيديو لغرف العمليات والإقامة')",
+                              (request_id,)).lastrowid
+        conn.commit()
+        doc = dict(conn.execute("SELECT * FROM documents WHERE id=?", (doc_id,)).fetchone())
+    upload_id = app.resumable_upload_id(doc_id)
+    video = bytes(range(256)) * 10
+    app.upload_journal.create(upload_id, len(video), "clip.MOV")
+    app.upload_journal.write_chunk(upload_id, 0, io.BytesIO(video[:1000]), 1000)
+    assert not app.finalize_resumable_upload(request_id, doc, ["mp4", "mov"])
+
+    for index in (1, 2):
+        chunk = video[index * 1000:(index + 1) * 1000]
+        app.upload_journal.write_chunk(upload_id, index, io.BytesIO(chunk), len(chunk))
+    assert app.finalize_resumable_upload(request_id, doc, ["mp4", "mov"])
+    with app.get_conn() as conn:
+        saved = conn.execute("SELECT * FROM documents WHERE id=?", (doc_id,)).fetchone()
+    assert saved['satisfied'] == 1 and saved['file_name'].endswith(".mov")
+    assert Path(saved['file_path']).read_bytes() == video
+    assert app.upload_journal.status(upload_id) is None
+
+
+# ---------------------------- معالجة الوسائط ---------------------------- #
+def test_video_upload_schedules_media_job_and_delete_purges_outputs(app_db, tmp_path, monkeypatch):
+    """رفع فيديو يجدول مهمة معالجة واحدة لكل محتوى، وحذف آخر مستند يحذف ناتج المعالجة"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "MEDIA_DIR", tmp_path / "media")
+    calls = []
+
+    def fake_process_video(source, output_dir):
+        calls.append(source)
+        output_dir.mkdir(parents=True)
+        (output_dir / "web.mp4").write_bytes(b"mp4")
+        return {"status": "done", "container": "avi", "duration": 75.0, "width": 640, "height": 480,
+                "video_codec": "mpeg4", "rendition_path": str(output_dir / "web.mp4"), "rendition_size": 3}
+
+    monkeypatch.setattr(app, "process_video", fake_process_video)
+    _, first = _create_request(app)
+    _, second = _create_request(app)
+    doc = _upload(app, first, "فيديو", b"RIFF....AVI " * 50, name="clip.avi")
+    job = app.media_jobs.list_jobs("media")[0]
+    assert app.media_jobs.wait(job["id"], timeout=10)["result"] == "done"
+    other = _upload(app, second, "فيديو", b"RIFF....AVI " * 50, name="clip.avi")
+    assert len(calls) == 1
+
+    media = app.fetch_document_media([doc, other])
+    assert media[doc['content_hash']]['duration'] == 75.0
+    assert app.backfill_document_media() == []
+
+    app._callback_delete_document_admin(doc['id'], doc['file_path'])
+    assert (tmp_path / "media" / doc['content_hash']).exists()
+    app._callback_delete_document_admin(other['id'], other['file_path'])
+    assert not (tmp_path / "media" / doc['content_hash']).exists()
+    with app.get_conn() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM document_media").fetchone()[0] == 0
+
+
+def test_unsupported_videos_are_reprocessed_once_ffprobe_is_installed(app_db, tmp_path, monkeypatch):
+    """الفيديو المرفوع قبل تثبيت ffmpeg يُسجل unsupported، وتعيد process-media معالجته بعد التثبيت"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "MEDIA_DIR", tmp_path / "media")
+    monkeypatch.setattr(app, "find_tool", lambda name: None)
+    monkeypatch.setattr(app, "process_video", lambda source, output_dir: {"status": "unsupported"})
+    _, request_id = _create_request(app)
+    doc = _upload(app, request_id, "فيديو", b"RIFF....AVI " * 50, name="clip.avi")
+    assert app.fetch_document_media([doc])[doc['content_hash']]['status'] == "unsupported"
+    assert app.backfill_document_media() == []
+
+    monkeypatch.setattr(app, "find_tool", lambda name: f"/usr/bin/{name}")
+    monkeypatch.setattr(app, "process_video", lambda source, output_dir: {"status": "done", "duration": 12.0})
+    job_ids = app.backfill_document_media()
+    assert len(job_ids) == 1 and app.wait_document_media(job_ids[0], timeout=10)["result"] == "done"
+    assert app.fetch_document_media([doc])[doc['content_hash']]['duration'] == 12.0
+
+
+def test_partial_pdfs_are_reindexed_once_a_pdf_library_is_installed(app_db, tmp_path, monkeypatch):
+    """PDF المفهرس بدون مكتبة PDF يُسجل partial، وتعيد process-media فهرسته بعد تثبيت المكتبة"""
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "MEDIA_DIR", tmp_path / "media")
+    monkeypatch.setattr(app, "available_backend", lambda: None)
+    monkeypatch.setattr(app, "index_pdf", lambda source, output_dir: {"status": "partial", "page_count": 2})
+    _, request_id = _create_request(app)
+    doc = _upload(app, request_id, "بطاقة ضريبية", b"%PDF-1.4 partial" * 10, name="tax.pdf")
+    assert app.fetch_document_media([doc])[doc['content_hash']]['status'] == "partial"
+    assert app.backfill_document_media() == []
+
+    monkeypatch.setattr(app, "available_backend", lambda: "pymupdf")
+    monkeypatch.setattr(app, "index_pdf", lambda source, output_dir: {"status": "done", "page_count": 2,
+                                                                      "text_fingerprint": "ab" * 16})
+    job_ids = app.backfill_document_media()
+    assert len(job_ids) == 1 and app.wait_document_media(job_ids[0], timeout=10)["result"] == "done"
+    assert app.fetch_document_media([doc])[doc['content_hash']]['text_fingerprint'] == "ab" * 16
+
+
+def test_pdf_indexing_does_not_wait_behind_video_transcode(app_db, tmp_path, monkeypatch):
+    """فهرسة PDF في طابور مستقل فلا تنتظر مهمة فيديو طويلة"""
+    import threading
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "MEDIA_DIR", tmp_path / "media")
+    release = threading.Event()
+    video_job = app.media_jobs.submit("media", "معالجة فيديو طويلة", lambda job: release.wait(10))
+    try:
+        job_id = app.schedule_media_processing("cd" * 32, tmp_path / "missing.pdf")
+        assert app.wait_document_media(job_id, timeout=5)["status"] == "done"
+        assert app.media_jobs.get(video_job)["status"] == "running"
+    finally:
+        release.set()
+        app.media_jobs.wait(video_job, timeout=10)
+
+
+def test_pdf_upload_is_indexed_in_background(app_db, tmp_path, monkeypatch):
+    """رفع PDF يسجل عدد الصفحات والحجم في document_media وتعرضه صفحات المراجعة بدون فتح الملف"""
+    from reportlab.pdfgen import canvas
+    app = app_db
+    monkeypatch.setattr(app, "blob_store", app.BlobStore(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "MEDIA_DIR", tmp_path / "media")
+    pdf_path = tmp_path / "license.pdf"
+    pdf = canvas.Canvas(str(pdf_path))
+    for _ in range(4):
+        pdf.drawString(100, 700, "license")
+        pdf.showPage()
+    pdf.save()
+    _, request_id = _create_request(app)
+    doc = _upload(app, request_id, "ترخيص", pdf_path.read_bytes(), name="license.pdf")
+    row = app.fetch_document_media([doc])[doc['content_hash']]
+    # بدون مكتبة PDF يُحسب عدد الصفحات من بنية الملف وتبقى الحالة partial حتى تثبيتها
+    assert row['kind'] == "pdf" and row['status'] == ("done" if app.available_backend() else "partial")
+    assert row['page_count'] == 4 and row['byte_size'] == pdf_path.stat().st_size
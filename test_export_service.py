@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات خدمة تصدير الأرشيفات (ZIP على القرص مع التخزين حسب الإصدار)
+"""
+
+import sys
+import zipfile
+
+sys.path.append('.')
+
+from export_service import build_cached_archive
+
+
+def _entries(root, version="v1"):
+    return [(str(root / "video.mp4"), "فيديو.mp4", version),
+            (str(root / "notes.txt"), "ملاحظات.txt", version),
+            (str(root / "missing.pdf"), "مفقود.pdf", version)]
+
+
+def test_archive_is_built_on_disk_with_stored_media(tmp_path):
+    (tmp_path / "video.mp4").write_bytes(b"\x00" * 50_000)
+    (tmp_path / "notes.txt").write_text("نص " * 5_000, encoding="utf-8")
+    path, files_added = build_cached_archive(_entries(tmp_path), tmp_path / "cache", "request_1")
+    assert files_added == 2
+    with zipfile.ZipFile(path) as zf:
+        infos = {i.filename: i for i in zf.infolist()}
+        assert infos["فيديو.mp4"].compress_type == zipfile.ZIP_STORED
+        assert infos["ملاحظات.txt"].compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read("فيديو.mp4") == b"\x00" * 50_000
+    assert not list((tmp_path / "cache").glob(".building_*"))
+
+
+def test_archive_is_reused_until_documents_change(tmp_path):
+    (tmp_path / "video.mp4").write_bytes(b"1")
+    (tmp_path / "notes.txt").write_text("x")
+    cache = tmp_path / "cache"
+    first, _ = build_cached_archive(_entries(tmp_path), cache, "request_1")
+    mtime = first.stat().st_mtime_ns
+    again, files_added = build_cached_archive(_entries(tmp_path), cache, "request_1")
+    assert again == first and again.stat().st_mtime_ns == mtime and files_added == 2
+
+    updated, _ = build_cached_archive(_entries(tmp_path, version="v2"), cache, "request_1")
+    assert updated != first and not first.exists()
+    other, _ = build_cached_archive(_entries(tmp_path), cache, "request_10")
+    assert updated.exists() and other.exists()
+
+
+def test_no_files_means_no_archive(tmp_path):
+    assert build_cached_archive([(str(tmp_path / "none.pdf"), "a.pdf", "v")], tmp_path, "request_2") == (None, 0)
+
+
+def test_parallel_prefetch_keeps_order_and_reports_progress(tmp_path, monkeypatch):
+    import export_service
+    from job_manager import Job
+    monkeypatch.setattr(export_service, "PREFETCH_MAX_BYTES", 100)
+    entries = []
+    for i in range(12):
+        path = tmp_path / f"f{i}.txt"
+        path.write_bytes(bytes([i]) * (50 if i % 3 else 500))  # بعض الملفات أكبر من حد القراءة المسبقة
+        entries.append((str(path), f"request_{i // 4}/f{i}.txt", None))
+    entries.append((str(tmp_path / "missing.txt"), "request_9/missing.txt", None))
+    job = Job("bulk_export", "test")
+    dest = tmp_path / "out" / "bulk.zip"
+    assert export_service.write_archive(entries, dest, job=job, max_workers=3) == 12
+    assert (job.processed, job.total, job.rows) == (13, 13, 12)
+    with zipfile.ZipFile(dest) as zf:
+        assert zf.namelist() == [e[1] for e in entries[:12]]
+        assert zf.read("request_0/f3.txt") == bytes([3]) * 500
+        assert zf.read("request_2/f10.txt") == bytes([10]) * 50
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات خادم تنزيل الملفات (روابط موقعة، Range، حماية المسارات، الرفع على دفعات)
+"""
+
+import json
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.append('.')
+
+from file_server import FileServer, parse_range
+from upload_journal import UploadJournal
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "storage"
+    root.mkdir()
+    srv = FileServer(host="127.0.0.1", port=0)
+    srv.configure(roots=[root], secret="test-secret")
+    assert srv.start()
+    yield srv, root
+    srv.stop()
+
+
+def _get(srv, url_path, headers=None):
+    req = urllib.request.Request(f"http://127.0.0.1:{srv.port}{url_path}", headers=headers or {})
+    with urllib.request.urlopen(req, timeout=5) as resp:
+        return resp.status, dict(resp.headers), resp.read()
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=100-", 100) is False
+    assert parse_range("bytes=0-1,5-6", 100) is None
+
+
+def test_full_and_range_downloads(server):
+    srv, root = server
+    data = bytes(range(256)) * 4096  # 1 MB (أكبر من حجم الدفعة)
+    (root / "video.mp4").write_bytes(data)
+    url = srv.url_path(root / "video.mp4", filename="فيديو.mp4")
+
+    status, headers, body = _get(srv, url)
+    assert status == 200 and body == data
+    assert headers["Accept-Ranges"] == "bytes"
+    assert headers["Content-Type"] == "video/mp4"
+    assert "UTF-8''" in headers["Content-Disposition"]
+
+    status, headers, body = _get(srv, url, {"Range": "bytes=1000-1999"})
+    assert status == 206 and body == data[1000:2000]
+    assert headers["Content-Range"] == f"bytes 1000-1999/{len(data)}"
+
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _get(srv, url, {"Range": f"bytes={len(data)}-"})
+    assert err.value.code == 416
+
+
+def test_rejects_tampered_expired_and_outside_paths(server, tmp_path):
+    srv, root = server
+    (root / "a.pdf").write_bytes(b"%PDF")
+    outside = tmp_path / "secret.txt"
+    outside.write_text("x")
+
+    token = srv.sign(root / "a.pdf")
+    for bad in (token[:-2] + "xx", srv.sign(root / "a.pdf", ttl=-1), srv.sign(outside), srv.sign(root / ".." / "secret.txt")):
+        with pytest.raises(urllib.error.HTTPError) as err:
+            _get(srv, f"/files/{bad}")
+        assert err.value.code == 403
+
+    other = FileServer()
+    other.configure(roots=[root], secret="another-secret")
+    assert other.verify(token) is None
+
+
+def test_second_instance_reuses_running_server(server):
+    srv, root = server
+    sibling = FileServer(host="127.0.0.1", port=srv.port)
+    sibling.configure(roots=[root], secret="test-secret")
+    assert sibling.start() and sibling.available
+    stranger = FileServer(host="127.0.0.1", port=srv.port)
+    stranger.configure(roots=[root], secret="different")
+    assert not stranger.start()
+
+
+def _call(srv, url_path, method="GET", data=None):
+    req = urllib.request.Request(f"http://127.0.0.1:{srv.port}{url_path}", data=data, method=method)
+    with urllib.request.urlopen(req, timeout=5) as resp:
+        return resp.status, dict(resp.headers), json.loads(resp.read())
+
+
+def test_resumable_upload_round_trip(server, tmp_path):
+    srv, root = server
+    srv.uploads = UploadJournal(root / "uploads", chunk_size=1000)
+    data = bytes(range(256)) * 10  # 2560 بايت = 3 دفعات
+    url = f"/uploads/{srv.sign_upload('doc_7', max_size=10_000)}"
+
+    assert _call(srv, url)[2] is None
+    status, headers, state = _call(srv, f"{url}?size={len(data)}&name=%D9%81%D9%8A%D8%AF%D9%8A%D9%88.mp4&fp=abc", "POST")
+    assert headers["Access-Control-Allow-Origin"] == "*"
+    assert state["chunks"] == 3 and state["received"] == [] and state["name"] == "فيديو.mp4"
+
+    # الاتصال انقطع بعد الدفعة الأولى: الاستكمال يرسل الباقي فقط
+    _call(srv, f"{url}/0", "PUT", data[:1000])
+    assert _call(srv, url)[2]["received"] == [0]
+    _call(srv, f"{url}/2", "PUT", data[2000:])
+    state = _call(srv, f"{url}/1", "PUT", data[1000:2000])[2]
+    assert state["complete"]
+    assert srv.uploads.data_path("doc_7").read_bytes() == data
+
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _call(srv, f"{url}/1", "PUT", data[:10])
+    assert err.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _call(srv, f"{url}?size=20000&name=a.mp4", "POST")
+    assert err.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _call(srv, f"/uploads/{srv.sign_upload('doc_7', ttl=-1)}")
+    assert err.value.code == 403
+    # رمز التنزيل لا يصلح للرفع
+    with pytest.raises(urllib.error.HTTPError) as err:
+        _call(srv, f"/uploads/{srv.sign(root / 'a.pdf')}")
+    assert err.value.code == 403
+
+    req = urllib.request.Request(f"http://127.0.0.1:{srv.port}{url}/0", method="OPTIONS")
+    with urllib.request.urlopen(req, timeout=5) as resp:
+        assert resp.status == 204 and "PUT" in resp.headers["Access-Control-Allow-Methods"]
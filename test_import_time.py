@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبار زمن الاستيراد البارد للتطبيق (python -X importtime)
+
+يفشل إذا تم تحميل مكتبات ثقيلة عند الاستيراد أو إذا تجاوز زمن استيراد التطبيق
+(بدون Streamlit نفسه) الميزانية المحددة. يمكن تعديل الميزانية بالمتغير IMPORT_TIME_BUDGET_MS.
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent
+IMPORT_TIME_BUDGET_MS = int(os.environ.get("IMPORT_TIME_BUDGET_MS", "300"))
+HEAVY_MODULES = ["pandas", "numpy", "plotly.express", "openpyxl", "reportlab"]
+
+
+def _import_times(tmp_path):
+    """تشغيل استيراد بارد في عملية منفصلة وإرجاع {module: cumulative_us}"""
+    env = dict(os.environ, PYTHONPATH=str(APP_DIR))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import waiting_list_contracts_app"],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative.strip())
+    return times
+
+
+def test_cold_import_skips_heavy_modules_and_stays_within_budget(tmp_path):
+    times = _import_times(tmp_path)
+    loaded = [m for m in HEAVY_MODULES if m in times]
+    assert not loaded, f"مكتبات ثقيلة تُحمّل عند الاستيراد: {loaded}"
+    app_ms = (times["waiting_list_contracts_app"] - times.get("streamlit", 0)) / 1000
+    assert app_ms < IMPORT_TIME_BUDGET_MS, f"زمن الاستيراد {app_ms:.0f}ms يتجاوز الميزانية {IMPORT_TIME_BUDGET_MS}ms"
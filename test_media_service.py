@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات خدمة معالجة الوسائط (بدون الحاجة لتثبيت ffmpeg)
+"""
+
+import json
+import subprocess
+import sys
+
+sys.path.append('.')
+
+import media_service
+
+
+def test_probe_parses_ffprobe_output(monkeypatch, tmp_path):
+    output = {
+        "format": {"format_name": "avi", "duration": "93.5", "bit_rate": "4000000"},
+        "streams": [{"codec_type": "video", "codec_name": "mpeg4", "width": 1920, "height": 1080},
+                    {"codec_type": "audio", "codec_name": "mp3"}],
+    }
+    monkeypatch.setattr(media_service, "find_tool", lambda name: f"/usr/bin/{name}")
+    monkeypatch.setattr(media_service, "_run", lambda args, timeout: subprocess.CompletedProcess(args, 0, json.dumps(output).encode()))
+    info = media_service.probe(tmp_path / "clip.avi")
+    assert info == {"container": "avi", "duration": 93.5, "width": 1920, "height": 1080,
+                    "video_codec": "mpeg4", "audio_codec": "mp3", "bit_rate": 4_000_000}
+    assert media_service.needs_rendition(info, 10_000)
+
+
+def test_small_h264_mp4_is_served_as_is():
+    info = {"container": "mov,mp4,m4a,3gp,3g2,mj2", "height": 720, "video_codec": "h264", "audio_codec": "aac"}
+    assert not media_service.needs_rendition(info, 20 * 1024 * 1024)
+    assert media_service.needs_rendition(info, media_service.RENDITION_MAX_BYTES + 1)
+    assert media_service.needs_rendition(dict(info, height=1080), 1)
+
+
+def test_rendition_bitrate_fits_size_cap():
+    assert media_service.rendition_video_kbps(None) == media_service.RENDITION_VIDEO_KBPS
+    assert media_service.rendition_video_kbps(60) == media_service.RENDITION_VIDEO_KBPS
+    long_video = 15 * 60
+    kbps = media_service.rendition_video_kbps(long_video)
+    expected_bytes = (kbps + media_service.RENDITION_AUDIO_KBPS) * 1000 / 8 * long_video
+    assert kbps < media_service.RENDITION_VIDEO_KBPS and expected_bytes < media_service.RENDITION_MAX_BYTES
+    assert media_service.rendition_video_kbps(10 * 3600) == media_service.RENDITION_MIN_VIDEO_KBPS
+
+
+def test_without_tools_video_is_marked_unsupported(monkeypatch, tmp_path):
+    monkeypatch.setattr(media_service, "find_tool", lambda name: None)
+    source = tmp_path / "clip.wmv"
+    source.write_bytes(b"\x00" * 10)
+    assert media_service.process_video(source, tmp_path / "out")["status"] == "unsupported"
+    assert not (tmp_path / "out").exists()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات فهرسة ملفات PDF (عدد الصفحات، بصمة النص، الصورة المصغرة)
+"""
+
+import sys
+import types
+
+sys.path.append('.')
+
+import pdf_index
+
+
+def _write_pdf(path, pages):
+    from reportlab.pdfgen import canvas
+    pdf = canvas.Canvas(str(path))
+    for i in range(pages):
+        pdf.drawString(100, 700, f"page {i}")
+        pdf.showPage()
+    pdf.save()
+
+
+def test_text_fingerprint_ignores_layout_whitespace_and_case():
+    assert pdf_index.text_fingerprint(["Tax  Card\nNo. 5"]) == pdf_index.text_fingerprint([" tax card no. 5 "])
+    assert pdf_index.text_fingerprint(["a", "b"]) != pdf_index.text_fingerprint(["a b"])
+    assert pdf_index.text_fingerprint(["", "  \n"]) is None
+
+
+def test_page_count_without_pdf_library(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf_index, "available_backend", lambda: None)
+    _write_pdf(tmp_path / "doc.pdf", 3)
+    result = pdf_index.index_pdf(tmp_path / "doc.pdf", tmp_path / "out")
+    assert result["page_count"] == 3 and result["poster_path"] is None and result["text_fingerprint"] is None
+    assert result["status"] == "partial"
+    (tmp_path / "empty.pdf").write_bytes(b"")
+    assert pdf_index.count_pages_raw(tmp_path / "empty.pdf") is None
+
+
+def test_pymupdf_backend_renders_first_page_thumbnail(tmp_path, monkeypatch):
+    class _Page:
+        rect = types.SimpleNamespace(width=600)
+
+        def __init__(self, text):
+            self.text = text
+
+        def get_text(self):
+            return self.text
+
+        def get_pixmap(self, matrix, alpha):
+            assert matrix.zoom == pdf_index.THUMBNAIL_WIDTH / 600
+            return types.SimpleNamespace(save=lambda name: open(name, "wb").write(b"\x89PNG"))
+
+    class _Doc:
+        pages = [_Page("first page"), _Page("second")]
+        page_count = 2
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def __getitem__(self, i):
+            return self.pages[i]
+
+    fake_fitz = types.SimpleNamespace(open=lambda path: _Doc(), Matrix=lambda x, y: types.SimpleNamespace(zoom=x))
+    monkeypatch.setitem(sys.modules, "fitz", fake_fitz)
+    (tmp_path / "doc.pdf").write_bytes(b"%PDF-1.4")
+    result = pdf_index.index_pdf(tmp_path / "doc.pdf", tmp_path / "out")
+    assert result["page_count"] == 2
+    assert result["text_fingerprint"] == pdf_index.text_fingerprint(["first page", "second"])
+    assert (tmp_path / "out" / "thumb.png").read_bytes() == b"\x89PNG"
+    assert not list((tmp_path / "out").glob(".building_*"))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+اختبارات سجل الرفع القابل للاستكمال
+"""
+
+import io
+import os
+import sys
+import time
+
+sys.path.append('.')
+
+import pytest
+
+from upload_journal import UploadError, UploadJournal
+
+
+def test_torn_journal_line_means_chunk_is_resent(tmp_path):
+    journal = UploadJournal(tmp_path, chunk_size=4)
+    journal.create("doc_1", 10, "a.mp4", "fp")
+    journal.write_chunk("doc_1", 1, io.BytesIO(b"5678"), 4)
+    # انقطاع أثناء تسجيل الدفعة 2: السطر بدون نهاية لا يُحتسب
+    with open(tmp_path / "doc_1" / "chunks.log", "a", encoding="ascii") as log:
+        log.write("2")
+    state = journal.status("doc_1")
+    assert state["received"] == [1] and state["chunks"] == 3 and not state["complete"]
+
+
+def test_invalid_ids_sizes_and_short_chunks_are_rejected(tmp_path):
+    journal = UploadJournal(tmp_path, chunk_size=4, max_size=100)
+    with pytest.raises(UploadError):
+        journal.create("../escape", 10, "a.mp4")
+    with pytest.raises(UploadError):
+        journal.create("doc_1", 101, "a.mp4")
+    journal.create("doc_1", 10, "a.mp4")
+    with pytest.raises(UploadError):
+        journal.write_chunk("doc_1", 2, io.BytesIO(b"9"), 1)  # الدفعة الأخيرة = بايتان
+    with pytest.raises(UploadError):
+        journal.write_chunk("doc_1", 0, io.BytesIO(b"12"), 4)  # الاتصال انقطع داخل الدفعة
+    assert journal.status("doc_1")["received"] == []
+
+
+def test_chunk_written_during_restart_is_not_logged(tmp_path):
+    journal = UploadJournal(tmp_path, chunk_size=4)
+    journal.create("doc_1", 8, "a.mp4", "old")
+
+    class RestartingStream(io.BytesIO):
+        def read(self, size=-1):
+            # رفع جديد لنفس المعرف يبدأ أثناء كتابة الدفعة
+            journal.create("doc_1", 8, "b.mp4", "new")
+            return super().read(size)
+
+    with pytest.raises(UploadError):
+        journal.write_chunk("doc_1", 0, RestartingStream(b"1234"), 4)
+    state = journal.status("doc_1")
+    assert state["fingerprint"] == "new" and state["received"] == []
+
+
+def test_prune_removes_abandoned_uploads_only(tmp_path):
+    journal = UploadJournal(tmp_path, chunk_size=4)
+    journal.create("old", 4, "a.mp4")
+    journal.create("fresh", 4, "b.mp4")
+    stale = time.time() - 3 * 24 * 3600
+    for path in (tmp_path / "old" / "chunks.log", tmp_path / "old"):
+        os.utime(path, (stale, stale))
+    assert journal.prune(2 * 24 * 3600) == 1
+    assert journal.status("old") is None and journal.status("fresh") is not None
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+سجل الرفع القابل للاستكمال
+============================
+رفع الملفات الكبيرة (فيديو غرف العمليات حتى 200MB) على دفعات بدلاً من st.file_uploader،
+فانقطاع الاتصال يكلف دفعة واحدة فقط وليس الملف كاملاً.
+
+لكل عملية رفع مجلد:
+
+    storage/uploads/<upload_id>/
+        meta.json    الحجم وحجم الدفعة واسم الملف وبصمة الملف في المتصفح (الاسم/الحجم/آخر تعديل)
+                     ومعرف الجيل (generation) الذي يتغير مع كل create
+        data.part    ملف بالحجم النهائي تُكتب كل دفعة في موضعها مباشرة (لا توجد خطوة تجميع)
+        chunks.log   سطر لكل دفعة مكتملة، يُضاف فقط بعد كتابة الدفعة و fsync
+
+الاستكمال: المتصفح يسأل عن الدفعات المستلمة ويرسل الباقي فقط.
+"""
+
+import json
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+_UPLOAD_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UploadError(ValueError):
+    """دفعة أو طلب رفع غير صالح (يُعاد للمتصفح كـ 400)"""
+
+
+class UploadJournal:
+    def __init__(self, root, chunk_size=CHUNK_SIZE, max_size=MAX_UPLOAD_SIZE):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _dir(self, upload_id):
+        if not _UPLOAD_ID_RE.match(upload_id or ""):
+            raise UploadError("invalid upload id")
+        return self.root / upload_id
+
+    def data_path(self, upload_id):
+        return self._dir(upload_id) / "data.part"
+
+    # ------------------------------------------------------------------ #
+    def create(self, upload_id, size, name, fingerprint="", max_size=None):
+        """بدء رفع جديد (أو استبدال رفع سابق لملف مختلف). العودة: الحالة"""
+        size = int(size)
+        limit = max_size or self.max_size
+        if size <= 0 or size > limit:
+            raise UploadError(f"size must be between 1 and {limit} bytes")
+        directory = self._dir(upload_id)
+        with self._lock:
+            shutil.rmtree(directory, ignore_errors=True)
+            directory.mkdir(parents=True)
+            with open(directory / "data.part", "wb") as f:
+                f.truncate(size)
+            meta = {
+                "size": size,
+                "chunk_size": self.chunk_size,
+                "name": Path(str(name)).name,
+                "fingerprint": str(fingerprint),
+                "created_at": datetime.now().isoformat(),
+                "generation": secrets.token_hex(8),
+            }
+            tmp = directory / "meta.json.tmp"
+            tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, directory / "meta.json")
+            (directory / "chunks.log").touch()
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        """حالة الرفع أو None: {size, chunk_size, chunks, name, fingerprint, received, complete}"""
+        directory = self._dir(upload_id)
+        try:
+            meta = json.loads((directory / "meta.json").read_text(encoding="utf-8"))
+            log = (directory / "chunks.log").read_text(encoding="ascii")
+        except (OSError, ValueError):
+            return None
+        chunks = -(-meta["size"] // meta["chunk_size"])
+        # السطر الأخير قد يكون ناقصاً إذا انقطعت الكتابة: يُتجاهل وتُعاد الدفعة
+        received = sorted({int(line) for line in log.split("\n")[:-1] if line.isdigit() and int(line) < chunks})
+        meta.update(chunks=chunks, received=received, complete=len(received) == chunks)
+        return meta
+
+    def write_chunk(self, upload_id, index, stream, length):
+        """كتابة دفعة في موضعها من data.part ثم تسجيلها. العودة: الحالة بعد الكتابة"""
+        state = self.status(upload_id)
+        if state is None:
+            raise UploadError("unknown upload")
+        index, length = int(index), int(length)
+        if not 0 <= index < state["chunks"]:
+            raise UploadError("chunk index out of range")
+        offset = index * state["chunk_size"]
+        expected = min(state["chunk_size"], state["size"] - offset)
+        if length != expected:
+            raise UploadError(f"chunk {index} must be {expected} bytes")
+        directory = self._dir(upload_id)
+        with open(directory / "data.part", "r+b") as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = stream.read(min(remaining, 256 * 1024))
+                if not data:
+                    raise UploadError("connection closed before the chunk was complete")
+                f.write(data)
+                remaining -= len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            # create متزامن قد يحذف المجلد ويعيد إنشاءه أثناء كتابة الدفعة: الدفعة تخص الجيل القديم فلا تُسجل
+            current = self.status(upload_id)
+            if current is None or current.get("generation") != state.get("generation"):
+                raise UploadError("upload was restarted while the chunk was written")
+            with open(directory / "chunks.log", "a", encoding="ascii") as log:
+                log.write(f"{index}\n")
+        state["received"] = sorted(set(state["received"]) | {index})
+        state["complete"] = len(state["received"]) == state["chunks"]
+        return state
+
+    def remove(self, upload_id):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def prune(self, max_age_seconds):
+        """حذف عمليات الرفع المتروكة الأقدم من max_age_seconds"""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        if not self.root.exists():
+            return 0
+        for directory in self.root.iterdir():
+            try:
+                log = directory / "chunks.log"
+                last_activity = (log if log.exists() else directory).stat().st_mtime
+                if directory.is_dir() and last_activity < cutoff:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
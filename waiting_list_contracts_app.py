@@ -42,20 +42,23 @@
 """
 import os
 import re
-import io
-import zipfile
 import hashlib
 import base64
 import secrets
 from datetime import datetime, date, timedelta
 from pathlib import Path
-from backup_manager import backup_manager
-import pandas as pd
-from contextlib import contextmanager
+from backup_manager import BACKUP_EXCLUDED_STORAGE_DIRS, backup_manager
+from connection_pool import connection_pool
+from tagged_cache import query_cache
+from job_manager import job_manager
+from file_server import file_server
+from export_service import build_cached_archive, prune_old_files, write_archive
+from blob_store import BlobStore
+from upload_journal import UploadJournal
+from media_service import find_tool, is_video, media_jobs, needs_rendition, process_video
+from pdf_index import available_backend, index_pdf, pdf_jobs
 import sqlite3
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 import time
 import shutil
 import json
@@ -65,10 +68,21 @@ from functools import lru_cache
 APP_TITLE = "المشروع القومي لقوائم الانتظار - التعاقد على الخدمات الجراحية"
 DB_PATH = Path("data/app.db")
 STORAGE_DIR = Path("storage")
+BLOBS_DIR = STORAGE_DIR / "blobs"  # ملفات المستندات مخزنة مرة واحدة بحسب بصمة المحتوى
+UPLOADS_DIR = STORAGE_DIR / "uploads"  # سجل الرفع القابل للاستكمال (دفعات الملفات الكبيرة)
+RESUMABLE_UPLOAD_MAX_AGE = 2 * 24 * 3600  # حذف عمليات الرفع المتروكة بعد يومين
+MEDIA_DIR = STORAGE_DIR / "media"  # ناتج معالجة الفيديو (غلاف ونسخة ويب) لكل بصمة محتوى
 EXPORTS_DIR = Path("exports")
 RESOURCES_DIR = Path("static")
 BACKUP_DIR = Path("backups")
 NOTIFICATIONS_FILE = Path("data/notifications.json")
+FILE_SERVER_PORT = int(os.environ.get("FILE_SERVER_PORT", "8502"))
+FILE_SERVER_PUBLIC_URL = os.environ.get("FILE_SERVER_PUBLIC_URL", "").rstrip("/")
+FILE_SERVER_KEY_FILE = Path("data/file_server.key")
+ZIP_CACHE_DIR = EXPORTS_DIR / "zip_cache"
+ZIP_CACHE_MAX_AGE = 24 * 3600  # أرشيفات الطلبات الأقدم من يوم تُحذف (وتُبنى من جديد عند طلبها)
+BULK_EXPORTS_DIR = EXPORTS_DIR / "bulk"
+BULK_EXPORT_MAX_AGE = 7 * 24 * 3600  # حذف أرشيفات التصدير الجماعي الأقدم من أسبوع
 
 # نظام هاش متوافق: إنشاء جديد باستخدام salt:sha256(salt:password)، والتحقق يدعم القديم والجديد
 def secure_hash(password: str, salt: str = None) -> str:
@@ -129,6 +143,10 @@ def verify_password(password: str, stored_hash: str) -> bool:
 for p in [DB_PATH.parent, STORAGE_DIR, EXPORTS_DIR, RESOURCES_DIR, BACKUP_DIR]:
     p.mkdir(parents=True, exist_ok=True)
 
+# مخزن الملفات بحسب المحتوى (الملفات المكررة بين الطلبات تُحفظ مرة واحدة)
+blob_store = BlobStore(BLOBS_DIR)
+upload_journal = UploadJournal(UPLOADS_DIR)
+
 # ---------------------------- أنماط CSS مخصصة - محسّنة للقراءة (UI/UX Enhanced) ---------------------- #
 # لوحة الألوان الموحدة والجذابة للتطبيق
 COLOR_PALETTE = {
@@ -794,42 +812,45 @@ STATUS_SETTINGS_DEFAULTS = {
 }
 
 # دالة لتحديث المستندات الاختيارية في الطلبات الموجودة
-def update_existing_requests_optional_docs():
-    """تحديث المستندات الاختيارية في الطلبات الموجودة عند تغيير الإعدادات"""
-    try:
-        with get_conn() as conn:
-            hospital_types = get_hospital_types()
-            total_updated = 0
-            
-            for htype in hospital_types:
-                optional_docs = get_optional_docs_for_type(htype)
-                all_doc_names = [dt['name'] for dt in get_document_types()]
-                
-                # الحصول على جميع الطلبات لهذا النوع من المستشفيات
-                requests = conn.execute(
-                    "SELECT r.id FROM requests r JOIN hospitals h ON r.hospital_id = h.id WHERE h.type = ? AND r.deleted_at IS NULL", 
-                    (htype,)
-                ).fetchall()
-                
-                for req in requests:
-                    # تحديث حالة المطلوب/اختياري للمستندات
-                    for doc_name in all_doc_names:
-                        is_required = 0 if doc_name in optional_docs else 1
-                        result = conn.execute(
-                            "UPDATE documents SET required = ? WHERE request_id = ? AND doc_type = ?", 
-                            (is_required, req['id'], doc_name)
-                        )
-                        total_updated += result.rowcount
-            
-            conn.commit()
-            print(f"تم تحديث {total_updated} مستند في الطلبات الموجودة")
-            
-    except Exception as e:
-        print(f"خطأ في تحديث المستندات الاختيارية: {e}")
-
-
+def update_existing_requests_optional_docs(job=None, hospital_type: str = None):
+    """تحديث المستندات الاختيارية في الطلبات الموجودة عند تغيير الإعدادات.
 
+    عبارة UPDATE واحدة لكل نوع مستشفى تعيد حساب required من hospital_type_optional_docs
+    ولا تلمس إلا الصفوف التي تغيرت قيمتها. تعمل كمهمة خلفية (job) تبلغ عن التقدم وعدد الصفوف.
 
+    العودة: عدد المستندات المعدلة
+    """
+    hospital_types = [hospital_type] if hospital_type else get_hospital_types()
+    total_updated = 0
+    if job:
+        job.update(processed=0, total=len(hospital_types))
+    
+    for i, htype in enumerate(hospital_types, start=1):
+        with get_conn() as conn:
+            result = conn.execute("""
+                UPDATE documents
+                SET required = CASE WHEN EXISTS (
+                        SELECT 1 FROM hospital_type_optional_docs o
+                        WHERE o.hospital_type = :htype AND o.doc_name = documents.doc_type
+                    ) THEN 0 ELSE 1 END
+                WHERE request_id IN (
+                        SELECT r.id FROM requests r JOIN hospitals h ON r.hospital_id = h.id
+                        WHERE h.type = :htype AND r.deleted_at IS NULL
+                    )
+                  AND required IS NOT (CASE WHEN EXISTS (
+                        SELECT 1 FROM hospital_type_optional_docs o
+                        WHERE o.hospital_type = :htype AND o.doc_name = documents.doc_type
+                    ) THEN 0 ELSE 1 END)
+            """, {"htype": htype})
+            total_updated += max(result.rowcount, 0)
+            conn.commit()
+        if job:
+            job.update(processed=i, rows=total_updated, message=htype)
+    
+    if job:
+        job.update(message=f"تم تحديث {total_updated} صف")
+    print(f"تم تحديث {total_updated} مستند في الطلبات الموجودة")
+    return total_updated
 
 
 # ---------------------------- أدوات مساعدة ---------------------------- #
@@ -874,61 +895,17 @@ def _db_pragmas_tuple():
         ("temp_store", "memory"),
     )
 
-@contextmanager
 def get_conn():
-    """Context manager for database connections with proper cleanup."""
-    conn = None
-    try:
-        conn = sqlite3.connect(
-            DB_PATH, 
-            check_same_thread=False, 
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-            timeout=30.0
-        )
-        conn.row_factory = sqlite3.Row
-        # تفعيل WAL mode لتحسين الأداء وتقليل القفل
-        # Apply pragmatic settings once per connection
-        for k, v in _db_pragmas_tuple():
-            try:
-                conn.execute(f"PRAGMA {k}={v}")
-            except Exception:
-                pass
-        yield conn
-    except sqlite3.OperationalError as e:
-        if "database is locked" in str(e):
-            import time
-            time.sleep(0.1)
-            try:
-                if conn:
-                    conn.close()
-                conn = sqlite3.connect(
-                    DB_PATH, 
-                    check_same_thread=False, 
-                    detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-                    timeout=30.0
-                )
-                conn.row_factory = sqlite3.Row
-                for k, v in _db_pragmas_tuple():
-                    try:
-                        conn.execute(f"PRAGMA {k}={v}")
-                    except Exception:
-                        pass
-                yield conn
-            except sqlite3.Error as db_error:
-                print(f"Database connection error: {db_error}")
-                raise db_error
-        else:
-            print(f"Database operational error: {e}")
-            raise e
-    except sqlite3.Error as e:
-        print(f"SQLite error: {e}")
-        raise e
-    finally:
-        if conn:
-            try:
-                conn.close()
-            except Exception as e:
-                print(f"Error closing database connection: {e}")
+    """Context manager for pooled database connections.
+
+    الاتصالات تُسحب من تجمع على مستوى العملية (connection_pool) وتُعاد إليه بعد الاستخدام،
+    والاستدعاءات المتداخلة داخل نفس الخيط تعيد نفس الاتصال.
+    """
+    return connection_pool.connection(DB_PATH, _db_pragmas_tuple())
+
+def close_db_pool():
+    """إغلاق الاتصالات الخاملة في التجمع (مثلاً قبل استرجاع نسخة احتياطية)"""
+    connection_pool.close_all()
 
 # تم توحيد دوال التجزئة في hash_pw أعلاه ولا حاجة لتعريفات إضافية هنا
 
@@ -963,6 +940,7 @@ def cleanup_memory():
             st.cache_data.clear()
         if hasattr(st, 'cache_resource'):
             st.cache_resource.clear()
+        query_cache.clear()
         
         keys_to_remove = [k for k in st.session_state.keys() 
                          if k.startswith(('upload_processed_', 'dl_', 'delete_', 'save_', 'sat_', 'req_admin_', 'cm_'))]
@@ -978,14 +956,141 @@ def cleanup_memory():
         print(f"Error in cleanup_memory: {e}")
         return False
 
+# ---------------------------- الملفات الثابتة (البنر والشعار) ---------------------------- #
+def _static_serving_enabled() -> bool:
+    try:
+        return bool(st.get_option("server.enableStaticServing"))
+    except Exception:
+        return False
+
+@query_cache.cached(tags=["static_assets"])
+def _encoded_static_asset(path_str: str, mtime_ns: int) -> str:
+    """data URI مرمز مرة واحدة لكل عملية (المفتاح يتضمن mtime فيتجدد تلقائياً عند تغيير الملف)"""
+    import mimetypes
+    mime = mimetypes.guess_type(path_str)[0] or "application/octet-stream"
+    with open(path_str, "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode()}"
+
+def static_asset_src(path) -> str | None:
+    """قيمة src لصورة ثابتة.
+
+    عند تفعيل server.enableStaticServing يُستخدم رابط app/static مع رقم إصدار من mtime
+    (المتصفح يخزن الصورة ولا تُعاد إرسال بياناتها مع كل تفاعل)، وإلا data URI مخزن على مستوى العملية.
+    """
+    path = Path(path)
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except OSError:
+        return None
+    if _static_serving_enabled() and path.parent.resolve() == RESOURCES_DIR.resolve():
+        from urllib.parse import quote
+        return f"app/static/{quote(path.name)}?v={mtime_ns}"
+    return _encoded_static_asset(str(path), mtime_ns)
+
+def render_banner():
+    """عرض البنر أعلى الصفحة إن وجد"""
+    banner_path = next((p for p in [RESOURCES_DIR / "banner.png", RESOURCES_DIR / "banner.jpg"] if p.exists()), None)
+    src = static_asset_src(banner_path) if banner_path else None
+    if src:
+        st.markdown(f"<div style='text-align: center;'><img src='{src}' class='banner-image'></div>", unsafe_allow_html=True)
+
+def render_logo(target=None, width: int = 80):
+    """عرض شعار التطبيق (في الشريط الجانبي افتراضياً)"""
+    src = static_asset_src(RESOURCES_DIR / "logo.png")
+    if src:
+        (target or st.sidebar).markdown(f"<img src='{src}' width='{width}'>", unsafe_allow_html=True)
+
+# ---------------------------- روابط تنزيل الملفات ---------------------------- #
+def _file_server_secret() -> str:
+    """مفتاح توقيع روابط التنزيل (مشترك بين كل عمليات التطبيق عبر ملف في مجلد data)"""
+    secret = os.environ.get("FILE_SERVER_SECRET")
+    if secret:
+        return secret
+    try:
+        return FILE_SERVER_KEY_FILE.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        FILE_SERVER_KEY_FILE.parent.mkdir(parents=True, exist_ok=True)
+        secret = secrets.token_hex(32)
+        FILE_SERVER_KEY_FILE.write_text(secret, encoding="utf-8")
+        try:
+            os.chmod(FILE_SERVER_KEY_FILE, 0o600)
+        except OSError:
+            pass
+        return secret
+
+def start_file_server() -> bool:
+    """تشغيل خادم تنزيل الملفات (مرة واحدة لكل عملية)"""
+    try:
+        file_server.configure(roots=[STORAGE_DIR, EXPORTS_DIR], secret=_file_server_secret(), port=FILE_SERVER_PORT,
+                              uploads=upload_journal)
+        upload_journal.prune(RESUMABLE_UPLOAD_MAX_AGE)
+        return file_server.start()
+    except Exception as e:
+        print(f"⚠️ تعذر تشغيل خادم تنزيل الملفات: {e}")
+        return False
+
+def _file_server_base_url() -> str | None:
+    """العنوان الذي يصل به المتصفح لخادم الملفات (نفس اسم المضيف الذي فُتح به التطبيق).
+
+    بدون FILE_SERVER_PUBLIC_URL يُستنتج من ترويسات الطلب (st.context). العودة None إذا تعذر ذلك
+    (إصدارات Streamlit بدون st.context)، أو إذا فُتح التطبيق عبر HTTPS (رابط http سيحظره المتصفح)،
+    فتستخدم الصفحات التنزيل من داخل التطبيق بدلاً من رابط يشير لجهاز المستخدم نفسه.
+    """
+    if FILE_SERVER_PUBLIC_URL:
+        return FILE_SERVER_PUBLIC_URL
+    try:
+        headers = st.context.headers
+        host = headers.get("Host")
+        forwarded_proto = (headers.get("X-Forwarded-Proto") or "").lower()
+    except Exception:
+        return None
+    if not host or forwarded_proto == "https":
+        return None
+    return f"http://{host.rsplit(':', 1)[0]}:{file_server.port}"
+
+def file_download_url(path, filename: str = None, mime: str = None) -> str | None:
+    """رابط تنزيل موقع لملف، أو None إذا لم يكن خادم الملفات متاحاً أو لم يُعرف عنوانه"""
+    if not file_server.available:
+        return None
+    base_url = _file_server_base_url()
+    if not base_url:
+        return None
+    try:
+        return base_url + file_server.url_path(path, filename, mime)
+    except Exception:
+        return None
+
+def date_range_conditions(column: str, date_from=None, date_to=None):
+    """تحويل فلتر تاريخ (من/إلى، شاملين) إلى شروط نطاق نصف مفتوح على العمود مباشرة.
+
+    column >= 'YYYY-MM-DD' AND column < 'اليوم التالي لـ date_to'
+    بدلاً من DATE(column) حتى يستطيع SQLite استخدام الفهرس على العمود.
+    تقبل date أو datetime أو نص ISO. العودة: (conditions, params)
+    """
+    def _as_date(value):
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return date.fromisoformat(str(value)[:10])
+
+    conditions, params = [], []
+    if date_from:
+        conditions.append(f"{column} >= ?")
+        params.append(_as_date(date_from).isoformat())
+    if date_to:
+        conditions.append(f"{column} < ?")
+        params.append((_as_date(date_to) + timedelta(days=1)).isoformat())
+    return conditions, params
+
 # ---------------------------- طبقة تنفيذ الاستعلامات مع تخزين مؤقت ذكي ---------------------------- #
 # ملاحظة: لا نغير نص الاستعلامات الموجودة. نضيف طبقة تنفيذ اختيارية قابلة لإعادة الاستخدام.
 
-@st.cache_data(show_spinner=False, ttl=300, max_entries=256)
+@query_cache.cached(ttl=300, tags=lambda query, params=(), one=False, tag=None: [tag])
 def cached_query(query: str, params: tuple = (), one: bool = False, tag: str = None):
     """تنفيذ استعلام SELECT بتخزين مؤقت مبني على (query, params, one, tag).
     - لا تستخدم إلا للاستعلامات القرائية فقط.
-    - tag يسمح بتجميع منطقي لإبطال ذاكرة محددة لاحقاً.
+    - tag يسمح بتجميع منطقي لإبطال ذاكرة محددة لاحقاً عبر invalidate_cache_tags.
     """
     with get_conn() as conn:
         cur = conn.execute(query, params or ())
@@ -998,19 +1103,49 @@ def cached_query(query: str, params: tuple = (), one: bool = False, tag: str = N
 
 def invalidate_cache_tags(tags: list[str] | None = None):
     """تفريغ تخزين بيانات الاستعلامات عند تغيّر المدخلات.
-    إذا لم تُحدد وسوم، يتم تفريغ كلي.
+    يتم إبطال المدخلات المرتبطة بالوسوم المحددة فقط (ومعها الدوال المخزنة المعتمدة عليها)،
+    وإذا لم تُحدد وسوم يتم تفريغ كلي.
     """
     try:
         if not tags:
-            cached_query.clear()
+            query_cache.clear()
             return True
-        # Streamlit cache لا يدعم إبطال جزئي مخصص، لذلك نفرّغ كلياً عند الحاجة.
-        cached_query.clear()
+        query_cache.invalidate_tags(tags)
         return True
     except Exception:
         return False
 
+
+# ---------------------------- تماسك الذاكرة المؤقتة بين العمليات ---------------------------- #
+# عند تشغيل عدة عمليات Streamlit خلف موزع أحمال، كل عملية تملك ذاكرتها المؤقتة الخاصة.
+# كل دالة تعديل تزيد إصدار النطاق (scope) المعني في جدول cache_versions داخل نفس المعاملة،
+# وكل عملية تقارن الإصدارات مرة واحدة في كل إعادة تشغيل وتبطل الوسوم التي تغيرت.
+# أسماء النطاقات هي نفسها وسوم الذاكرة المؤقتة (مثل meta:sectors و request_statuses).
+
+def bump_cache_versions(conn, scopes: list[str]):
+    """زيادة إصدار نطاقات الذاكرة المؤقتة (يُستدعى قبل conn.commit() لعملية الكتابة)"""
+    now_iso = datetime.now().isoformat()
+    conn.executemany(
+        """INSERT INTO cache_versions (scope, version, updated_at) VALUES (?, 1, ?)
+           ON CONFLICT(scope) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at""",
+        [(scope, now_iso) for scope in scopes]
+    )
+
+def sync_cache_versions():
+    """إبطال الذاكرة المؤقتة المحلية للنطاقات التي عدلتها عمليات أخرى (استعلام واحد صغير لكل rerun)"""
+    try:
+        with get_conn() as conn:
+            rows = conn.execute("SELECT scope, version FROM cache_versions").fetchall()
+    except sqlite3.OperationalError:
+        return []
+    return query_cache.sync_versions({row['scope']: row['version'] for row in rows})
+
 # ---------------------------- نظام النسخ الاحتياطي ---------------------------- #
+def _backup_ignore(directory, names):
+    """ignore لـ copytree: المجلدات المستثناة من النسخ الاحتياطي (BACKUP_EXCLUDED_STORAGE_DIRS)"""
+    excluded = {STORAGE_DIR / d for d in BACKUP_EXCLUDED_STORAGE_DIRS}
+    return [name for name in names if Path(directory) / name in excluded]
+
 def create_backup():
     """إنشاء نسخة احتياطية شاملة"""
     try:
@@ -1023,9 +1158,9 @@ def create_backup():
         if DB_PATH.exists():
             shutil.copy2(DB_PATH, backup_path / "app.db")
         
-        # نسخ مجلد الملفات
+        # نسخ مجلد الملفات (بدون الرفع الجزئي ونواتج المعالجة القابلة لإعادة الإنشاء)
         if STORAGE_DIR.exists():
-            shutil.copytree(STORAGE_DIR, backup_path / "storage", dirs_exist_ok=True)
+            shutil.copytree(STORAGE_DIR, backup_path / "storage", dirs_exist_ok=True, ignore=_backup_ignore)
         
         # ضغط النسخة
         shutil.make_archive(str(backup_path), 'zip', backup_path)
@@ -1051,15 +1186,23 @@ def restore_backup(backup_file: str):
         extract_path = BACKUP_DIR / "temp_restore"
         shutil.unpack_archive(backup_path, extract_path)
         
-        # استرجاع قاعدة البيانات
+        # استرجاع قاعدة البيانات (مع إغلاق الاتصالات الخاملة في التجمع أولاً)
         if (extract_path / "app.db").exists():
+            close_db_pool()
             shutil.copy2(extract_path / "app.db", DB_PATH)
         
-        # استرجاع الملفات
+        # استرجاع الملفات (المجلدات المستثناة من النسخ تبقى كما هي: نواتج المعالجة مرتبطة ببصمة المحتوى)
         if (extract_path / "storage").exists():
             if STORAGE_DIR.exists():
-                shutil.rmtree(STORAGE_DIR)
-            shutil.copytree(extract_path / "storage", STORAGE_DIR)
+                excluded = {STORAGE_DIR / d for d in BACKUP_EXCLUDED_STORAGE_DIRS}
+                for child in STORAGE_DIR.iterdir():
+                    if child in excluded:
+                        continue
+                    if child.is_dir():
+                        shutil.rmtree(child)
+                    else:
+                        child.unlink()
+            shutil.copytree(extract_path / "storage", STORAGE_DIR, dirs_exist_ok=True)
         
         shutil.rmtree(extract_path)
         return True, "تم الاسترجاع بنجاح"
@@ -1151,12 +1294,10 @@ def get_audit_logs(filters: dict = None, limit: int = 100):
                 if filters.get('table'):
                     query += " AND table_name = ?"
                     params.append(filters['table'])
-                if filters.get('date_from'):
-                    query += " AND DATE(timestamp) >= ?"
-                    params.append(filters['date_from'])
-                if filters.get('date_to'):
-                    query += " AND DATE(timestamp) <= ?"
-                    params.append(filters['date_to'])
+                date_conditions, date_params = date_range_conditions("timestamp", filters.get('date_from'), filters.get('date_to'))
+                for condition in date_conditions:
+                    query += f" AND {condition}"
+                params.extend(date_params)
             
             query += f" ORDER BY timestamp DESC LIMIT {limit}"
             return conn.execute(query, params).fetchall()
@@ -1173,6 +1314,8 @@ def ensure_notifications_table():
     - حقول الكيان: entity_type, entity_id
     - حقول موروثة: type, related_id
     - عمود التكرار: event_key
+
+    إذا كان الجدول موجوداً بصيغة قديمة (مُنشأ من verify_and_auto_migrate_schema) تُضاف الأعمدة الناقصة.
     """
     with get_conn() as conn:
         conn.execute("""
@@ -1194,89 +1337,230 @@ def ensure_notifications_table():
         )
         """)
         
+        # إضافة الأعمدة الناقصة في الجداول القديمة
+        existing_cols = {r['name'] for r in conn.execute("PRAGMA table_info(notifications)").fetchall()}
+        for col_name, col_type in (("user_role", "TEXT"), ("role", "TEXT"), ("sector", "TEXT"),
+                                   ("entity_type", "TEXT"), ("entity_id", "INTEGER"), ("type", "TEXT"),
+                                   ("related_id", "INTEGER"), ("event_key", "TEXT")):
+            if col_name not in existing_cols:
+                try:
+                    conn.execute(f"ALTER TABLE notifications ADD COLUMN {col_name} {col_type} DEFAULT NULL")
+                except Exception as e:
+                    print(f"Notifications column warning ({col_name}): {e}")
+        
         # Create indices for performance optimization
+        # الفهارس المركبة تغطي قواعد الرؤية مع الترتيب على (created_at, id) لصفحات keyset
         try:
             conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_is_read ON notifications(is_read)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user_role ON notifications(user_role)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_entity_type ON notifications(entity_type)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_created_at ON notifications(created_at)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_event_key ON notifications(event_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_user_read_created ON notifications(user_id, is_read, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_sector_read_created ON notifications(sector, is_read, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_entity_read_created ON notifications(entity_type, is_read, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_read_created ON notifications(is_read, created_at)")
         except Exception as e:
             print(f"Index creation warning: {e}")
         
+        # منع التكرار على مستوى قاعدة البيانات: إشعار واحد لكل (event_key, role)
+        # تُحذف النسخ المكررة القديمة أولاً (مع الاحتفاظ بالأقدم) ثم يُنشأ الفهرس الفريد
+        duplicates_removed = 0
+        if not index_exists(conn, 'idx_notifications_event_role'):
+            duplicates_removed = conn.execute("""
+                DELETE FROM notifications
+                WHERE event_key IS NOT NULL
+                  AND id NOT IN (SELECT MIN(id) FROM notifications WHERE event_key IS NOT NULL GROUP BY event_key, role)
+            """).rowcount
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_event_role ON notifications(event_key, role)")
+        
+        # عدادات الإشعارات غير المقروءة لكل جمهور (شارة الشريط الجانبي)
+        counters_missing = not table_exists(conn, 'unread_counters')
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS unread_counters (
+            audience TEXT NOT NULL,               -- admin / reviewer_general / reviewer_sector / hospital
+            sector TEXT NOT NULL DEFAULT '',
+            user_id INTEGER NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (audience, sector, user_id)
+        )
+        """)
+        # قواعد بيانات بطريقة عد سابقة (صف لكل دور أو قراءة مشتركة بين الأدوار): إعادة بناء لمرة واحدة
+        counters_mode = conn.execute("SELECT value FROM meta WHERE `key` = 'unread_counters_mode'").fetchone() \
+            if table_exists(conn, 'meta') else None
+        if counters_missing or duplicates_removed or counters_mode is None or counters_mode['value'] != UNREAD_COUNTERS_MODE:
+            rebuild_unread_counters(conn)
+        
         conn.commit()
 
 
-# In-memory guard for non-streamlit runs and global sent keys
-NOTIF_SENT_CACHE = set()
+# ---------------------------- عدادات الإشعارات غير المقروءة ---------------------------- #
+# الأدوار التي لها عداد مخزن؛ أي دور آخر يرجع لاستعلام COUNT المباشر
+COUNTED_AUDIENCES = ("admin", "reviewer_general", "reviewer_sector", "hospital")
+UNREAD_COUNTERS_MODE = "event_role"  # طريقة العد الحالية: تغييرها يعيد بناء العدادات مرة واحدة
+
+
+def _unread_counter_keys(user_id, sector, entity_type):
+    """مفاتيح العدادات (audience, sector, user_id) التي يظهر لها إشعار بهذه الحقول (نفس قواعد الرؤية)"""
+    keys = [("admin", "", 0)]
+    if entity_type == "request":
+        keys.append(("reviewer_general", "", 0))
+    if sector is not None:
+        keys.append(("reviewer_sector", sector, 0))
+    if user_id is not None:
+        keys.append(("hospital", "", user_id))
+    return keys
+
+
+def _apply_unread_delta(conn, user_id, sector, entity_type, delta: int, keys=None):
+    """تعديل العدادات داخل نفس معاملة إنشاء/قراءة الإشعار"""
+    if keys is None:
+        keys = _unread_counter_keys(user_id, sector, entity_type)
+    conn.executemany(
+        """INSERT INTO unread_counters (audience, sector, user_id, unread) VALUES (?, ?, ?, ?)
+           ON CONFLICT(audience, sector, user_id) DO UPDATE SET unread = MAX(0, unread + ?)""",
+        [(audience, key_sector, key_user, max(0, delta), delta) for audience, key_sector, key_user in keys]
+    )
 
 
-def send_notification_once(event_key: str, **kwargs):
-    """Send notification once per unique event_key. Uses st.session_state when available to persist flags
+# الحدث الواحد يُدرج بصف لكل دور (نفس event_key)، والقائمة تعرضه مرة واحدة، فالعداد يحسب الأحداث لا الصفوف
+UNREAD_EVENT_EXPR = "COALESCE(event_key, 'id:' || id)"
+
+
+def _unread_event_keys(conn, event_key, keys) -> set:
+    """مفاتيح العدادات التي يظهر لها الحدث غير مقروء الآن (بنفس قواعد الرؤية المستخدمة في القائمة)"""
+    result = set()
+    for audience, key_sector, key_user in keys:
+        conditions, params = _notifications_visibility_filter(key_user, audience, key_sector)
+        where = " AND ".join(conditions + ["event_key = ?", "is_read = 0"])
+        if conn.execute(f"SELECT 1 FROM notifications WHERE {where} LIMIT 1", params + [event_key]).fetchone():
+            result.add((audience, key_sector, key_user))
+    return result
+
+
+def _apply_unread_transition(conn, keys, before: set, after: set):
+    """تطبيق فرق الحالة (غير مقروء قبل/بعد) على العدادات: +1 لما أصبح غير مقروء و -1 لما قُرئ"""
+    _apply_unread_delta(conn, None, None, None, 1, keys=[k for k in keys if k in after and k not in before])
+    _apply_unread_delta(conn, None, None, None, -1, keys=[k for k in keys if k in before and k not in after])
+
+
+def rebuild_unread_counters(conn=None):
+    """إعادة بناء جدول unread_counters بالكامل من جدول الإشعارات (للإصلاح)"""
+    if conn is None:
+        with get_conn() as own_conn:
+            count = rebuild_unread_counters(own_conn)
+            own_conn.commit()
+            return count
+    conn.execute("DELETE FROM unread_counters")
+    conn.execute(f"""
+        INSERT INTO unread_counters (audience, sector, user_id, unread)
+        SELECT 'admin', '', 0, COUNT(DISTINCT {UNREAD_EVENT_EXPR}) FROM notifications
+        WHERE is_read = 0 AND {_OWN_EVENT_ROW_SQL}
+        UNION ALL
+        SELECT 'reviewer_general', '', 0, COUNT(DISTINCT {UNREAD_EVENT_EXPR}) FROM notifications
+        WHERE entity_type = 'request' AND is_read = 0 AND {_OWN_EVENT_ROW_SQL}
+        UNION ALL
+        SELECT 'reviewer_sector', sector, 0, COUNT(DISTINCT {UNREAD_EVENT_EXPR}) FROM notifications
+        WHERE sector IS NOT NULL AND is_read = 0 AND {_OWN_EVENT_ROW_SQL} GROUP BY sector
+        UNION ALL
+        SELECT 'hospital', '', user_id, COUNT(DISTINCT {UNREAD_EVENT_EXPR}) FROM notifications
+        WHERE user_id IS NOT NULL AND is_read = 0 AND {_OWN_EVENT_ROW_SQL} GROUP BY user_id
+    """, ["admin"] * 2 + ["reviewer_general"] * 2 + ["reviewer_sector"] * 2 + ["hospital"] * 2)
+    if table_exists(conn, 'meta'):
+        conn.execute("INSERT OR REPLACE INTO meta (`key`, value) VALUES ('unread_counters_mode', ?)", (UNREAD_COUNTERS_MODE,))
+    return conn.execute("SELECT COUNT(1) as c FROM unread_counters").fetchone()['c']
+
+
+def _normalize_notification(user_id=None, user_role=None, title="", message="", notification_type=None,
+                            related_id=None, entity_type=None, entity_id=None, sector=None, event_key=None):
+    """تطبيع حقول الإشعار إلى صف جاهز للإدراج، أو None إذا كانت الحقول الإلزامية ناقصة"""
+    # تطبيع الحقول أولاً
+    title = str(title).strip()[:500] if title else ""  # حد أقصى 500 حرف
+    message = str(message).strip()[:2000] if message else ""  # حد أقصى 2000 حرف
+    
+    # التحقق من الحقول الإلزامية بعد التطبيع
+    if not title or not message:
+        print(f"notification skipped: missing required fields. title={title!r}, message={message!r}, event_key={event_key!r}")
+        return None
+    
+    # تطبيع نوع الكيان
+    spec_entity_type = entity_type or notification_type or "system"
+    if spec_entity_type not in ("request", "hospital", "document", "system"):
+        spec_entity_type = "system"
+    
+    return {
+        "user_id": user_id, "user_role": user_role, "role": user_role, "sector": sector,
+        "title": title, "message": message, "entity_type": spec_entity_type,
+        "entity_id": entity_id or related_id, "type": notification_type, "related_id": related_id,
+        "event_key": event_key,
+    }
+
+
+def _insert_notifications(conn, rows: list[dict]) -> int:
+    """إدراج الإشعارات وتحديث العدادات داخل معاملة المتصل.
 
-    event_key should uniquely identify the event, e.g. 'req_created:123', 'req_status:123:approved'
+    الإشعارات التي لها نفس (event_key, role) موجودة مسبقاً يتم تجاهلها بواسطة الفهرس الفريد.
+    العودة: عدد الإشعارات المدرجة فعلاً
     """
-    try:
-        # normalize key
-        k = f"notif_sent::{event_key}"
-        sent = False
-        try:
-            if hasattr(st, 'session_state'):
-                if k in st.session_state:
-                    return False
+    now_iso = datetime.now().isoformat()
+    inserted = 0
+    for row in rows:
+        keys = _unread_counter_keys(row["user_id"], row["sector"], row["entity_type"])
+        before = _unread_event_keys(conn, row["event_key"], keys) if row["event_key"] else set()
+        cur = conn.execute(
+            """
+            INSERT INTO notifications (
+                user_id, user_role, role, sector, title, message, 
+                entity_type, entity_id, type, related_id, event_key, 
+                is_read, created_at
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,0,?)
+            ON CONFLICT(event_key, role) DO NOTHING
+            """,
+            (row["user_id"], row["user_role"], row["role"], row["sector"], row["title"], row["message"],
+             row["entity_type"], row["entity_id"], row["type"], row["related_id"], row["event_key"], now_iso)
+        )
+        if cur.rowcount:
+            inserted += 1
+            # تحديث عدادات غير المقروء في نفس المعاملة (مرة واحدة لكل حدث وجمهور)
+            if row["event_key"]:
+                _apply_unread_transition(conn, keys, before, _unread_event_keys(conn, row["event_key"], keys))
             else:
-                if k in NOTIF_SENT_CACHE:
-                    return False
-        except Exception:
-            # fallback to module cache
-            if k in NOTIF_SENT_CACHE:
-                return False
+                _apply_unread_delta(conn, None, None, None, 1, keys=keys)
+    return inserted
 
-        # validate minimal fields
-        title = kwargs.get('title')
-        message = kwargs.get('message')
-        if not title or not message:
-            print(f"Notification skipped (missing title/message) for {event_key}")
-            return False
 
-        # Ensure DB can record event key for de-duplication
-        try:
-            _ensure_notifications_event_key_column()
-        except Exception:
-            pass
+def send_notifications(event_key: str, audiences: list[dict], **common) -> int:
+    """إرسال إشعار حدث واحد لعدة جماهير في معاملة واحدة، مرة واحدة لكل (event_key, role).
 
-        # Check DB for an existing notification with the same event_key (prevent cross-session duplicates)
-        try:
-            with get_conn() as conn:
-                res = conn.execute("SELECT COUNT(1) as c FROM notifications WHERE event_key = ?", (event_key,)).fetchone()
-                if res and res['c'] and int(res['c']) > 0:
-                    # mark as sent in session/cache to avoid reattempts in this run
-                    try:
-                        if hasattr(st, 'session_state'):
-                            st.session_state[k] = True
-                    except Exception:
-                        pass
-                    NOTIF_SENT_CACHE.add(k)
-                    return False
-        except Exception:
-            # If DB check fails, proceed to attempt creation but rely on session guard
-            pass
+    - event_key: معرف فريد للحدث، مثل 'req_created:123' أو 'req_status:123:approved'
+    - audiences: قائمة بحقول كل جمهور (user_role إلزامي، ويمكن تجاوز title/message/user_id/sector)
+    - common: الحقول المشتركة بين كل الجماهير (entity_type, entity_id, sector, ...)
 
-        # include event_key into kwargs so it's stored for future de-dup checks
-        kwargs['event_key'] = event_key
-        ok = create_notification(**kwargs)
-        if ok:
-            try:
-                if hasattr(st, 'session_state'):
-                    st.session_state[k] = True
-                NOTIF_SENT_CACHE.add(k)
-            except Exception:
-                NOTIF_SENT_CACHE.add(k)
-            return True
-        return False
+    العودة: عدد الإشعارات المدرجة (0 إذا كانت كلها مرسلة مسبقاً)
+    """
+    try:
+        rows = []
+        for audience in audiences:
+            fields = dict(common)
+            fields.update(audience)
+            fields['event_key'] = event_key
+            row = _normalize_notification(**fields)
+            if row:
+                rows.append(row)
+        if not rows:
+            return 0
+        with get_conn() as conn:
+            inserted = _insert_notifications(conn, rows)
+            conn.commit()
+        return inserted
     except Exception as e:
-        print(f"send_notification_once error: {e}")
-        return False
+        print(f"send_notifications error: {e}")
+        return 0
+
+
+def send_notification_once(event_key: str, **kwargs):
+    """إرسال إشعار واحد مرة واحدة لكل (event_key, role) - غلاف متوافق حول send_notifications."""
+    return send_notifications(event_key, [kwargs]) > 0
 
 
 def create_notification(user_id: int = None,
@@ -1302,61 +1586,17 @@ def create_notification(user_id: int = None,
     - sector: القطاع (اختياري)
     - event_key: مفتاح فريد لمنع التكرار (اختياري)
     
-    العودة: True عند النجاح، False عند الفشل
+    العودة: True عند النجاح، False عند الفشل (أو إذا كان الإشعار مرسلاً مسبقاً لنفس event_key والدور)
     """
     try:
-        # تطبيع الحقول أولاً
-        title = str(title).strip()[:500] if title else ""  # حد أقصى 500 حرف
-        message = str(message).strip()[:2000] if message else ""  # حد أقصى 2000 حرف
-        
-        # التحقق من الحقول الإلزامية بعد التطبيع
-        if not title or not message:
-            print(f"create_notification: missing required fields. title={title!r}, message={message!r}")
+        row = _normalize_notification(user_id, user_role, title, message, notification_type,
+                                      related_id, entity_type, entity_id, sector, event_key)
+        if not row:
             return False
-        
-        # تطبيع نوع الكيان
-        spec_entity_type = entity_type or notification_type or "system"
-        if spec_entity_type not in ("request", "hospital", "document", "system"):
-            spec_entity_type = "system"
-        
-        # التأكد من وجود جدول الإشعارات وعمود event_key
-        try:
-            _ensure_notifications_event_key_column()
-        except Exception:
-            pass  # لا نعطل العملية إذا فشل هذا
-        
-        now_iso = datetime.now().isoformat()
-        
         with get_conn() as conn:
-            # إدراج الإشعار مع جميع الحقول
-            if event_key:
-                conn.execute(
-                    """
-                    INSERT INTO notifications (
-                        user_id, user_role, role, sector, title, message, 
-                        entity_type, entity_id, type, related_id, event_key, 
-                        is_read, created_at
-                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-                    """,
-                    (user_id, user_role, user_role, sector, title, message,
-                     spec_entity_type, entity_id or related_id, notification_type, 
-                     related_id, event_key, 0, now_iso)
-                )
-            else:
-                conn.execute(
-                    """
-                    INSERT INTO notifications (
-                        user_id, user_role, role, sector, title, message, 
-                        entity_type, entity_id, type, related_id, 
-                        is_read, created_at
-                    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
-                    """,
-                    (user_id, user_role, user_role, sector, title, message,
-                     spec_entity_type, entity_id or related_id, notification_type, 
-                     related_id, 0, now_iso)
-                )
+            inserted = _insert_notifications(conn, [row])
             conn.commit()
-            return True
+        return inserted > 0
     except Exception as e:
         print(f"create_notification error: {e}")
         import traceback
@@ -1364,48 +1604,104 @@ def create_notification(user_id: int = None,
         return False
 
 
-def _build_notifications_query_for_user(user_id: int, role: str, sector: str = None, unread_only: bool = False, limit: int = 50, offset: int = 0):
-    """بناء استعلام لإحضار الإشعارات مع تطبيق قواعد العرض (visibility rules)."""
-    params = []
-    # Admin يرى كل الإشعارات
+NOTIFICATIONS_PAGE_SIZE = 20
+
+
+# الحدث الموزع على عدة أدوار له صف لكل دور (event_key, role): كل دور يرى صفه هو فقط،
+# ويرى صفوف الأدوار الأخرى فقط إذا لم يُرسل له صف خاص (مثل إشعار موجه لمستشفى واحدة).
+# فحالة القراءة مستقلة لكل دور: قراءة المستشفى لا تخفي التحديث عن المراجعين والعكس.
+_OWN_EVENT_ROW_SQL = ("(role = ? OR NOT EXISTS (SELECT 1 FROM notifications o "
+                      "WHERE o.event_key = notifications.event_key AND o.role = ?))")
+
+
+def _notifications_visibility_filter(user_id: int, role: str, sector: str = None):
+    """شروط الرؤية (visibility rules) لكل دور كقائمة شروط ومعاملات.
+
+    كل شرط يطابق بادئة أحد الفهارس المركبة (..., is_read, created_at)،
+    وشرط صف الدور (_OWN_EVENT_ROW_SQL) يُفحص بالفهرس الفريد (event_key, role).
+    """
     if role == "admin":
-        query = "SELECT * FROM notifications"
+        # Admin يرى كل الإشعارات
+        conditions, params = [], []
     elif role == "reviewer_general":
         # يرى جميع إشعارات الطلبات
-        query = "SELECT * FROM notifications WHERE entity_type = 'request'"
+        conditions, params = ["entity_type = 'request'"], []
     elif role == "reviewer_sector":
-        # يرى إشعارات القطاع المتعلقة بقطاعه أو الإشعارات التي تم تحديدها لقطاع معين
-        query = "SELECT * FROM notifications WHERE (sector = ? OR entity_type = 'hospital' AND sector = ?)"
-        params.extend([sector, sector])
+        # يرى إشعارات قطاعه (بما فيها إشعارات المستشفيات المحددة لقطاعه)
+        conditions, params = ["sector = ?"], [sector]
     elif role == "hospital":
         # يرى إشعارات مرتبطة به مباشرة
-        query = "SELECT * FROM notifications WHERE user_id = ?"
-        params.append(user_id)
+        conditions, params = ["user_id = ?"], [user_id]
     else:
         # افتراضي: إحضار إشعارات موجهة للدور أو للمستخدم
-        query = "SELECT * FROM notifications WHERE (user_id = ? OR role = ?)"
-        params.extend([user_id, role])
+        conditions, params = ["(user_id = ? OR role = ?)"], [user_id, role]
+    return conditions + [_OWN_EVENT_ROW_SQL], params + [role, role]
 
-    if unread_only:
-        if "WHERE" in query:
-            query += " AND is_read = 0"
-        else:
-            query += " WHERE is_read = 0"
 
-    query += " ORDER BY datetime(created_at) DESC"
-    
-    # فقط أضف LIMIT و OFFSET إذا كانا معيّنة (limit > 0)
-    if limit and limit > 0:
-        query += " LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-    
+def _build_notifications_query_for_user(user_id: int, role: str, sector: str = None, unread_only: bool = False, limit: int = 50, cursor: tuple = None):
+    """بناء استعلام keyset لإحضار الإشعارات مع تطبيق قواعد العرض (visibility rules).
+
+    - الترتيب على (created_at, id) تنازلياً بدون datetime() ليستفيد من الفهارس المركبة.
+    - cursor هو (created_at, id) لآخر إشعار في الصفحة السابقة بدلاً من OFFSET.
+    - عند عرض الكل يتم دمج فرعين (غير مقروء / مقروء) كل منهما مرتب من الفهرس ومحدود بـ limit،
+      فلا يتجاوز الفرز 2 × limit صف مهما كبر حجم الجدول.
+    """
+    conditions, base_params = _notifications_visibility_filter(user_id, role, sector)
+    if cursor:
+        conditions = conditions + ["(created_at, id) < (?, ?)"]
+        base_params = base_params + [cursor[0], cursor[1]]
+
+    branches = []
+    params = []
+    for is_read in ([0] if unread_only else [0, 1]):
+        where = " AND ".join(conditions + ["is_read = ?"])
+        branches.append(f"SELECT * FROM (SELECT * FROM notifications WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ?)")
+        params.extend(base_params + [is_read, limit])
+
+    query = " UNION ALL ".join(branches) + " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit)
     return query, params
 
 
+def _iter_visible_notifications(user_id: int, user_role: str, user_sector: str = None, unread_only: bool = False, cursor: tuple = None, batch_size: int = 50):
+    """مولّد للإشعارات المرئية بالترتيب من الأحدث للأقدم.
+
+    يعيد (notification, position) حيث position هو مؤشر keyset بعد هذا الإشعار.
+    إزالة تكرار الحدث (صف لكل دور) تتم في الاستعلام نفسه عبر _OWN_EVENT_ROW_SQL.
+    """
+    while True:
+        query, params = _build_notifications_query_for_user(user_id, user_role, user_sector, unread_only, batch_size, cursor)
+        with get_conn() as conn:
+            rows = [dict(r) for r in conn.execute(query, params).fetchall()]
+        for notif in rows:
+            cursor = (notif['created_at'], notif['id'])
+            yield notif, cursor
+        if len(rows) < batch_size:
+            return
+
+
+def get_notifications_page(user_id: int, user_role: str, user_sector: str = None, unread_only: bool = False, limit: int = NOTIFICATIONS_PAGE_SIZE, cursor: tuple = None):
+    """صفحة إشعارات بنظام keyset.
+
+    العودة: (قائمة الإشعارات, مؤشر الصفحة التالية أو None إذا لا توجد إشعارات أقدم)
+    """
+    try:
+        # صف إضافي واحد يكفي لمعرفة وجود صفحة تالية
+        query, params = _build_notifications_query_for_user(user_id, user_role, user_sector, unread_only, limit + 1, cursor)
+        with get_conn() as conn:
+            rows = [dict(r) for r in conn.execute(query, params).fetchall()]
+    except Exception as e:
+        print(f"get_notifications_page error: {e}")
+        return [], None
+    items = rows[:limit]
+    next_cursor = (items[-1]['created_at'], items[-1]['id']) if len(rows) > limit else None
+    return items, next_cursor
+
+
 def get_user_notifications(user_id: int, user_role: str, user_sector: str = None, unread_only: bool = False, limit: int = 50, offset: int = 0):
     """الحصول على إشعانات مرئية للمستخدم بناءً على قواعد الرؤية (visibility rules).
 
-    يحترم pagination وفلترة unread.
+    واجهة متوافقة مع الكود القديم فوق نظام keyset (يفضل استخدام get_notifications_page).
     
     المعاملات:
     - user_id: معرف المستخدم
@@ -1418,77 +1714,15 @@ def get_user_notifications(user_id: int, user_role: str, user_sector: str = None
     العودة: قائمة الإشعارات
     """
     try:
-        with get_conn() as conn:
-            query, params = _build_notifications_query_for_user(user_id, user_role, user_sector, unread_only, limit, offset)
-            # استخدم التخزين المؤقت للاستعلامات
-            notif_list = cached_query(query, tuple(params), one=False, tag="notifications_list") or []
-
-            # إزالة الإشعارات المكررة بناءً على event_key أو entity
-            seen = {}
-            
-            def get_fingerprint(n: dict) -> str:
-                """حساب بصمة فريدة للإشعار لتجنب التكرار"""
-                event_key = n.get('event_key')
-                if event_key:
-                    return f"ek::{event_key}"
-                
-                entity_type = n.get('entity_type') or ''
-                entity_id = n.get('entity_id')
-                if entity_type and entity_id:
-                    return f"ent::{entity_type}:{entity_id}"
-                
-                # الخيار الأخير: بصمة العنوان والرسالة
-                title = n.get('title') or ''
-                message = n.get('message') or ''
-                return f"txt::{title}:{message}"
-            
-            for notif in notif_list:
-                fingerprint = get_fingerprint(notif)
-                
-                # الحصول على تاريخ الإنشاء للمقارنة
-                current_dt = None
-                try:
-                    created_str = notif.get('created_at')
-                    if created_str:
-                        current_dt = datetime.fromisoformat(created_str)
-                except (ValueError, TypeError):
-                    current_dt = None
-                
-                if fingerprint not in seen:
-                    # إضافة إشعار جديد
-                    seen[fingerprint] = (notif, current_dt)
-                else:
-                    # الاحتفاظ بالإشعار الأحدث
-                    existing_notif, existing_dt = seen[fingerprint]
-                    try:
-                        if current_dt and (existing_dt is None or current_dt > existing_dt):
-                            seen[fingerprint] = (notif, current_dt)
-                    except TypeError:
-                        pass  # لا نقارن إذا فشلت المقارنة
-            
-            # استخراج الإشعارات المزالة من التكرار وترتيبها
-            deduped = [v[0] for v in seen.values()]
-            
-            def get_datetime(n: dict):
-                """محاولة الحصول على تاريخ الإشعار"""
-                try:
-                    created_str = n.get('created_at')
-                    if created_str:
-                        return datetime.fromisoformat(created_str)
-                except (ValueError, TypeError):
-                    pass
-                return datetime.min
-            
-            # ترتيب تنازلي حسب التاريخ
-            deduped.sort(key=get_datetime, reverse=True)
-            
-            # تطبيق pagination
-            start = max(0, int(offset or 0))
-            if limit and limit > 0:
-                end = start + int(limit)
-                return deduped[start:end]
-            
-            return deduped[start:]
+        start = max(0, int(offset or 0))
+        end = start + int(limit) if limit and limit > 0 else None
+        result = []
+        for index, (notif, _) in enumerate(_iter_visible_notifications(user_id, user_role, user_sector, unread_only, batch_size=end or 200)):
+            if end is not None and index >= end:
+                break
+            if index >= start:
+                result.append(notif)
+        return result
     
     except Exception as e:
         print(f"get_user_notifications error: {e}")
@@ -1519,8 +1753,24 @@ def mark_notification_read(notification_id: int, acting_user_id: int = None, act
                     allowed = True
                 if not allowed:
                     return False
-            # تعيين كمقروء
-            conn.execute("UPDATE notifications SET is_read = 1 WHERE id = ?", (notification_id,))
+            # تعيين كمقروء: صفوف الحدث التي يراها المستخدم فقط (صف دوره)، فلا تتغير حالة الأدوار الأخرى
+            # وتُعدّل العدادات فقط للجماهير التي تغيرت حالة الحدث لديها فعلاً
+            target = conn.execute("SELECT event_key FROM notifications WHERE id = ?", (notification_id,)).fetchone()
+            event_key = target['event_key'] if target else None
+            if event_key and acting_user_role:
+                conditions, params = _notifications_visibility_filter(acting_user_id, acting_user_role, acting_user_sector)
+                where = " AND ".join(conditions + ["event_key = ?", "is_read = 0"])
+                rows = conn.execute(f"SELECT id, user_id, sector, entity_type FROM notifications WHERE {where}",
+                                    params + [event_key]).fetchall()
+            else:
+                rows = conn.execute("SELECT id, user_id, sector, entity_type FROM notifications WHERE id = ? AND is_read = 0",
+                                    (notification_id,)).fetchall()
+            if rows:
+                keys = sorted({key for r in rows for key in _unread_counter_keys(r['user_id'], r['sector'], r['entity_type'])})
+                before = _unread_event_keys(conn, event_key, keys) if event_key else set(keys)
+                conn.executemany("UPDATE notifications SET is_read = 1 WHERE id = ?", [(r['id'],) for r in rows])
+                after = _unread_event_keys(conn, event_key, keys) if event_key else set()
+                _apply_unread_transition(conn, keys, before, after)
             conn.commit()
             # إبطال التخزين المؤقت للإشعارات لضمان تحديث البيانات
             try:
@@ -1534,26 +1784,39 @@ def mark_notification_read(notification_id: int, acting_user_id: int = None, act
 
 
 def get_unread_count(user_id: int, user_role: str, user_sector: str = None):
-    """عدد الإشعارات غير المقروءة للمستخدم مع قواعد رؤية بسيطة."""
+    """عدد الإشعارات غير المقروءة للمستخدم مع قواعد رؤية بسيطة.
+
+    للأدوار المعروفة: قراءة واحدة بالمفتاح الأساسي من unread_counters.
+    """
     try:
+        if user_role in COUNTED_AUDIENCES:
+            key_sector = (user_sector or "") if user_role == "reviewer_sector" else ""
+            key_user = (user_id or 0) if user_role == "hospital" else 0
+            with get_conn() as conn:
+                row = conn.execute(
+                    "SELECT unread FROM unread_counters WHERE audience = ? AND sector = ? AND user_id = ?",
+                    (user_role, key_sector, key_user)
+                ).fetchone()
+                return row['unread'] if row else 0
+
         # استعلام مباشر بدون تخزين مؤقت لضمان دقة البيانات
         with get_conn() as conn:
             # بناء الاستعلام
             if user_role == "admin":
-                query = "SELECT COUNT(1) as c FROM notifications WHERE is_read = 0"
-                params = []
+                query = f"SELECT COUNT(DISTINCT {UNREAD_EVENT_EXPR}) as c FROM notifications WHERE is_read = 0 AND {_OWN_EVENT_ROW_SQL}"
+                params = [user_role, user_role]
             elif user_role == "reviewer_general":
-                query = "SELECT COUNT(1) as c FROM notifications WHERE entity_type = 'request' AND is_read = 0"
-                params = []
+                query = f"SELECT COUNT(DISTINCT {UNREAD_EVENT_EXPR}) as c FROM notifications WHERE entity_type = 'request' AND is_read = 0 AND {_OWN_EVENT_ROW_SQL}"
+                params = [user_role, user_role]
             elif user_role == "reviewer_sector":
-                query = "SELECT COUNT(1) as c FROM notifications WHERE sector = ? AND is_read = 0"
-                params = [user_sector]
+                query = f"SELECT COUNT(DISTINCT {UNREAD_EVENT_EXPR}) as c FROM notifications WHERE sector = ? AND is_read = 0 AND {_OWN_EVENT_ROW_SQL}"
+                params = [user_sector, user_role, user_role]
             elif user_role == "hospital":
-                query = "SELECT COUNT(1) as c FROM notifications WHERE user_id = ? AND is_read = 0"
-                params = [user_id]
+                query = f"SELECT COUNT(DISTINCT {UNREAD_EVENT_EXPR}) as c FROM notifications WHERE user_id = ? AND is_read = 0 AND {_OWN_EVENT_ROW_SQL}"
+                params = [user_id, user_role, user_role]
             else:
-                query = "SELECT COUNT(1) as c FROM notifications WHERE (user_id = ? OR role = ?) AND is_read = 0"
-                params = [user_id, user_role]
+                query = f"SELECT COUNT(DISTINCT {UNREAD_EVENT_EXPR}) as c FROM notifications WHERE (user_id = ? OR role = ?) AND is_read = 0 AND {_OWN_EVENT_ROW_SQL}"
+                params = [user_id, user_role, user_role, user_role]
             
             result = conn.execute(query, params).fetchone()
             return result['c'] if result else 0
@@ -1562,22 +1825,6 @@ def get_unread_count(user_id: int, user_role: str, user_sector: str = None):
         return 0
 
 
-def _ensure_notifications_event_key_column():
-    """Ensure the notifications table has an event_key TEXT column for deduplication.
-
-    This is a safe no-op if the column already exists.
-    """
-    try:
-        with get_conn() as conn:
-            cols = [r['name'] for r in conn.execute("PRAGMA table_info(notifications)").fetchall()]
-            if 'event_key' not in cols:
-                conn.execute("ALTER TABLE notifications ADD COLUMN event_key TEXT")
-                conn.commit()
-    except Exception as e:
-        # bubble up to callers if necessary
-        raise
-
-
 def navigate_to_entity(entity_type: str, entity_id: int = None):
     """Set a session-state target for navigation and rerun.
 
@@ -1717,12 +1964,25 @@ def render_sidebar_notifications(user: dict):
             st.caption("✅ لا توجد رسائل جديدة")
 
         with st.expander("عرض الإشعارات الأخيرة"):
-            notifs = get_user_notifications(uid, urole, usector, unread_only=False, limit=50)
+            # التنقل بين الصفحات عبر مكدس مؤشرات keyset في session_state
+            cursor_stack = st.session_state.setdefault("notif_cursor_stack", [])
+            cursor = cursor_stack[-1] if cursor_stack else None
+            notifs, next_cursor = get_notifications_page(uid, urole, usector, cursor=cursor)
 
-            if not notifs:
+            if not notifs and not cursor_stack:
                 st.info("لا توجد إشعارات حاليًا")
                 return
 
+            nav_newer, nav_older = st.columns(2)
+            with nav_newer:
+                if cursor_stack and st.button("⬅️ الأحدث", key="notif_page_newer"):
+                    cursor_stack.pop()
+                    st.rerun()
+            with nav_older:
+                if next_cursor and st.button("الأقدم ➡️", key="notif_page_older"):
+                    cursor_stack.append(next_cursor)
+                    st.rerun()
+
             # عرض كل إشعار مع تحسينات
             for n in notifs:
                 try:
@@ -1810,6 +2070,12 @@ def parse_date_safely(date_str: str, default_value=None):
     if not date_str or date_str == "غير محدد":
         return default_value
     try:
+        # الصيغة المعتادة (ISO) بدون تحميل pandas
+        return date.fromisoformat(str(date_str).strip()[:10])
+    except ValueError:
+        pass
+    try:
+        import pandas as pd
         # errors='coerce' سيجعل pandas يعيد NaT (Not a Time) عند الفشل
         dt = pd.to_datetime(date_str, errors='coerce')
         return dt.date() if pd.notna(dt) else default_value
@@ -1865,13 +2131,16 @@ def can_user_review_requests(user: dict) -> bool:
     return user.get("role") in ["admin", "reviewer_general", "reviewer_sector"]
 
 # ---------------------------- وظائف مساعدة للإعدادات ---------------------------- #
-@st.cache_data(ttl=3600)
+# مدة صلاحية طويلة لأن أي تعديل يبطل الذاكرة المؤقتة في كل العمليات عبر cache_versions
+CONFIG_CACHE_TTL = 24 * 3600
+
+@query_cache.cached(ttl=CONFIG_CACHE_TTL, tags=["meta"])
 def get_list_from_meta(key: str, default_list: list) -> list:
     # قراءة بسيطة من meta عبر الكاش
-    row = cached_query("SELECT value FROM meta WHERE key=?", (key,), one=True, tag="meta")
+    row = cached_query("SELECT value FROM meta WHERE key=?", (key,), one=True, tag=f"meta:{key}")
     return (row["value"].split(",") if row and row.get("value") else []) or default_list
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_hospital_types() -> list:
     return get_list_from_meta('hospital_types', DEFAULT_HOSPITAL_TYPES)
 
@@ -1879,12 +2148,12 @@ def set_hospital_types(types: list):
     with get_conn() as conn:
         conn.execute("INSERT INTO meta(key,value) VALUES('hospital_types', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                     (",".join(types),))
+        bump_cache_versions(conn, ["meta:hospital_types"])
         conn.commit()
     # مسح الذاكرة المؤقتة لضمان تحديث البيانات
-    get_hospital_types.clear()
-    get_list_from_meta.clear()
+    invalidate_cache_tags(["meta:hospital_types"])
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_sectors() -> list:
     return get_list_from_meta('sectors', DEFAULT_SECTORS)
 
@@ -1892,12 +2161,12 @@ def set_sectors(sectors: list):
     with get_conn() as conn:
         conn.execute("INSERT INTO meta(key,value) VALUES('sectors', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                     (",".join(sectors),))
+        bump_cache_versions(conn, ["meta:sectors"])
         conn.commit()
     # مسح الذاكرة المؤقتة
-    get_sectors.clear()
-    get_list_from_meta.clear()
+    invalidate_cache_tags(["meta:sectors"])
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_governorates() -> list:
     return get_list_from_meta('governorates', DEFAULT_GOVERNORATES)
 
@@ -1905,23 +2174,23 @@ def set_governorates(gov: list):
     with get_conn() as conn:
         conn.execute("INSERT INTO meta(key,value) VALUES('governorates', ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                     (",".join(gov),))
+        bump_cache_versions(conn, ["meta:governorates"])
         conn.commit()
     # مسح الذاكرة المؤقتة
-    get_governorates.clear()
-    get_list_from_meta.clear()
+    invalidate_cache_tags(["meta:governorates"])
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_request_statuses() -> list:
     rows = cached_query("SELECT name FROM request_statuses ORDER BY id", (), one=False, tag="request_statuses")
     return [row['name'] for row in rows] if rows else DEFAULT_REQUEST_STATUSES
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_preventing_statuses() -> set:
     """الحصول على الحالات التي تمنع تقديم طلب جديد."""
     rows = cached_query("SELECT status_name FROM status_settings WHERE prevents_new_request = 1", (), one=False, tag="status_settings")
     return {row['status_name'] for row in rows}
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_blocking_statuses() -> set:
     """الحصول على الحالات التي تمنع التقديم لفترة معينة."""
     rows = cached_query("SELECT status_name FROM status_settings WHERE blocks_service_for_days > 0", (), one=False, tag="status_settings")
@@ -1931,7 +2200,7 @@ def is_final_status(status: str) -> bool:
     row = cached_query("SELECT is_final_state FROM status_settings WHERE status_name = ?", (status,), one=True, tag="status_settings")
     return bool(row and row.get('is_final_state') == 1)
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_editable_statuses_for_role(role: str) -> set:
     """احصل على الحالات التي يمكن لدور معين تعديلها"""
     if role == "admin":
@@ -1952,7 +2221,7 @@ def can_reviewer_modify_status(role: str, current_status: str, new_status: str)
     editable = get_editable_statuses_for_role(role)
     return current_status in editable and new_status in editable
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_reviewer_status_permissions_matrix() -> dict:
     """احصل على مصفوفة جميع صلاحيات المراجعين لتعديل الحالات"""
     roles = ["reviewer_general", "reviewer_sector"]
@@ -1961,12 +2230,12 @@ def get_reviewer_status_permissions_matrix() -> dict:
         matrix[role] = list(get_editable_statuses_for_role(role))
     return matrix
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_document_types() -> list:
     rows = cached_query("SELECT name, display_name, is_video_allowed FROM document_types ORDER BY name", (), one=False, tag="document_types")
     return [{'name': r['name'], 'display_name': r['display_name'], 'is_video_allowed': r['is_video_allowed']} for r in rows]
 
-@st.cache_data(ttl=1800)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL, tags=["opt_docs"])
 def get_optional_docs_for_type(hospital_type: str) -> set:
     rows = cached_query("SELECT doc_name FROM hospital_type_optional_docs WHERE hospital_type = ?", (hospital_type,), one=False, tag=f"opt_docs:{hospital_type}")
     return {row['doc_name'] for row in rows}
@@ -1984,50 +2253,65 @@ def set_optional_docs_for_type(hospital_type: str, doc_names: list):
                 [(hospital_type, name) for name in doc_names if name]
             )
         
+        bump_cache_versions(conn, [f"opt_docs:{hospital_type}"])
         conn.commit()
     
-    # تحديث الطلبات الموجودة فوراً
-    update_existing_requests_optional_docs()
-    
     # مسح الذاكرة المؤقتة لضمان التحديث
-    get_optional_docs_for_type.clear()
-    get_document_types.clear()
-    invalidate_cache_tags(["document_types", f"opt_docs:{hospital_type}"])
+    invalidate_cache_tags([f"opt_docs:{hospital_type}"])
     
     print(f"تم تحديث المستندات الاختيارية لـ {hospital_type}: {doc_names}")
+    
+    # تحديث الطلبات الموجودة في الخلفية حتى تعود الواجهة فوراً
+    return job_manager.submit(
+        "optional_docs", f"تطبيق المستندات الاختيارية على طلبات {hospital_type}",
+        update_existing_requests_optional_docs, hospital_type=hospital_type,
+        dedupe_key=f"optional_docs:{hospital_type}"
+    )
+
+def _docs_config_stamp(conn, hospital_type: str) -> str:
+    """بصمة إصدار إعدادات المستندات لنوع مستشفى معين (من جدول cache_versions)"""
+    scopes = ("document_types", "opt_docs", f"opt_docs:{hospital_type}")
+    rows = conn.execute("SELECT scope, version FROM cache_versions WHERE scope IN (?,?,?)", scopes).fetchall()
+    versions = {r['scope']: r['version'] for r in rows}
+    return ":".join(str(versions.get(scope, 0)) for scope in scopes) + f":{hospital_type}"
 
 def ensure_request_docs(request_id: int, hospital_type: str):
-    """ضمان وجود جميع المستندات للطلب مع تحديث حالة المطلوب/الاختياري"""
+    """ضمان وجود جميع المستندات للطلب مع تحديث حالة المطلوب/الاختياري.
+
+    - عبارة upsert واحدة من document_types مع hospital_type_optional_docs (تعتمد على الفهرس الفريد
+      documents(request_id, doc_type)) ولا تعدل إلا الصفوف التي تغيرت فعلاً.
+    - لا تكتب شيئاً إذا لم تتغير إعدادات المستندات منذ آخر مزامنة للطلب (requests.docs_config_stamp)،
+      فعرض صفحة الرفع لا يأخذ قفل كتابة.
+
+    العودة: True إذا تمت المزامنة، False إذا كان الطلب محدثاً مسبقاً
+    """
     with get_conn() as conn:
-        existing_rows = conn.execute("SELECT doc_type FROM documents WHERE request_id=?", (request_id,)).fetchall()
-        existing = {r["doc_type"] for r in existing_rows}
-        optional_docs = get_optional_docs_for_type(hospital_type)
-        all_doc_types = get_document_types()
-        
-        # إضافة المستندات المفقودة
-        docs_to_insert = []
-        for dt in all_doc_types:
-            dt_name = dt['name']
-            if dt_name not in existing:
-                required = 0 if dt_name in optional_docs else 1
-                docs_to_insert.append((request_id, dt_name, dt['display_name'], required, 0, None, dt['is_video_allowed'], datetime.now().isoformat()))
-        
-        if docs_to_insert:
-            conn.executemany(
-                "INSERT INTO documents (request_id, doc_type, display_name, required, satisfied, uploaded_at, is_video_allowed, updated_at) VALUES (?,?,?,?,?,?,?,?)",
-                docs_to_insert
-            )
-        
-        # تحديث جميع المستندات الموجودة بناءً على الإعدادات الحالية
-        for dt in all_doc_types:
-            dt_name = dt['name']
-            required = 0 if dt_name in optional_docs else 1
-            conn.execute(
-                "UPDATE documents SET required = ?, display_name = ?, is_video_allowed = ?, updated_at = ? WHERE request_id = ? AND doc_type = ?", 
-                (required, dt['display_name'], dt['is_video_allowed'], datetime.now().isoformat(), request_id, dt_name)
-            )
+        stamp = _docs_config_stamp(conn, hospital_type)
+        row = conn.execute("SELECT docs_config_stamp FROM requests WHERE id=?", (request_id,)).fetchone()
+        if row and row['docs_config_stamp'] == stamp:
+            return False
         
+        conn.execute("""
+            INSERT INTO documents (request_id, doc_type, display_name, required, satisfied, uploaded_at, is_video_allowed, updated_at)
+            SELECT ?, dt.name, dt.display_name,
+                   CASE WHEN EXISTS (
+                       SELECT 1 FROM hospital_type_optional_docs o WHERE o.hospital_type = ? AND o.doc_name = dt.name
+                   ) THEN 0 ELSE 1 END,
+                   0, NULL, dt.is_video_allowed, ?
+            FROM document_types dt
+            WHERE true
+            ON CONFLICT(request_id, doc_type) DO UPDATE SET
+                required = excluded.required,
+                display_name = excluded.display_name,
+                is_video_allowed = excluded.is_video_allowed,
+                updated_at = excluded.updated_at
+            WHERE documents.required IS NOT excluded.required
+               OR documents.display_name IS NOT excluded.display_name
+               OR documents.is_video_allowed IS NOT excluded.is_video_allowed
+        """, (request_id, hospital_type, datetime.now().isoformat()))
+        conn.execute("UPDATE requests SET docs_config_stamp=? WHERE id=?", (stamp, request_id))
         conn.commit()
+        return True
     
 def hospital_has_open_request(hospital_id: int, service_id: int, prevented_statuses: set) -> bool:
     """التحقق من وجود طلب مفتوح (منع التقديم) لنفس الخدمة"""
@@ -2079,21 +2363,41 @@ def start_database_monitor():
 
 
 # ---------------------------- إعداد قاعدة البيانات ---------------------------- #
-DB_SCHEMA_VERSION = 6
+DB_SCHEMA_VERSION = 12
+
+def table_columns(conn, table: str) -> set:
+    """أسماء أعمدة جدول من PRAGMA table_info (مجموعة فارغة إذا لم يوجد الجدول)"""
+    return {row['name'] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
 
 def column_exists(conn, table: str, column: str) -> bool:
     """التحقق من وجود عمود في جدول"""
-    try:
-        conn.execute(f"SELECT {column} FROM {table} LIMIT 1")
-        return True
-    except sqlite3.OperationalError:
-        return False
+    return column in table_columns(conn, table)
 
 def table_exists(conn, table: str) -> bool:
     """التحقق من وجود جدول"""
     result = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
     return result is not None
 
+class SchemaCapabilities:
+    """لقطة من بنية قاعدة البيانات (الجداول وأعمدتها) تُقرأ مرة واحدة وتُستخدم بدلاً من فحص البنية في كل rerun"""
+
+    def __init__(self, columns: dict):
+        self.columns = columns  # table -> set(columns)
+
+    def has_table(self, table: str) -> bool:
+        return table in self.columns
+
+    def has_column(self, table: str, column: str) -> bool:
+        return column in self.columns.get(table, ())
+
+@query_cache.cached(tags=["schema"])
+def get_schema_capabilities() -> SchemaCapabilities:
+    """سجل إمكانيات البنية (بدون مدة صلاحية: لا يُبطل إلا بعد تشغيل الترحيلات عبر وسم schema)"""
+    with get_conn() as conn:
+        tables = [r['name'] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall()]
+        return SchemaCapabilities({table: table_columns(conn, table) for table in tables})
+
 def safe_add_column(conn, table: str, column: str, column_type: str, default_value=None):
     """إضافة عمود بشكل آمن إذا لم يكن موجوداً"""
     if not column_exists(conn, table, column):
@@ -2122,6 +2426,37 @@ def set_schema_version(version):
         conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)", (str(version),))
         conn.commit()
 
+def compute_schema_fingerprint(conn) -> str:
+    """بصمة البنية الحالية (الجداول والفهارس كما في sqlite_master)"""
+    rows = conn.execute("""
+        SELECT type, name, tbl_name, COALESCE(sql, '') AS sql FROM sqlite_master
+        WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name
+    """).fetchall()
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update("\x1f".join(str(v) for v in tuple(row)).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+def schema_is_current() -> bool:
+    """المسار السريع: الإصدار المخزن يساوي DB_SCHEMA_VERSION والبصمة المخزنة تطابق البنية الفعلية"""
+    try:
+        with get_conn() as conn:
+            rows = {r['key']: r['value'] for r in conn.execute(
+                "SELECT `key`, value FROM meta WHERE `key` IN ('schema_version', 'schema_fingerprint')").fetchall()}
+            if rows.get('schema_version') != str(DB_SCHEMA_VERSION) or not rows.get('schema_fingerprint'):
+                return False
+            return rows['schema_fingerprint'] == compute_schema_fingerprint(conn)
+    except sqlite3.Error:
+        return False
+
+def record_schema_fingerprint():
+    """حفظ بصمة البنية بعد تحقق كامل ناجح"""
+    with get_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_fingerprint', ?)",
+                     (compute_schema_fingerprint(conn),))
+        conn.commit()
+
 def index_exists(conn, index_name: str) -> bool:
     """التحقق من وجود فهرس في قاعدة البيانات"""
     result = conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (index_name,)).fetchone()
@@ -2139,6 +2474,29 @@ def foreign_key_exists(conn, table: str, column: str, ref_table: str) -> bool:
     except:
         return False
 
+def _dedupe_request_documents(conn):
+    """حذف صفوف المستندات المكررة لنفس (request_id, doc_type).
+
+    يتم الاحتفاظ بالصف الذي يحتوي على ملف مرفوع (الأحدث رفعاً) وإلا الأقدم.
+    عدادات مخزن المحتوى للصفوف المحذوفة تُنقص في نفس المعاملة، والملفات القديمة (قبل المخزن) لا تُحذف من القرص
+    لأن الصفوف المكررة قد تشير لنفس المسار.
+    العودة: (عدد الصفوف المحذوفة، بصمات تُحذف ملفاتها بعد commit عبر delete_released_files)
+    """
+    ids = [row['id'] for row in conn.execute("""
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY request_id, doc_type
+                ORDER BY (file_path IS NULL), uploaded_at DESC, id
+            ) AS rn
+            FROM documents
+        ) WHERE rn > 1
+    """).fetchall()]
+    if not ids:
+        return 0, []
+    released = release_document_files(conn, ids) if table_exists(conn, 'blobs') else {"blobs": []}
+    conn.execute(f"DELETE FROM documents WHERE id IN ({','.join('?' * len(ids))})", ids)
+    return len(ids), released["blobs"]
+
 def verify_and_auto_migrate_schema():
     """
     التحقق الشامل من توافقية قاعدة البيانات وإنشاء العناصر المفقودة تلقائياً
@@ -2148,6 +2506,7 @@ def verify_and_auto_migrate_schema():
     try:
         current_version = get_current_schema_version()
         migration_log = []
+        released_blobs = []
         
         with get_conn() as conn:
             conn.row_factory = sqlite3.Row
@@ -2223,6 +2582,7 @@ def verify_and_auto_migrate_schema():
                     uploaded_at TEXT, 
                     is_video_allowed INTEGER DEFAULT 0, 
                     updated_at TEXT, 
+                    content_hash TEXT, 
                     FOREIGN KEY (request_id) REFERENCES requests(id)
                 )""",
                 'document_types': """CREATE TABLE IF NOT EXISTS document_types (
@@ -2296,12 +2656,56 @@ def verify_and_auto_migrate_schema():
                     updated_at TEXT NOT NULL,
                     UNIQUE(role_name, status_name),
                     FOREIGN KEY (status_name) REFERENCES request_statuses(name) ON DELETE CASCADE
+                )""",
+                'cache_versions': """CREATE TABLE IF NOT EXISTS cache_versions (
+                    scope TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    updated_at TEXT
+                )""",
+                'request_stats_daily': """CREATE TABLE IF NOT EXISTS request_stats_daily (
+                    day TEXT NOT NULL,
+                    sector TEXT NOT NULL DEFAULT '',
+                    governorate TEXT NOT NULL DEFAULT '',
+                    service_id INTEGER NOT NULL,
+                    hospital_type TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT '',
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, sector, governorate, service_id, hospital_type, status)
+                )""",
+                'document_media': """CREATE TABLE IF NOT EXISTS document_media (
+                    content_hash TEXT PRIMARY KEY,
+                    kind TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    container TEXT,
+                    duration REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    video_codec TEXT,
+                    audio_codec TEXT,
+                    bit_rate INTEGER,
+                    poster_path TEXT,
+                    rendition_path TEXT,
+                    rendition_size INTEGER,
+                    page_count INTEGER,
+                    byte_size INTEGER,
+                    text_fingerprint TEXT,
+                    error TEXT,
+                    updated_at TEXT
+                )""",
+                'blobs': """CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    ref_count INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT
                 )"""
             }
             
+            created_tables = []
             for table_name, create_sql in required_tables.items():
                 if not table_exists(conn, table_name):
                     conn.execute(create_sql)
+                    created_tables.append(table_name)
                     migration_log.append(f"✅ تم إنشاء جدول {table_name}")
             
             # ==== الخطوة 3: إضافة الأعمدة المفقودة بشكل آمن ====
@@ -2316,13 +2720,18 @@ def verify_and_auto_migrate_schema():
                 ],
                 'requests': [
                     ('sector', 'TEXT'), ('governorate', 'TEXT'), ('updated_at', 'TEXT'),
-                    ('deleted_at', 'TEXT'), ('closed_at', 'TEXT'), ('admin_note', 'TEXT')
+                    ('deleted_at', 'TEXT'), ('closed_at', 'TEXT'), ('admin_note', 'TEXT'),
+                    ('docs_config_stamp', 'TEXT')
                 ],
                 'documents': [
                     ('updated_at', 'TEXT'), ('is_video_allowed', 'INTEGER DEFAULT 0'),
                     ('display_name', 'TEXT'), ('required', 'INTEGER DEFAULT 1'),
                     ('satisfied', 'INTEGER DEFAULT 0'), ('admin_comment', 'TEXT'),
-                    ('uploaded_at', 'TEXT')
+                    ('uploaded_at', 'TEXT'), ('content_hash', 'TEXT')
+                ],
+                'document_media': [
+                    ('kind', 'TEXT'), ('page_count', 'INTEGER'), ('byte_size', 'INTEGER'),
+                    ('text_fingerprint', 'TEXT')
                 ]
             }
             
@@ -2382,9 +2791,12 @@ def verify_and_auto_migrate_schema():
                 ("idx_documents_request_id", "CREATE INDEX IF NOT EXISTS idx_documents_request_id ON documents(request_id)"),
                 ("idx_documents_doc_type", "CREATE INDEX IF NOT EXISTS idx_documents_doc_type ON documents(doc_type)"),
                 ("idx_documents_updated_at", "CREATE INDEX IF NOT EXISTS idx_documents_updated_at ON documents(updated_at)"),
+                ("idx_documents_content_hash", "CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash)"),
                 ("idx_hospitals_sector", "CREATE INDEX IF NOT EXISTS idx_hospitals_sector ON hospitals(sector)"),
                 ("idx_hospitals_governorate", "CREATE INDEX IF NOT EXISTS idx_hospitals_governorate ON hospitals(governorate)"),
-                ("idx_services_active_name", "CREATE INDEX IF NOT EXISTS idx_services_active_name ON services(active, name)")
+                ("idx_services_active_name", "CREATE INDEX IF NOT EXISTS idx_services_active_name ON services(active, name)"),
+                ("idx_audit_log_timestamp", "CREATE INDEX IF NOT EXISTS idx_audit_log_timestamp ON audit_log(timestamp)"),
+                ("idx_activity_log_timestamp", "CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp ON activity_log(timestamp)")
             ]
             
             for idx_name, create_sql in indexes_to_create:
@@ -2394,6 +2806,24 @@ def verify_and_auto_migrate_schema():
                 except Exception as e:
                     migration_log.append(f"⚠️ تحذير في إنشاء فهرس {idx_name}: {e}")
             
+            # فهرس فريد لمستندات الطلب (مطلوب لـ upsert في ensure_request_docs) بعد إزالة التكرار
+            if table_exists(conn, 'documents') and not index_exists(conn, 'idx_documents_request_doc_type'):
+                try:
+                    removed, released_blobs = _dedupe_request_documents(conn)
+                    if removed:
+                        migration_log.append(f"✅ تم حذف {removed} مستند مكرر (نفس الطلب ونوع المستند)")
+                    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_request_doc_type ON documents(request_id, doc_type)")
+                except Exception as e:
+                    migration_log.append(f"⚠️ تحذير في إنشاء فهرس idx_documents_request_doc_type: {e}")
+            
+            # تعبئة جدول تجميع الإحصائيات عند إنشائه لأول مرة (بعد إضافة أعمدة الطلبات المفقودة)
+            if 'request_stats_daily' in created_tables:
+                try:
+                    rebuild_request_stats_daily(conn)
+                    migration_log.append("✅ تم بناء جدول request_stats_daily من الطلبات الحالية")
+                except Exception as e:
+                    migration_log.append(f"⚠️ فشل بناء جدول request_stats_daily: {e}")
+            
             # ==== الخطوة 6: التحقق من البيانات الافتراضية وإضافتها إذا لزم الأمر ====
             # التحقق من admins
             if table_exists(conn, 'admins'):
@@ -2486,7 +2916,11 @@ def verify_and_auto_migrate_schema():
                         migration_log.append(f"⚠️ فشل إضافة صلاحيات الحالات: {e}")
             
             # ==== الخطوة 7: الحفظ والتحديث ====
+            bump_cache_versions(conn, ["schema"])
             conn.commit()
+            invalidate_cache_tags(["schema"])
+            if released_blobs:
+                delete_released_files({"blobs": released_blobs, "legacy": []})
             
             # تحديث إصدار Schema
             if current_version < DB_SCHEMA_VERSION:
@@ -2515,16 +2949,26 @@ def run_migrations():
         print(f"⚠️ خطأ في run_migrations (سيتم المتابعة): {e}")
         return [f"⚠️ خطأ: {e}"]
 
-def run_ddl():
+def run_ddl(full: bool = False):
     """
     ✅ تُستدعى مرة واحدة عند بدء التطبيق
     ✅ تتحقق من توافقية قاعدة البيانات وتنشئ العناصر المفقودة تلقائياً
     ✅ لا تحذف أو تعدل أي بيانات قديمة
+    ✅ مسار سريع: إذا كان الإصدار والبصمة المخزنة مطابقين تعود فوراً بدون التحقق الكامل
+       (التحقق الكامل متاح دائماً عبر: python db_maintenance.py verify-schema)
+    العودة: سجل الترحيل، أو [] عند استخدام المسار السريع
     """
     try:
-        run_migrations()
+        if not full and schema_is_current():
+            return []
+        migration_log = run_migrations()
+        ensure_notifications_table()
+        if not any(str(entry).startswith("❌") for entry in migration_log):
+            record_schema_fingerprint()
+        return migration_log
     except Exception as e:
         print(f"⚠️ خطأ في run_ddl: {e}")
+        return [f"⚠️ خطأ: {e}"]
 
 # --- إضافة جديدة: دالة تسجيل النشاط ---
 def log_activity(action: str, details: str = ""):
@@ -2567,12 +3011,7 @@ def login_ui():
             st.session_state.login_attempts = 0
             st.session_state.lockout_until = None
     
-    banner_path = next((p for p in [Path("static/banner.png"), Path("static/banner.jpg")] if p.exists()), None)
-    
-    if banner_path:
-        with open(banner_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode()
-        st.markdown(f"<div style='text-align: center;'><img src='data:image/png;base64,{encoded_string}' class='banner-image'></div>", unsafe_allow_html=True)
+    render_banner()
     
     st.markdown(f"<div class='login-header'><h1>{APP_TITLE}</h1></div>", unsafe_allow_html=True)
     
@@ -2638,13 +3077,11 @@ def login_ui():
 # ---------------------------- صفحات المستشفى ---------------------------- #
 def hospital_home():
     user = st.session_state.user
-    logo_path = Path("static/logo.png")
 
     menu_items = ["🏠 الصفحة الرئيسية", "📝 تقديم طلب جديد", "📂 طلباتي", "📥 ملفات للتنزيل", "🔑 تغيير كلمة المرور", "🚪 تسجيل الخروج"]
 
     with st.sidebar:
-        if logo_path.exists():
-            st.image(str(logo_path), width=80)
+        render_logo()
         st.markdown(f"### أهلاً بكِ")
         st.markdown(f"**{user['name']}**")
         st.markdown("---")
@@ -2757,9 +3194,9 @@ def hospital_dashboard_ui(user: dict):
             except Exception as e:
                 st.error(f"حدث خطأ: {e}")
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL)
 def get_active_services():
-    rows = cached_query("SELECT id, name FROM services WHERE active=1 ORDER BY name", (), one=False, tag="services_active")
+    rows = cached_query("SELECT id, name FROM services WHERE active=1 ORDER BY name", (), one=False, tag="services")
     return [dict(row) for row in rows]
 
 
@@ -2810,37 +3247,39 @@ def hospital_new_request_ui(user: dict):
             # Create a cursor to interact with the database
             cur = conn.cursor()
             # Check for the existence of columns before insertion
-            try:
-                cur.execute("SELECT governorate FROM requests LIMIT 1")
+            if get_schema_capabilities().has_column("requests", "governorate"):
                 cur.execute("""
                     INSERT INTO requests (hospital_id, service_id, age_category, status, sector, governorate, created_at)
                     VALUES (?,?,?,?,?,?,?)
                 """, (user["id"], service_id, age_category, "طلب غير مرسل", hospital_sector_value, hospital_governorate_value, datetime.now().isoformat()))
-            except sqlite3.OperationalError:
+            else:
                 # If columns do not exist, use only the basic columns
                 cur.execute("""
                     INSERT INTO requests (hospital_id, service_id, age_category, status, created_at)
                     VALUES (?,?,?,?,?)
                 """, (user["id"], service_id, age_category, "طلب غير مرسل", datetime.now().isoformat()))
             req_id = cur.lastrowid
+            update_request_stats(conn, req_id, 1)
             conn.commit()
 
         ensure_request_docs(req_id, user["type"])  # تغيير hospital_type إلى type
+        invalidate_cache_tags(["requests_count", "requests_stats"])
         st.success("تم إنشاء الطلب. يمكنك الآن رفع المستندات.")
         st.session_state["active_request_id"] = req_id
         st.session_state[f"editing_request_{req_id}"] = True 
         # إرسال إشعارات ثابتة مرة واحدة لكل حدث إنشاء طلب
         try:
-            send_notification_once(f"req_created:{req_id}",
-                                   user_id=None, user_role='admin', title='تم إنشاء طلب جديد',
-                                   message=f'تم إنشاء طلب رقم {req_id} بواسطة المستشفى {user.get("name") or user.get("username")}', entity_type='request', entity_id=req_id, sector=hospital_sector_value)
-            send_notification_once(f"req_created:{req_id}",
-                                   user_id=None, user_role='reviewer_general', title='طلب جديد للمراجعة',
-                                   message=f'طلب رقم {req_id} بحاجة لمراجعة', entity_type='request', entity_id=req_id, sector=hospital_sector_value)
+            audiences = [
+                {'user_role': 'admin', 'title': 'تم إنشاء طلب جديد',
+                 'message': f'تم إنشاء طلب رقم {req_id} بواسطة المستشفى {user.get("name") or user.get("username")}'},
+                {'user_role': 'reviewer_general', 'title': 'طلب جديد للمراجعة',
+                 'message': f'طلب رقم {req_id} بحاجة لمراجعة'},
+            ]
             if hospital_sector_value:
-                send_notification_once(f"req_created:{req_id}",
-                                       user_id=None, user_role='reviewer_sector', title='طلب جديد في قطاعك',
-                                       message=f'طلب رقم {req_id} في قطاع {hospital_sector_value}', entity_type='request', entity_id=req_id, sector=hospital_sector_value)
+                audiences.append({'user_role': 'reviewer_sector', 'title': 'طلب جديد في قطاعك',
+                                  'message': f'طلب رقم {req_id} في قطاع {hospital_sector_value}'})
+            send_notifications(f"req_created:{req_id}", audiences,
+                               entity_type='request', entity_id=req_id, sector=hospital_sector_value)
         except Exception:
             pass
         st.rerun()
@@ -2921,55 +3360,36 @@ def documents_upload_ui(request_id: int, user: dict, is_active_edit: bool = Fals
                     else:
                         st.error("❌ نوع الملف غير مسموح")
 
+            # رفع على دفعات للفيديو الكبير: انقطاع الاتصال يكلف دفعة واحدة فقط
+            if (video_only or is_video_allowed_flag) and file_server.available and _file_server_base_url():
+                with st.expander("📶 رفع قابل للاستكمال (للملفات الكبيرة)"):
+                    render_resumable_uploader(doc, allowed_types)
+                    if st.button("✅ إنهاء الرفع", key=f"finish_resumable_{request_id}_{doc['id']}", use_container_width=True):
+                        if finalize_resumable_upload(request_id, doc, allowed_types):
+                            st.success("✅ تم رفع الملف بنجاح")
+                            st.rerun()
+
         with cols[2]:
             # عرض زر التنزيل بناءً على البيانات المحدثة
-            if doc.get('file_path') and doc.get('satisfied'):
-                try:
-                    file_path_obj = Path(doc['file_path'])
-                    if file_path_obj.exists() and file_path_obj.stat().st_size > 0:
-                        with open(file_path_obj, "rb") as f:
-                            file_data = f.read()
-                        
-                        file_ext = file_path_obj.suffix.lower()
-                        mime_type = "application/pdf" if file_ext == '.pdf' else "video/mp4" if file_ext in ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm'] else "application/octet-stream"
-                        
-                        st.download_button(
-                            "📥 تنزيل",
-                            data=file_data,
-                            file_name=file_path_obj.name,
-                            mime=mime_type,
-                            key=f"dl_{request_id}_{doc['id']}",
-                            use_container_width=True
-                        )
-                    else:
-                        st.caption("— ملف غير موجود")
-                except Exception:
-                    st.caption("— خطأ")
-            else:
-                st.caption("— لم يتم الرفع")
+            render_file_downloader(doc, key_prefix=f"dl_{request_id}")
             
 
         with cols[3]:
             if doc.get("file_path") and doc.get("satisfied"):
                 delete_key = f"del_{request_id}_{doc['id']}"
                 if st.button("🗑️ حذف", key=delete_key, type="secondary"):
-                    # حذف الملف من القرص
-                    file_path = doc.get("file_path")
-                    if file_path and os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                        except Exception as e:
-                            print(f"خطأ في حذف الملف: {e}")
-                    
-                    # تحديث قاعدة البيانات
+                    # تحديث قاعدة البيانات (تحرير الملف من المخزن)
                     now_iso = datetime.now().isoformat()
                     with get_conn() as conn:
+                        released = release_document_files(conn, [doc["id"]])
                         conn.execute(
                             "UPDATE documents SET file_name=NULL, file_path=NULL, satisfied=0, uploaded_at=NULL, updated_at=? WHERE id=?", 
                             (now_iso, doc["id"])
                         )
                         conn.execute("UPDATE requests SET updated_at=? WHERE id=?", (now_iso, request_id))
                         conn.commit()
+                    # حذف الملف من القرص إذا لم يعد مستخدماً في طلب آخر
+                    delete_released_files(released)
                     
                     # تنظيف session state
                     keys_to_clean = [k for k in list(st.session_state.keys()) if f"up_{request_id}_{doc['id']}" in str(k) or "processed_" in str(k)]
@@ -3011,8 +3431,11 @@ def documents_upload_ui(request_id: int, user: dict, is_active_edit: bool = Fals
                 with get_conn() as conn:
                     statuses = get_request_statuses()
                     initial_status = statuses[0] if statuses else "جاري دراسة الطلب ومراجعة الأوراق"
+                    update_request_stats(conn, request_id, -1)
                     conn.execute("UPDATE requests SET status=?, updated_at=? WHERE id=?", (initial_status, datetime.now().isoformat(), request_id))
+                    update_request_stats(conn, request_id, 1)
                     conn.commit()
+                invalidate_cache_tags(["requests_count", "requests_stats"])
                 
                 log_activity("تقديم طلب مكتمل", f"طلب رقم: {request_id}")
                 
@@ -3027,9 +3450,120 @@ def documents_upload_ui(request_id: int, user: dict, is_active_edit: bool = Fals
         elif not all_required_uploaded:
             st.info("⚠️ يرجى رفع جميع المستندات المطلوبة (🔴) لتفعيل زر 'إرسال الطلب'. المستندات الاختيارية (🟡) غير ملزمة.")
 
+# ---------------------------- مخزن الملفات بحسب المحتوى ---------------------------- #
+def release_document_files(conn, doc_ids):
+    """تحرير ملفات المستندات المحددة داخل معاملة المستدعي (إنقاص عدادات المخزن).
+
+    العودة: ما يجب حذفه من القرص بعد commit عبر delete_released_files.
+    """
+    released = {"blobs": [], "legacy": []}
+    doc_ids = [int(i) for i in doc_ids]
+    if not doc_ids:
+        return released
+    placeholders = ",".join("?" * len(doc_ids))
+    rows = conn.execute(f"SELECT content_hash, file_path FROM documents WHERE id IN ({placeholders}) AND file_path IS NOT NULL",
+                        doc_ids).fetchall()
+    for row in rows:
+        if row['content_hash']:
+            if blob_store.release(conn, row['content_hash']):
+                released["blobs"].append(row['content_hash'])
+        elif not blob_store.contains(row['file_path']):
+            # ملف قديم (قبل مخزن المحتوى) خاص بهذا الطلب فقط
+            released["legacy"].append(row['file_path'])
+    conn.execute(f"UPDATE documents SET content_hash=NULL WHERE id IN ({placeholders})", doc_ids)
+    return released
+
+def delete_released_files(released):
+    """حذف الملفات التي لم يعد أي مستند يشير إليها. العودة: (عدد المحذوف، عدد الفشل)"""
+    deleted, failed = 0, 0
+    if released["blobs"]:
+        with get_conn() as conn:
+            deleted += blob_store.purge(conn, released["blobs"])
+            purge_document_media(conn, released["blobs"])
+            conn.commit()
+    for path in released["legacy"]:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+                deleted += 1
+            except Exception as e:
+                failed += 1
+                print(f"خطأ في حذف الملف: {e}")
+    return deleted, failed
+
+def migrate_documents_to_blob_store():
+    """نقل ملفات المستندات القديمة (مسار لكل طلب) إلى مخزن المحتوى. العودة: (عدد المستندات، عدد الملفات المحذوفة)"""
+    with get_conn() as conn:
+        rows = conn.execute("SELECT id, file_path FROM documents WHERE file_path IS NOT NULL AND content_hash IS NULL").fetchall()
+    migrated, removed = 0, 0
+    for row in rows:
+        old_path = row['file_path']
+        if blob_store.contains(old_path) or not os.path.isfile(old_path):
+            continue
+        with open(old_path, "rb") as f:
+            staged = blob_store.stage(f, Path(old_path).suffix)
+        with get_conn() as conn:
+            dest_path = blob_store.acquire(conn, staged)
+            conn.execute("UPDATE documents SET file_path=?, content_hash=? WHERE id=?", (str(dest_path), staged.digest, row['id']))
+            conn.commit()
+        migrated += 1
+        removed += delete_released_files({"blobs": [], "legacy": [old_path]})[0]
+    return migrated, removed
+
+def rebuild_blob_refcounts():
+    """إعادة حساب عدادات مخزن المحتوى من جدول المستندات وحذف الملفات غير المستخدمة"""
+    with get_conn() as conn:
+        blob_count, orphans = blob_store.rebuild_refcounts(conn)
+        conn.commit()
+        removed = blob_store.purge(conn, orphans)
+        conn.commit()
+    return blob_count, removed
+
+def record_uploaded_document(staged, file_name: str, request_id: int, doc_dict: dict):
+    """نشر ملف مكتوب مؤقتاً في مخزن المحتوى وتحديث بيانات المستند وإرسال الإشعارات.
+
+    مشتركة بين الرفع العادي (st.file_uploader) والرفع القابل للاستكمال بعد تجميع الدفعات.
+    """
+    # تحديث قاعدة البيانات بأمان: نشر الملف وزيادة عداده وتحرير الملف السابق في نفس المعاملة
+    now_iso = datetime.now().isoformat()
+    with get_conn() as conn:
+        try:
+            dest_path = blob_store.acquire(conn, staged)
+            released = release_document_files(conn, [doc_dict["id"]])
+        except Exception:
+            conn.rollback()
+            blob_store.discard(staged)
+            raise
+        conn.execute(
+            "UPDATE documents SET file_name=?, file_path=?, content_hash=?, uploaded_at=?, satisfied=1, updated_at=? WHERE id=?",
+            (file_name, str(dest_path), staged.digest, now_iso, now_iso, doc_dict["id"])
+        )
+        conn.execute("UPDATE requests SET updated_at=? WHERE id=?", (now_iso, request_id))
+        r = conn.execute('SELECT sector FROM requests WHERE id=?', (request_id,)).fetchone()
+        request_sector = r['sector'] if r else None
+        conn.commit()
+    delete_released_files(released)
+    schedule_media_processing(staged.digest, dest_path)
+
+    # إشعار عند إضافة/رفع مستند (مرّة واحدة لكل حدث ولكل دور)
+    try:
+        doc_id = doc_dict.get('id') if isinstance(doc_dict, dict) else None
+        audiences = [
+            {'user_role': 'admin', 'title': 'تم إضافة مستند'},
+            {'user_role': 'reviewer_general', 'title': 'مستند جديد لمراجعة'},
+        ]
+        # إشعار لمراجع القطاع إن وُجِد قطاع
+        if request_sector:
+            audiences.append({'user_role': 'reviewer_sector', 'title': 'مستند داخل قطاعك', 'sector': request_sector,
+                              'message': f'تم رفع مستند للطلب رقم {request_id} في قطاع {request_sector}'})
+        send_notifications(f"doc_uploaded:{request_id}:{doc_id}", audiences,
+                           message=f'تم رفع مستند للطلب رقم {request_id}', entity_type='document', entity_id=doc_id)
+    except Exception:
+        pass
+
 # ... (دالة save_uploaded_file كما هي) ...
 def save_uploaded_file(file, user: dict, request_id: int, doc_row):
-    """حفظ ملف مرفوع من قبل المستخدم - محسّن بالكامل مع كتابة متدفقة (chunked) لدعم الفيديو الكبير."""
+    """حفظ ملف مرفوع من قبل المستخدم - كتابة متدفقة (chunked) ذرية إلى مخزن المحتوى لدعم الفيديو الكبير."""
     if file is None:
         return False
 
@@ -3048,103 +3582,33 @@ def save_uploaded_file(file, user: dict, request_id: int, doc_row):
     try:
         doc_dict = dict(doc_row) if hasattr(doc_row, 'keys') else doc_row
 
-        # إعداد مسار الحفظ
-        hospital_id_str = str(user["id"])
-        safe_request_id = str(int(request_id))
-        dest_dir = STORAGE_DIR / hospital_id_str / safe_request_id
-        dest_dir.mkdir(parents=True, exist_ok=True)
-
-        # تحديد امتداد الملف وآمن الاسم
+        # تحديد امتداد الملف وآمن الاسم (الاسم يُحفظ في المستند، والملف نفسه في مخزن المحتوى)
         file_ext = Path(file.name).suffix.lower() or '.pdf'
         safe_doc_type = safe_filename(doc_dict.get('doc_type') or file.name)[:50]
         fn = f"{safe_doc_type}{file_ext}"
-        dest_path = dest_dir / fn
-
-        # حذف الملف القديم إن وجد مع معالجة الأخطاء
-        if dest_path.exists():
-            try:
-                dest_path.unlink()
-                time.sleep(0.05)
-            except Exception as e:
-                # حاول تجاوز الخطأ واستمر
-                print(f"تحذير: لم يتم حذف الملف القديم: {e}")
 
-        # حفظ الملف بشكل متدفق لتقليل استهلاك الذاكرة (يدعم ملفات الفيديو الكبيرة)
+        # كتابة متدفقة إلى ملف مؤقت مع حساب البصمة والحجم في نفس المرور ثم fsync (يدعم ملفات الفيديو الكبيرة)
+        # بايتات UploadedFile تُكتب كشرائح memoryview من مخزنه الداخلي بدون نسخ، والنشر لاحقاً بـ os.replace ذري
+        staged = None
         try:
-            # تأكد أن مؤشر الملف عند البداية
             try:
                 file.seek(0)
             except Exception:
                 pass
-
-            chunk_size = 4 * 1024 * 1024  # 4MB chunks
-            with open(dest_path, "wb") as out_f:
-                while True:
-                    chunk = file.read(chunk_size)
-                    if not chunk:
-                        break
-                    out_f.write(chunk)
+            staged = blob_store.stage(file, file_ext)
         except Exception as e:
-            # حذف ملف جزئي إن تم انشاؤه
-            try:
-                if dest_path.exists():
-                    dest_path.unlink()
-            except Exception:
-                pass
+            blob_store.discard(staged)
             st.error("❌ حدث خطأ أثناء حفظ الملف. يرجى المحاولة مرة أخرى.")
             print(f"خطأ في كتابة الملف: {e}")
             return False
 
-        # التحقق من الحفظ والحجم الفعلي
-        if not dest_path.exists():
-            st.error("❌ فشل في حفظ الملف على الخادم.")
-            return False
-
-        file_size = dest_path.stat().st_size
+        file_size = staged.size
         if file_size == 0:
-            try:
-                dest_path.unlink()
-            except Exception:
-                pass
+            blob_store.discard(staged)
             st.error("❌ الملف فارغ بعد الحفظ.")
             return False
 
-        # تحديث قاعدة البيانات بأمان
-        now_iso = datetime.now().isoformat()
-        with get_conn() as conn:
-            conn.execute(
-                "UPDATE documents SET file_name=?, file_path=?, uploaded_at=?, satisfied=1, updated_at=? WHERE id=?",
-                (fn, str(dest_path), now_iso, now_iso, doc_dict["id"])
-            )
-            conn.execute("UPDATE requests SET updated_at=? WHERE id=?", (now_iso, request_id))
-            conn.commit()
-
-        try:
-            # إشعار عند إضافة/رفع مستند (مرّة واحدة لكل حدث)
-            try:
-                doc_id = doc_dict.get('id') if isinstance(doc_dict, dict) else None
-                # Use canonical event key for this upload so only one notification is created per upload
-                send_notification_once(f"doc_uploaded:{request_id}:{doc_id}",
-                                       user_id=None, user_role='admin', title='تم إضافة مستند',
-                                       message=f'تم رفع مستند للطلب رقم {request_id}', entity_type='document', entity_id=doc_id)
-                send_notification_once(f"doc_uploaded:{request_id}:{doc_id}",
-                                       user_id=None, user_role='reviewer_general', title='مستند جديد لمراجعة',
-                                       message=f'تم رفع مستند للطلب رقم {request_id}', entity_type='document', entity_id=doc_id)
-                # إشعار لمراجع القطاع إن وُجِد قطاع
-                try:
-                    with get_conn() as nconn:
-                        r = nconn.execute('SELECT sector FROM requests WHERE id=?', (request_id,)).fetchone()
-                        rs = r['sector'] if r else None
-                    if rs:
-                        send_notification_once(f"doc_uploaded:{request_id}:{doc_id}",
-                                               user_id=None, user_role='reviewer_sector', title='مستند داخل قطاعك',
-                                               message=f'تم رفع مستند للطلب رقم {request_id} في قطاع {rs}', entity_type='document', entity_id=doc_id, sector=rs)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-        except Exception:
-            pass
+        record_uploaded_document(staged, fn, request_id, doc_dict)
 
         print(f"تم رفع الملف بنجاح: {fn} ({file_size} bytes)")
         return True
@@ -3156,6 +3620,371 @@ def save_uploaded_file(file, user: dict, request_id: int, doc_row):
         traceback.print_exc()
         return False
 
+# ---------------------------- الرفع القابل للاستكمال ---------------------------- #
+RESUMABLE_UPLOAD_LINK_TTL = 24 * 3600  # الرفع البطيء لملف 200MB قد يستغرق ساعات
+
+def resumable_upload_id(doc_id: int) -> str:
+    """رفع واحد قابل للاستكمال لكل مستند (المتصفح يستكمله إذا اختير نفس الملف مرة أخرى)"""
+    return f"doc_{int(doc_id)}"
+
+def render_resumable_uploader(doc: dict, allowed_types: list, max_size_mb: int = 200):
+    """مكون صغير يرسل الملف على دفعات لخادم الملفات مع إعادة المحاولة والاستكمال بعد انقطاع الاتصال"""
+    token = file_server.sign_upload(resumable_upload_id(doc['id']), max_size=max_size_mb * 1024 * 1024,
+                                    ttl=RESUMABLE_UPLOAD_LINK_TTL)
+    upload_url = f"{_file_server_base_url()}/uploads/{token}"
+    accept = ",".join(f".{ext}" for ext in allowed_types)
+    component_html = f"""
+<div dir="rtl" style="font-family: sans-serif; font-size: 14px;">
+  <input type="file" id="file" accept="{accept}">
+  <progress id="bar" value="0" max="1" style="width: 100%; display: none;"></progress>
+  <div id="msg" style="color: #475569; margin-top: 4px;"></div>
+</div>
+<script>
+const url = {json.dumps(upload_url)};
+const msg = document.getElementById("msg"), bar = document.getElementById("bar");
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+async function call(target, options) {{
+  for (let attempt = 0; ; attempt++) {{
+    try {{
+      const resp = await fetch(target, options);
+      if (resp.ok) return await resp.json();
+      if (resp.status < 500) throw new Error((await resp.json()).error || resp.status);
+    }} catch (e) {{
+      if (e.name !== "TypeError") throw e;  // TypeError = انقطاع الشبكة
+    }}
+    msg.textContent = "⚠️ انقطع الاتصال، إعادة المحاولة...";
+    await sleep(Math.min(30000, 1000 * 2 ** attempt));
+  }}
+}}
+document.getElementById("file").onchange = async (event) => {{
+  const f = event.target.files[0];
+  if (!f) return;
+  const fp = [f.name, f.size, f.lastModified].join(":");
+  try {{
+    let state = await call(url);
+    if (!state || state.fingerprint !== fp || state.size !== f.size) {{
+      const query = "?size=" + f.size + "&name=" + encodeURIComponent(f.name) + "&fp=" + encodeURIComponent(fp);
+      state = await call(url + query, {{method: "POST"}});
+    }} else if (state.received.length) {{
+      msg.textContent = "↻ استكمال رفع سابق...";
+    }}
+    const done = new Set(state.received);
+    bar.style.display = "block";
+    bar.value = done.size / state.chunks;
+    for (let i = 0; i < state.chunks; i++) {{
+      if (done.has(i)) continue;
+      const chunk = f.slice(i * state.chunk_size, Math.min(f.size, (i + 1) * state.chunk_size));
+      await call(url + "/" + i, {{method: "PUT", body: chunk, headers: {{"Content-Type": "application/octet-stream"}}}});
+      done.add(i);
+      bar.value = done.size / state.chunks;
+      msg.textContent = "⏫ " + Math.round(100 * bar.value) + "%";
+    }}
+    msg.textContent = "✅ اكتمل إرسال الملف، اضغط «إنهاء الرفع» لحفظه";
+  }} catch (e) {{
+    msg.textContent = "❌ " + e.message;
+  }}
+}};
+</script>
+"""
+    if hasattr(st, "iframe"):
+        st.iframe(component_html, height=110)
+    else:
+        # إصدارات Streamlit الأقدم
+        import streamlit.components.v1 as components
+        components.html(component_html, height=110)
+
+def finalize_resumable_upload(request_id: int, doc: dict, allowed_types: list) -> bool:
+    """حفظ رفع مكتمل الدفعات كمستند (بنفس مسار save_uploaded_file بعد الكتابة). العودة: True عند النجاح"""
+    upload_id = resumable_upload_id(doc['id'])
+    state = upload_journal.status(upload_id)
+    if state is None:
+        st.warning("لم يبدأ رفع لهذا المستند بعد")
+        return False
+    if not state['complete']:
+        st.info(f"⏳ تم استلام {len(state['received'])} من {state['chunks']} جزء. سيتم الاستكمال تلقائياً بعد عودة الاتصال.")
+        return False
+    if Path(state['name']).suffix.lower().lstrip('.') not in allowed_types:
+        upload_journal.remove(upload_id)
+        st.error("❌ نوع الملف غير مسموح")
+        return False
+    file_ext = Path(state['name']).suffix.lower()
+    fn = f"{safe_filename(doc.get('doc_type') or state['name'])[:50]}{file_ext}"
+    try:
+        # data.part على نفس القرص: يُنقل لمنطقة انتظار المخزن بدون نسخ
+        staged = blob_store.stage_file(upload_journal.data_path(upload_id), file_ext)
+    except Exception as e:
+        st.error("❌ فشل حفظ الملف المرفوع. يرجى المحاولة مرة أخرى.")
+        print(f"خطأ في إنهاء الرفع القابل للاستكمال: {e}")
+        return False
+    try:
+        record_uploaded_document(staged, fn, request_id, doc)
+    except Exception as e:
+        st.error("❌ فشل حفظ الملف المرفوع بسبب خطأ في الخادم.")
+        print(f"خطأ في إنهاء الرفع القابل للاستكمال: {e}")
+        return False
+    finally:
+        upload_journal.remove(upload_id)
+    print(f"تم رفع الملف بنجاح (على دفعات): {fn} ({state['size']} bytes)")
+    return True
+
+# ---------------------------- معالجة الوسائط ---------------------------- #
+MEDIA_FIELDS = ("kind", "status", "container", "duration", "width", "height", "video_codec", "audio_codec", "bit_rate",
+                "poster_path", "rendition_path", "rendition_size", "page_count", "byte_size", "text_fingerprint", "error")
+
+def _save_document_media(content_hash: str, fields: dict):
+    values = {k: fields.get(k) for k in MEDIA_FIELDS}
+    with get_conn() as conn:
+        conn.execute(
+            f"""INSERT INTO document_media (content_hash, {", ".join(MEDIA_FIELDS)}, updated_at)
+                VALUES (?, {", ".join("?" * len(MEDIA_FIELDS))}, ?)
+                ON CONFLICT(content_hash) DO UPDATE SET
+                {", ".join(f"{k}=excluded.{k}" for k in MEDIA_FIELDS)}, updated_at=excluded.updated_at""",
+            (content_hash, *values.values(), datetime.now().isoformat()))
+        conn.commit()
+
+def media_kind(path) -> str | None:
+    """نوع المعالجة الخلفية للملف: 'video' أو 'pdf' أو None"""
+    if not path:
+        return None
+    if is_video(path):
+        return "video"
+    return "pdf" if Path(path).suffix.lower() == ".pdf" else None
+
+def process_document_media(job, content_hash: str, source_path: str):
+    """مهمة خلفية: معالجة الفيديو (الغلاف ونسخة الويب) أو فهرسة PDF (الصفحات والبصمة والصورة المصغرة)
+    ثم تسجيل النتيجة في document_media"""
+    kind = media_kind(source_path)
+    job.update(processed=0, total=1, message="فحص الفيديو" if kind == "video" else "فهرسة PDF")
+    try:
+        if kind == "video":
+            result = process_video(source_path, MEDIA_DIR / content_hash)
+        else:
+            result = index_pdf(source_path, MEDIA_DIR / content_hash)
+    except Exception as e:
+        result = {"status": "failed", "error": str(e)[:500]}
+    result["kind"] = kind
+    _save_document_media(content_hash, result)
+    job.update(processed=1, message=result["status"])
+    return result["status"]
+
+def schedule_media_processing(content_hash: str, path) -> str | None:
+    """جدولة معالجة الملف بعد حفظ المستند (مرة واحدة لكل محتوى). العودة: معرف المهمة أو None"""
+    kind = media_kind(path)
+    if not content_hash or not kind:
+        return None
+    with get_conn() as conn:
+        row = conn.execute("SELECT status FROM document_media WHERE content_hash=?", (content_hash,)).fetchone()
+    # 'unsupported' تعني أن ffprobe لم يكن متوفراً وقتها، و 'partial' أن PDF فُهرس بدون مكتبة PDF:
+    # تُعاد المعالجة بعد تثبيت الأداة
+    if row and (row['status'] == "done"
+                or (row['status'] == "unsupported" and not find_tool("ffprobe"))
+                or (row['status'] == "partial" and not available_backend())):
+        return None
+    _save_document_media(content_hash, {"kind": kind, "status": "pending"})
+    title = "معالجة فيديو" if kind == "video" else "فهرسة PDF"
+    # فهرسة PDF في طابورها الخاص حتى لا تنتظر خلف تحويل فيديو طويل
+    queue = media_jobs if kind == "video" else pdf_jobs
+    return queue.submit("media", f"{title} {Path(path).name[:12]}", process_document_media,
+                        content_hash, str(path), dedupe_key=f"media:{content_hash}")
+
+def wait_document_media(job_id: str, timeout=None):
+    """انتظار مهمة معالجة من أي من طابوري الوسائط (لأوامر الصيانة والاختبارات)"""
+    return media_jobs.wait(job_id, timeout) or pdf_jobs.wait(job_id, timeout)
+
+def backfill_document_media() -> list:
+    """جدولة معالجة الفيديوهات وملفات PDF المرفوعة قبل تفعيل المعالجة أو التي فشلت سابقاً
+    (ومعها الفيديوهات المرفوعة قبل تثبيت ffmpeg وملفات PDF المفهرسة بدون مكتبة PDF إذا أصبحت الأداة متوفرة).
+    العودة: معرفات المهام"""
+    statuses = ["pending", "failed"] + (["unsupported"] if find_tool("ffprobe") else []) + \
+        (["partial"] if available_backend() else [])
+    with get_conn() as conn:
+        rows = conn.execute(f"""
+            SELECT b.sha256, b.path FROM blobs b
+            LEFT JOIN document_media m ON m.content_hash = b.sha256
+            WHERE m.content_hash IS NULL OR m.status IN ({",".join("?" * len(statuses))})
+        """, statuses).fetchall()
+    job_ids = [schedule_media_processing(r['sha256'], r['path']) for r in rows if os.path.exists(r['path'])]
+    return [job_id for job_id in job_ids if job_id]
+
+def purge_document_media(conn, content_hashes):
+    """حذف ناتج المعالجة لمحتوى لم يعد أي مستند يشير إليه (داخل اتصال المستدعي)"""
+    for content_hash in set(h for h in content_hashes if h):
+        if conn.execute("SELECT 1 FROM blobs WHERE sha256=?", (content_hash,)).fetchone():
+            continue
+        conn.execute("DELETE FROM document_media WHERE content_hash=?", (content_hash,))
+        shutil.rmtree(MEDIA_DIR / content_hash, ignore_errors=True)
+
+def fetch_document_media(docs) -> dict:
+    """بيانات المعالجة لمستندات الصفحة في استعلام واحد: content_hash -> row"""
+    hashes = sorted({d['content_hash'] for d in docs if d['content_hash']})
+    if not hashes:
+        return {}
+    with get_conn() as conn:
+        rows = conn.execute(f"SELECT * FROM document_media WHERE content_hash IN ({','.join('?' * len(hashes))})",
+                            hashes).fetchall()
+    return {r['content_hash']: dict(r) for r in rows}
+
+def _format_duration(seconds) -> str:
+    seconds = int(seconds or 0)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60}:{seconds % 60:02d}"
+
+def _format_size(num_bytes) -> str:
+    num_bytes = num_bytes or 0
+    return f"{num_bytes / (1024 * 1024):.1f} MB" if num_bytes >= 1024 * 1024 else f"{max(1, num_bytes // 1024)} KB"
+
+def render_document_media(doc, media: dict):
+    """معاينة المستند من نتيجة المعالجة الخلفية بدون قراءة الملف الأصلي:
+    الفيديو (الغلاف والمدة ونسخة الويب الصغيرة) و PDF (الصورة المصغرة وعدد الصفحات والحجم)"""
+    row = media.get(doc['content_hash']) if doc['content_hash'] else None
+    kind = media_kind(doc['file_path'])
+    if row is None or not kind:
+        return
+    if row['status'] == "pending":
+        st.caption("⏳ جاري تجهيز معاينة الفيديو..." if kind == "video" else "⏳ جاري فهرسة الملف...")
+        return
+    if row['status'] not in ("done", "partial"):
+        return
+    if kind == "pdf":
+        _render_pdf_summary(row)
+        return
+    details = [f"⏱️ {_format_duration(row['duration'])}"]
+    if row['width'] and row['height']:
+        details.append(f"{row['width']}×{row['height']}")
+    if row['video_codec']:
+        details.append(row['video_codec'])
+    with st.expander(f"🎬 معاينة الفيديو ({' • '.join(details)})"):
+        if row['rendition_path'] and os.path.exists(row['rendition_path']):
+            source = row['rendition_path']
+        elif not needs_rendition(row, Path(doc['file_path']).stat().st_size if os.path.exists(doc['file_path']) else 0):
+            source = doc['file_path']
+        else:
+            source = None
+        has_poster = row['poster_path'] and os.path.exists(row['poster_path'])
+        video_url = file_download_url(source, mime="video/mp4") if source else None
+        if video_url:
+            # رابط خادم الملفات يدعم Range فيبدأ التشغيل بدون تحميل الملف كاملاً
+            st.video(video_url)
+        elif source:
+            # بدون خادم الملفات يقرأ st.video الملف كاملاً في الذاكرة: الغلاف أولاً والتشغيل بعد طلب صريح
+            playing = st.session_state.setdefault("playing_videos", set())
+            if source not in playing:
+                if has_poster:
+                    st.image(row['poster_path'], width=360)
+                if not st.button("▶️ تشغيل الفيديو", key=f"play_{doc['id']}"):
+                    return
+                playing.add(source)
+            st.video(source)
+        elif has_poster:
+            st.image(row['poster_path'], width=360)
+            st.caption("لا تتوفر نسخة ويب لهذا الفيديو، يمكن تنزيل الملف الأصلي")
+
+def _render_pdf_summary(row: dict):
+    details = []
+    if row['page_count']:
+        details.append(f"📄 {row['page_count']} صفحة")
+    if row['byte_size']:
+        details.append(_format_size(row['byte_size']))
+    has_thumbnail = row['poster_path'] and os.path.exists(row['poster_path'])
+    if has_thumbnail:
+        c_thumb, c_info = st.columns([1, 5])
+        # الصورة المصغرة صغيرة (عرض 240px) ومخزنة على القرص، فلا يُقرأ ملف PDF عند كل إعادة تشغيل
+        c_thumb.image(row['poster_path'], width=120)
+        c_info.caption(" • ".join(details))
+    elif details:
+        st.caption(" • ".join(details))
+
+# ---------------------------- تجهيز التنزيل عند الطلب ---------------------------- #
+PREPARED_DOWNLOADS_MAX_BYTES = 100 * 1024 * 1024  # الحد الأقصى لحجم الملفات المجهزة في ذاكرة كل جلسة
+
+def _prepared_downloads():
+    """ذاكرة LRU للملفات المجهزة للتنزيل في الجلسة الحالية: key -> bytes"""
+    from collections import OrderedDict
+    if "prepared_downloads" not in st.session_state:
+        st.session_state["prepared_downloads"] = OrderedDict()
+    return st.session_state["prepared_downloads"]
+
+def get_prepared_download(key):
+    """البيانات المجهزة مسبقاً لهذا المفتاح أو None (المفتاح يتضمن mtime والحجم فلا تُعاد بيانات قديمة)"""
+    prepared = _prepared_downloads()
+    data = prepared.get(key)
+    if data is not None:
+        prepared.move_to_end(key)
+    return data
+
+def prepare_download(key, path) -> bytes:
+    """قراءة الملف وإضافته لذاكرة الجلسة مع إزالة الأقدم استخداماً عند تجاوز الحد الأقصى للحجم.
+
+    الملف الأكبر من الحد نفسه لا يُخزن: تُعاد بياناته لزر تنزيل لمرة واحدة فقط.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    prepared = _prepared_downloads()
+    prepared.pop(key, None)
+    if len(data) > PREPARED_DOWNLOADS_MAX_BYTES:
+        return data
+    prepared[key] = data
+    total = sum(len(v) for v in prepared.values())
+    while total > PREPARED_DOWNLOADS_MAX_BYTES:
+        _, evicted = prepared.popitem(last=False)
+        total -= len(evicted)
+    return data
+
+def export_request_zip(request_id: int, docs) -> tuple:
+    """أرشيف ZIP لمرفقات طلب (مبني على القرص ومخزن حسب updated_at لكل مستند). العودة: (المسار أو None، عدد الملفات)"""
+    entries = []
+    for d in docs:
+        if d['file_path']:
+            arcname = f"{safe_filename(d['doc_type'])[:50]}{Path(d['file_path']).suffix}"
+            entries.append((d['file_path'], arcname, d['updated_at']))
+    # build_cached_archive يحذف الإصدارات السابقة لنفس الطلب فقط، فالمجلد يُنظف حسب العمر حتى لا يكبر بلا حد
+    prune_old_files(ZIP_CACHE_DIR, ZIP_CACHE_MAX_AGE)
+    return build_cached_archive(entries, ZIP_CACHE_DIR, f"request_{request_id}")
+
+def bulk_export_requests(job, from_sql: str, conditions: list, params: list):
+    """مهمة خلفية: أرشيف واحد لمستندات كل الطلبات المطابقة للفلاتر (مجلد لكل طلب).
+
+    تستقبل نفس from_sql والشروط المستخدمة في admin_requests_ui. العودة: مسار الأرشيف أو None.
+    """
+    prune_old_files(BULK_EXPORTS_DIR, BULK_EXPORT_MAX_AGE)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    with get_conn() as conn:
+        docs = conn.execute(f"""
+            SELECT r.id AS request_id, h.name AS hospital_name, d.doc_type, d.file_path
+            FROM {from_sql}
+            JOIN documents d ON d.request_id = r.id AND d.file_path IS NOT NULL
+            {where}
+            ORDER BY r.id, d.id
+        """, params).fetchall()
+    entries = []
+    for d in docs:
+        folder = f"request_{d['request_id']}_{safe_filename(d['hospital_name'])[:40]}"
+        entries.append((d['file_path'], f"{folder}/{safe_filename(d['doc_type'])[:50]}{Path(d['file_path']).suffix}", None))
+    request_count = len({d['request_id'] for d in docs})
+    dest = BULK_EXPORTS_DIR / f"requests_{datetime.now():%Y%m%d_%H%M%S}_{job.id}.zip"
+    files_added = write_archive(entries, dest, job=job, max_workers=4) if entries else 0
+    job.update(message=f"تم تصدير {files_added} ملف من {request_count} طلب")
+    return str(dest) if files_added else None
+
+def render_archive_download(path: Path, file_name: str, key: str):
+    """زر تنزيل أرشيف من القرص: رابط خادم الملفات، أو تجهيز في ذاكرة الجلسة كبديل"""
+    if not path.is_file():
+        # أرشيفات التصدير تُحذف بعد BULK_EXPORT_MAX_AGE، ونتيجة المهمة قد تبقى معروضة بعدها
+        st.caption("— انتهت صلاحية الأرشيف، أعد التصدير")
+        return
+    download_url = file_download_url(path, filename=file_name, mime="application/zip")
+    if download_url:
+        st.link_button("📥 تحميل الملفات", download_url)
+        return
+    # بدون خادم الملفات: القراءة تتم فقط بعد ضغط "تجهيز" (كما في render_file_downloader) لا مع كل إعادة تشغيل
+    stat = path.stat()
+    prepared_key = (str(path), stat.st_mtime_ns, stat.st_size)
+    data = get_prepared_download(prepared_key)
+    if data is None:
+        if not st.button("⏳ تجهيز الأرشيف للتنزيل", key=f"prep_{key}"):
+            return
+        data = prepare_download(prepared_key, path)
+    st.download_button("📥 تحميل الملفات", data=data, file_name=file_name, mime="application/zip", key=key)
+
 def render_file_downloader(doc: sqlite3.Row, key_prefix: str = "dl"):
     """دالة موحدة لعرض زر تنزيل الملف - مبسطة ومحسّنة"""
     if doc["file_path"] and doc["satisfied"]:
@@ -3166,25 +3995,34 @@ def render_file_downloader(doc: sqlite3.Row, key_prefix: str = "dl"):
                 if file_size > 0:
                     # مفتاح بسيط وفريد
                     download_key = f"{key_prefix}_{doc['id']}"
+                    # اسم الملف من المستند (الملف في المخزن مسمى ببصمة محتواه)
+                    download_name = (doc['file_name'] if 'file_name' in doc.keys() else None) or file_path_obj.name
+                    
+                    # رابط خفيف: البايتات تُقرأ على دفعات من خادم الملفات عند الضغط فقط
+                    download_url = file_download_url(file_path_obj, filename=download_name)
+                    if download_url:
+                        st.link_button("📥 تنزيل", download_url, use_container_width=True)
+                        return
                     
                     try:
-                        with open(file_path_obj, "rb") as f:
-                            file_data = f.read()
+                        # بدون خادم الملفات: القراءة تتم فقط بعد ضغط المستخدم على "تجهيز" وتبقى في ذاكرة الجلسة
+                        prepared_key = (str(file_path_obj), file_path_obj.stat().st_mtime_ns, file_size)
+                        file_data = get_prepared_download(prepared_key)
+                        if file_data is None:
+                            if st.button("⏳ تجهيز للتنزيل", key=f"prep_{download_key}", use_container_width=True):
+                                file_data = prepare_download(prepared_key, file_path_obj)
+                            else:
+                                return
                         
                         if file_data:
-                            # تحديد MIME type
-                            file_ext = file_path_obj.suffix.lower()
-                            if file_ext == '.pdf':
-                                mime_type = "application/pdf"
-                            elif file_ext in ['.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm']:
-                                mime_type = "video/mp4"
-                            else:
-                                mime_type = "application/octet-stream"
+                            # تحديد MIME type من الامتداد الفعلي (avi/wmv/mov ليست video/mp4)
+                            import mimetypes
+                            mime_type = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
                             
                             st.download_button(
                                 "📥 تنزيل",
                                 data=file_data, 
-                                file_name=file_path_obj.name, 
+                                file_name=download_name, 
                                 key=download_key,
                                 mime=mime_type,
                                 use_container_width=True
@@ -3205,6 +4043,7 @@ def render_file_downloader(doc: sqlite3.Row, key_prefix: str = "dl"):
         st.caption("— لم يتم الرفع")
 
 def hospital_requests_ui(user: dict):
+    import pandas as pd
     st.markdown("<div class='subheader'>طلباتي</div>", unsafe_allow_html=True)
     try:
         with get_conn() as conn:
@@ -3302,6 +4141,7 @@ def request_details_ui(request_id: int, role: str = "hospital"):
 def display_request_documents_readonly(docs: list):
     """دالة لعرض المستندات في وضع القراءة فقط."""
     st.markdown("##### المستندات")
+    media = fetch_document_media(docs)
     
     # تجميع المستندات حسب النوع
     required_docs = [d for d in docs if d['required'] == 1]
@@ -3327,6 +4167,7 @@ def display_request_documents_readonly(docs: list):
                 st.write(datetime.fromisoformat(d['uploaded_at']).strftime('%Y-%m-%d %H:%M:%S') if d['uploaded_at'] else "—")
             with c5:
                 st.write(d['admin_comment'] or "")
+            render_document_media(d, media)
     
     if optional_docs:
         st.markdown("**🟡 المستندات الاختيارية:**")
@@ -3347,6 +4188,7 @@ def display_request_documents_readonly(docs: list):
                 st.write(datetime.fromisoformat(d['uploaded_at']).strftime('%Y-%m-%d %H:%M:%S') if d['uploaded_at'] else "—")
             with c5:
                 st.write(d['admin_comment'] or "")
+            render_document_media(d, media)
 
     # ... (إجراءات الطلب: حذف نهائي، استرجاع، إغلاق) ...
 
@@ -3365,9 +4207,7 @@ def resources_download_ui():
 # ---------------------------- صفحات الإدارة ---------------------------- #
 def admin_home():
     user = st.session_state.user
-    logo_path = Path("static/logo.png")
-    if logo_path.exists():
-        st.sidebar.image(str(logo_path), width=80)
+    render_logo()
     st.markdown("<div class='admin-dashboard-header'><h2>لوحة التحكم الإدارية</h2></div>", unsafe_allow_html=True)
     
     admin_menu = {
@@ -3421,6 +4261,7 @@ def admin_home():
         menu["functions"][selected_index]()
 
 def admin_hospitals_ui():
+    import pandas as pd
     user = st.session_state.user
     
     # التحقق من صلاحية إدارة المستشفيات
@@ -3527,13 +4368,13 @@ def admin_hospitals_ui():
                             conn.commit()
                             # إنشاء إشعار عند إضافة مستشفى جديد (مرة واحدة)
                             try:
-                                send_notification_once(f"hospital_created:{new_hospital_id}",
-                                                       user_id=None, user_role='admin', title='تمت إضافة مستشفى',
-                                                       message=f'تمت إضافة المستشفى {name} (اسم مستخدم: {username})', entity_type='hospital', entity_id=new_hospital_id, sector=sector)
+                                audiences = [{'user_role': 'admin', 'title': 'تمت إضافة مستشفى',
+                                              'message': f'تمت إضافة المستشفى {name} (اسم مستخدم: {username})'}]
                                 if sector:
-                                    send_notification_once(f"hospital_created:{new_hospital_id}",
-                                                           user_id=None, user_role='reviewer_sector', title='مستشفى جديد في قطاعك',
-                                                           message=f'أُضيفت مستشفى {name} إلى قطاع {sector}', entity_type='hospital', entity_id=new_hospital_id, sector=sector)
+                                    audiences.append({'user_role': 'reviewer_sector', 'title': 'مستشفى جديد في قطاعك',
+                                                      'message': f'أُضيفت مستشفى {name} إلى قطاع {sector}'})
+                                send_notifications(f"hospital_created:{new_hospital_id}", audiences,
+                                                   entity_type='hospital', entity_id=new_hospital_id, sector=sector)
                             except Exception:
                                 pass
                         st.success(f"تمت الإضافة. اسم المستخدم: {username}")
@@ -3633,8 +4474,10 @@ def admin_hospitals_ui():
                             if st.button("✅ نعم، تأكيد الحذف", type="primary", key="confirm_delete"):
                                 try:
                                     with get_conn() as conn:
+                                        update_hospital_request_stats(conn, st.session_state['delete_hospital_id'], -1)
                                         conn.execute("DELETE FROM hospitals WHERE id = ?", (st.session_state['delete_hospital_id'],))
                                         conn.commit()
+                                    invalidate_cache_tags(["requests_count", "requests_stats"])
                                     
                                     st.success(f"✅ تم حذف المستشفى '{st.session_state['delete_hospital_name']}' بنجاح")
                                     # مسح بيانات الحذف من session state
@@ -3688,6 +4531,7 @@ def _callback_update_request_status(request_id: int, new_status: str, note: str,
             
             # تحديد ما إذا كانت الحالة الجديدة نهائية
             new_status_is_final = is_final_status(new_status)
+            update_request_stats(conn, request_id, -1)
             
             if new_status_is_final:
                 # إذا كانت الحالة الجديدة نهائية، قم بتعيين closed_at
@@ -3704,31 +4548,31 @@ def _callback_update_request_status(request_id: int, new_status: str, note: str,
                     # إذا لم تكن أي من الحالتين نهائية
                     conn.execute("UPDATE requests SET status=?, admin_note=?, updated_at=? WHERE id=?", 
                                  (new_status, note, updated_at, request_id))
+            update_request_stats(conn, request_id, 1)
             conn.commit()
+            invalidate_cache_tags(["requests_count", "requests_stats"])
             # بعد التحديث، إنشاء إشعارات مناسبة
             try:
                 # جلب معلومات الطلب لإرسال إشعار للمستشفى المعنية
-                with get_conn() as nconn:
-                    req = nconn.execute("SELECT hospital_id, sector FROM requests WHERE id=?", (request_id,)).fetchone()
-                    hospital_id = req['hospital_id'] if req else None
-                    sector = req['sector'] if req and 'sector' in req.keys() else None
+                req = conn.execute("SELECT hospital_id, sector FROM requests WHERE id=?", (request_id,)).fetchone()
+                hospital_id = req['hospital_id'] if req else None
+                sector = req['sector'] if req and 'sector' in req.keys() else None
 
+                audiences = []
                 if hospital_id:
-                    send_notification_once(f"req_status:{request_id}:{new_status}",
-                                           user_id=hospital_id, user_role='hospital', title='تحديث حالة الطلب',
-                                           message=f'تم تحديث حالة طلبك رقم {request_id} إلى: {new_status}', entity_type='request', entity_id=request_id, sector=sector)
+                    audiences.append({'user_id': hospital_id, 'user_role': 'hospital', 'title': 'تحديث حالة الطلب',
+                                      'message': f'تم تحديث حالة طلبك رقم {request_id} إلى: {new_status}'})
 
                 # إعلام المراجعين والإدمن (كل إشعار مرسل مرة واحدة لكل حدث)
-                send_notification_once(f"req_status:{request_id}:{new_status}",
-                                       user_id=None, user_role='admin', title='تحديث حالة طلب',
-                                       message=f'تم تحديث حالة طلب رقم {request_id} إلى: {new_status}', entity_type='request', entity_id=request_id, sector=sector)
-                send_notification_once(f"req_status:{request_id}:{new_status}",
-                                       user_id=None, user_role='reviewer_general', title='تحديث حالة طلب',
-                                       message=f'تم تحديث حالة طلب رقم {request_id}', entity_type='request', entity_id=request_id, sector=sector)
+                audiences.append({'user_role': 'admin', 'title': 'تحديث حالة طلب',
+                                  'message': f'تم تحديث حالة طلب رقم {request_id} إلى: {new_status}'})
+                audiences.append({'user_role': 'reviewer_general', 'title': 'تحديث حالة طلب',
+                                  'message': f'تم تحديث حالة طلب رقم {request_id}'})
                 if sector:
-                    send_notification_once(f"req_status:{request_id}:{new_status}",
-                                           user_id=None, user_role='reviewer_sector', title='تحديث حالة لقطاعك',
-                                           message=f'طلب رقم {request_id} تم تحديثه في قطاع {sector}', entity_type='request', entity_id=request_id, sector=sector)
+                    audiences.append({'user_role': 'reviewer_sector', 'title': 'تحديث حالة لقطاعك',
+                                      'message': f'طلب رقم {request_id} تم تحديثه في قطاع {sector}'})
+                send_notifications(f"req_status:{request_id}:{new_status}", audiences,
+                                   entity_type='request', entity_id=request_id, sector=sector)
             except Exception:
                 pass
 
@@ -3739,17 +4583,15 @@ def _callback_update_request_status(request_id: int, new_status: str, note: str,
 
 def _callback_delete_document_admin(doc_id: int, file_path: str):
     """Callback لحذف مستند من قبل الأدمن."""
-    if file_path and os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except Exception as e:
-            st.warning(f"تعذر حذف الملف من القرص: {e}")
-    
     try:
         with get_conn() as conn:
             now_iso = datetime.now().isoformat()
+            released = release_document_files(conn, [doc_id])
             conn.execute("UPDATE documents SET file_name=NULL, file_path=NULL, satisfied=0, uploaded_at=NULL, updated_at=? WHERE id=?", (now_iso, doc_id))
             conn.commit()
+        _, files_failed = delete_released_files(released)
+        if files_failed:
+            st.warning("تعذر حذف الملف من القرص")
         st.success("✅ تم حذف الملف")
     except Exception as e:
         st.error(f"فشل تحديث قاعدة البيانات: {e}")
@@ -3765,20 +4607,16 @@ def _callback_soft_delete_request(request_id: int, docs: list):
         st.error("❌ ليس لديك صلاحية لتنفيذ هذا الإجراء. فقط الأدمن والمراجع العام مصرحون.")
         return
     
-    files_deleted, files_failed = 0, 0
-    for d in docs:
-        if d['file_path'] and os.path.exists(d['file_path']):
-            try:
-                os.remove(d['file_path'])
-                files_deleted += 1
-            except Exception:
-                files_failed += 1
-    
     try:
         with get_conn() as conn:
             now_iso = datetime.now().isoformat()
+            update_request_stats(conn, request_id, -1)
+            released = release_document_files(conn, [d['id'] for d in docs])
             conn.execute("UPDATE requests SET deleted_at=?, updated_at=? WHERE id=?", (now_iso, now_iso, request_id))
             conn.commit()
+        # الملفات المشتركة مع طلبات أخرى تبقى على القرص
+        files_deleted, files_failed = delete_released_files(released)
+        invalidate_cache_tags(["requests_count", "requests_stats"])
         
         log_activity("حذف طلب نهائي", f"طلب رقم: {request_id}")
         msg = "تم الحذف النهائي."
@@ -3862,14 +4700,17 @@ def edit_hospital_ui(hospital_id: int):
                 params.append(hospital_id)
                 
                 with get_conn() as conn:
+                    update_hospital_request_stats(conn, hospital_id, -1)
                     conn.execute(q, tuple(params))
+                    update_hospital_request_stats(conn, hospital_id, 1)
                     conn.commit()
+                invalidate_cache_tags(["requests_stats"])
                 st.success("تم التعديل بنجاح")
                 st.rerun()
             except sqlite3.IntegrityError:
                 st.error("كود المستشفى أو اسم المستخدم مستخدم مسبقًا")
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL, tags=["services"])
 def get_all_services():
     with get_conn() as conn:
         rows = conn.execute("SELECT id, name FROM services ORDER BY name").fetchall()
@@ -3887,7 +4728,49 @@ def get_all_sectors():
         rows = conn.execute("SELECT DISTINCT sector FROM hospitals ORDER BY sector").fetchall()
         return [dict(row) for row in rows]
 
+# ---------------------------- محرك صفحات keyset ---------------------------- #
+REQUEST_SORT_OPTIONS = {
+    "تاريخ الإنشاء": "r.created_at",
+    "رقم الطلب": "r.id",
+    "الحالة": "r.status",
+}
+ADMIN_REQUESTS_PAGE_SIZES = [25, 50, 100]
+
+def fetch_keyset_page(conn, columns_sql: str, from_sql: str, conditions: list, params: list,
+                      sort_column: str, descending: bool = True, page_size: int = 50, cursor: tuple = None):
+    """جلب صفحة واحدة مرتبة على (sort_column, r.id) بنظام keyset بدون OFFSET.
+
+    sort_column يجب أن يكون من قائمة مسموحة (REQUEST_SORT_OPTIONS) لأنه يُضاف لنص الاستعلام.
+    العودة: (الصفوف المرئية فقط, مؤشر الصفحة التالية أو None)
+    """
+    op, order = ("<", "DESC") if descending else (">", "ASC")
+    conditions = list(conditions)
+    params = list(params)
+    if cursor:
+        conditions.append(f"({sort_column}, r.id) {op} (?, ?)")
+        params.extend(cursor)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    q = (f"SELECT {columns_sql}, {sort_column} AS _sort_value FROM {from_sql}{where}"
+         f" ORDER BY {sort_column} {order}, r.id {order} LIMIT ?")
+    rows = [dict(r) for r in conn.execute(q, params + [page_size + 1]).fetchall()]
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1]['_sort_value'], rows[-1]['id'])
+    for row in rows:
+        row.pop('_sort_value', None)
+    return rows, next_cursor
+
+@query_cache.cached(ttl=30, tags=["requests_count"])
+def count_keyset_rows(from_sql: str, conditions: list, params: list) -> int:
+    """العدد الإجمالي للصفوف المطابقة (مخزن مؤقتاً لفترة قصيرة أثناء التنقل بين الصفحات)"""
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    with get_conn() as conn:
+        return conn.execute(f"SELECT COUNT(1) AS c FROM {from_sql}{where}", params).fetchone()['c']
+
 def admin_requests_ui():
+    import pandas as pd
     user = st.session_state.user
     
     # التحقق من صلاحية مراجعة الطلبات
@@ -3950,33 +4833,19 @@ def admin_requests_ui():
 
     # بناء الاستعلام بشكل آمن مع فلترة القطاع
     # التحقق من وجود عمود governorate في جدول requests
-    try:
-        with get_conn() as test_conn:
-            test_conn.execute("SELECT governorate FROM requests LIMIT 1")
-        has_governorate_column = True
-    except sqlite3.OperationalError:
-        has_governorate_column = False
+    has_governorate_column = get_schema_capabilities().has_column("requests", "governorate")
     
-    if has_governorate_column:
-        base_query = """
-            SELECT r.id, h.name AS hospital, h.code AS code, h.type AS hospital_type, h.sector AS hospital_sector,
-                   COALESCE(r.governorate, h.governorate) AS governorate,
-                   s.name AS service, r.age_category, r.status, r.created_at, r.deleted_at, r.sector AS request_sector
-            FROM requests r
-            JOIN hospitals h ON h.id=r.hospital_id
-            JOIN services s ON s.id=r.service_id
-            WHERE 1=1
-        """
-    else:
-        base_query = """
-            SELECT r.id, h.name AS hospital, h.code AS code, h.type AS hospital_type, h.sector AS hospital_sector,
-                   h.governorate AS governorate,
-                   s.name AS service, r.age_category, r.status, r.created_at, r.deleted_at, r.sector AS request_sector
-            FROM requests r
+    governorate_expr = "COALESCE(r.governorate, h.governorate)" if has_governorate_column else "h.governorate"
+    columns_sql = f"""
+            r.id, h.name AS hospital, h.code AS code, h.type AS hospital_type, h.sector AS hospital_sector,
+            {governorate_expr} AS governorate,
+            s.name AS service, r.age_category, r.status, r.created_at, r.deleted_at, r.sector AS request_sector
+    """
+    from_sql = """
+            requests r
             JOIN hospitals h ON h.id=r.hospital_id
             JOIN services s ON s.id=r.service_id
-            WHERE 1=1
-        """
+    """
     
     conditions = []
     params = []
@@ -4022,33 +4891,63 @@ def admin_requests_ui():
         else:
             conditions.append("h.governorate = ?")
         params.append(selected_governorate)
-    if start_date:
-        conditions.append("DATE(r.created_at) >= ?")
-        params.append(start_date.isoformat())
-    if end_date:
-        conditions.append("DATE(r.created_at) <= ?")
-        params.append(end_date.isoformat())
-    
-    # بناء الاستعلام النهائي
-    if conditions:
-        where_clause = " AND ".join(conditions)
-        q = base_query.replace("WHERE 1=1", f"WHERE {where_clause}")
-    else:
-        q = base_query
-
-    q += " ORDER BY r.created_at DESC"
+    date_conditions, date_params = date_range_conditions("r.created_at", start_date, end_date)
+    conditions.extend(date_conditions)
+    params.extend(date_params)
+    
+    # ترتيب وحجم الصفحة (أعمدة الترتيب من قائمة مسموحة فقط)
+    sort_col, dir_col, size_col = st.columns(3)
+    with sort_col:
+        sort_label = st.selectbox("ترتيب حسب", list(REQUEST_SORT_OPTIONS.keys()))
+    with dir_col:
+        descending = st.selectbox("اتجاه الترتيب", ["تنازلي", "تصاعدي"]) == "تنازلي"
+    with size_col:
+        page_size = st.selectbox("عدد الطلبات في الصفحة", ADMIN_REQUESTS_PAGE_SIZES)
+    sort_column = REQUEST_SORT_OPTIONS[sort_label]
+
+    # إعادة التنقل للصفحة الأولى عند تغيير أي فلتر أو ترتيب
+    page_signature = (tuple(conditions), tuple(params), sort_column, descending, page_size)
+    if st.session_state.get("admin_req_page_signature") != page_signature:
+        st.session_state["admin_req_page_signature"] = page_signature
+        st.session_state["admin_req_cursor_stack"] = []
+    cursor_stack = st.session_state["admin_req_cursor_stack"]
+    cursor = cursor_stack[-1] if cursor_stack else None
 
     try:
+        total = count_keyset_rows(from_sql, conditions, params)
         with get_conn() as conn:
-            rows = conn.execute(q, tuple(params)).fetchall()
+            rows, next_cursor = fetch_keyset_page(conn, columns_sql, from_sql, conditions, params,
+                                                  sort_column, descending, page_size, cursor)
     except sqlite3.OperationalError as e:
         st.error(f"خطأ في الاستعلام: {str(e)}")
-        st.info(f"Query: {q}")
         st.info(f"Params: {params}")
-        rows = []
+        total, rows, next_cursor = 0, [], None
     
-    df = pd.DataFrame([dict(r) for r in rows]) if rows else pd.DataFrame()
+    df = pd.DataFrame(rows) if rows else pd.DataFrame()
     st.dataframe(df, use_container_width=True)
+
+    page_number = len(cursor_stack) + 1
+    total_pages = max(1, -(-total // page_size))
+    prev_col, info_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        if cursor_stack and st.button("⬅️ السابق", key="admin_req_prev"):
+            cursor_stack.pop()
+            st.rerun()
+    with info_col:
+        st.caption(f"صفحة {page_number} من {total_pages} — إجمالي الطلبات: {total}")
+    with next_col:
+        if next_cursor and st.button("التالي ➡️", key="admin_req_next"):
+            cursor_stack.append(next_cursor)
+            st.rerun()
+    
+    with st.expander("📦 تصدير مستندات كل الطلبات المطابقة (ZIP)"):
+        st.caption(f"سيتم تصدير مستندات {total} طلب حسب الفلاتر الحالية في مهمة خلفية (مجلد لكل طلب).")
+        if st.button("بدء التصدير", key="bulk_export_start", disabled=total == 0):
+            job_manager.submit("bulk_export", f"تصدير مستندات {total} طلب", bulk_export_requests,
+                               from_sql, list(conditions), list(params), owner=current_job_owner())
+        # الأرشيف مبني بفلاتر القطاع الخاصة بصاحبه: لا يُعرض لمستخدم آخر
+        render_background_jobs("bulk_export", owner=current_job_owner(), render_result=lambda job: render_archive_download(
+            Path(job['result']), Path(job['result']).name, key=f"bulk_dl_{job['id']}"))
     
     if rows:
         pick = st.selectbox("اختر طلبًا لإدارته", ["—"] + [str(r["id"]) for r in rows])
@@ -4158,53 +5057,24 @@ def admin_request_detail_ui(request_id: int):
                  )
 
     with colB:
+        zip_state_key = f"zip_ready_{request_id}"
         if st.button("تنزيل كل الملفات (ZIP)"):
-            buf = None
-            zf = None
             try:
-                buf = io.BytesIO()
-                with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-                    files_added = 0
-                    for d in docs:
-                        if d['file_path'] and os.path.exists(d['file_path']):
-                            try:
-                                safe_name = safe_filename(d['doc_type'])[:50]
-                                file_ext = Path(d['file_path']).suffix
-                                arcname = f"{safe_name}{file_ext}"
-                                zf.write(d['file_path'], arcname=arcname)
-                                files_added += 1
-                            except Exception as e:
-                                print(f"Error adding file to ZIP: {e}")
-                    
-                    if files_added == 0:
-                        st.warning("لا توجد ملفات صالحة للتنزيل")
-                        return
-                
-                buf.seek(0)
-                zip_data = buf.getvalue()
-                
-                if zip_data:
-                    st.download_button(
-                        "📥 تحميل الملفات", 
-                        data=zip_data, 
-                        file_name=f"request_{request_id}_files.zip",
-                        mime="application/zip"
-                    )
-                    st.success(f"تم إنشاء ملف ZIP يحتوي على {files_added} ملف")
-                else:
-                    st.error("فشل في إنشاء ملف ZIP")
-                    
+                zip_path, files_added = export_request_zip(request_id, docs)
+                if not zip_path:
+                    st.warning("لا توجد ملفات صالحة للتنزيل")
+                    return
+                st.session_state[zip_state_key] = str(zip_path)
+                st.success(f"تم إنشاء ملف ZIP يحتوي على {files_added} ملف")
             except Exception as e:
                 st.error(f"خطأ في إنشاء ملف ZIP: {e}")
-            finally:
-                # تحرير الذاكرة
-                if buf:
-                    buf.close()
-                del buf, zf
-                import gc
-                gc.collect()
+        
+        zip_ready = st.session_state.get(zip_state_key)
+        if zip_ready and os.path.exists(zip_ready):
+            render_archive_download(Path(zip_ready), f"request_{request_id}_files.zip", key=f"zip_dl_{request_id}")
 
     st.markdown("##### المستندات")
+    media = fetch_document_media(docs)
     for d in docs:
         c1, c2, c3, c4, c5, c6 = st.columns([3,2,2,2,3,3])
         with c1:
@@ -4238,6 +5108,7 @@ def admin_request_detail_ui(request_id: int):
                     conn.execute("UPDATE documents SET required=?, satisfied=?, admin_comment=?, updated_at=? WHERE id=?", (new_required_value, 1 if sat_toggle else 0, comment, now_iso, d['id']))
                     conn.commit()
                 st.success("تم التحديث")
+        render_document_media(d, media)
 
     st.markdown("##### الإجراءات")
     
@@ -4266,8 +5137,13 @@ def admin_request_detail_ui(request_id: int):
                 return
             try:
                 with get_conn() as conn:
+                    # الطلب قد يكون قائماً (الزر يظهر دائماً): إزالته من خانته الحالية أولاً
+                    # (لا أثر للطلب المحذوف لأن التجميع يتجاهل deleted_at)
+                    update_request_stats(conn, request_id, -1)
                     conn.execute("UPDATE requests SET status='إعادة تقديم', deleted_at=NULL, updated_at=? WHERE id=?", (datetime.now().isoformat(), request_id))
+                    update_request_stats(conn, request_id, 1)
                     conn.commit()
+                invalidate_cache_tags(["requests_count", "requests_stats"])
                 log_activity("استرجاع طلب", f"طلب رقم: {request_id}")
                 st.success("تم الاسترجاع")
             except Exception as e:
@@ -4297,6 +5173,7 @@ def admin_request_detail_ui(request_id: int):
 
 def admin_activity_log_ui():
     """واجهة عرض سجل نشاط المستخدمين للمدير."""
+    import pandas as pd
     st.markdown("<div class='subheader'>📜 سجل نشاط المستخدمين</div>", unsafe_allow_html=True)
 
     # --- فلاتر البحث ---
@@ -4322,8 +5199,9 @@ def admin_activity_log_ui():
         query += " AND action = ?"
         params.append(selected_action)
     if date_filter:
-        query += " AND DATE(timestamp) = ?"
-        params.append(date_filter.isoformat())
+        date_conditions, date_params = date_range_conditions("timestamp", date_filter, date_filter)
+        query += "".join(f" AND {condition}" for condition in date_conditions)
+        params.extend(date_params)
 
     query += " ORDER BY timestamp DESC LIMIT 500" # حد أقصى 500 سجل لتجنب التحميل الزائد
 
@@ -4337,12 +5215,130 @@ def admin_activity_log_ui():
     else:
         st.info("لا توجد سجلات تطابق معايير البحث.")
 
-@st.cache_data(ttl=600)
+@query_cache.cached(ttl=CONFIG_CACHE_TTL, tags=["services"])
 def get_active_service_names():
     with get_conn() as conn:
         return [s['name'] for s in conn.execute("SELECT name FROM services WHERE active=1").fetchall()]
 
+# ---------------------------- جدول تجميع الإحصائيات اليومية ---------------------------- #
+# request_stats_daily يحتفظ بعدد الطلبات غير المحذوفة لكل (يوم الإنشاء، القطاع، المحافظة، الخدمة، نوع المستشفى، الحالة)
+# ويُحدّث تدريجياً داخل نفس معاملة كل تعديل على الطلبات (طرح مساهمة الصف قبل التعديل وإضافتها بعده).
+# القيم الفارغة تُخزن كنص فارغ '' حتى يعمل المفتاح الأساسي و ON CONFLICT بشكل صحيح.
+_REQUEST_STATS_KEY_SQL = """
+    SUBSTR(r.created_at, 1, 10), COALESCE(h.sector, ''), COALESCE(r.governorate, h.governorate, ''),
+    r.service_id, COALESCE(h.type, ''), COALESCE(r.status, '')
+"""
+
+def _apply_request_stats_delta(conn, delta: int, where_sql: str, params: list):
+    """إضافة (delta=1) أو طرح (delta=-1) مساهمة الطلبات المطابقة لـ where_sql في جدول التجميع"""
+    conn.execute(f"""
+        INSERT INTO request_stats_daily (day, sector, governorate, service_id, hospital_type, status, count)
+        SELECT {_REQUEST_STATS_KEY_SQL}, ? * COUNT(*)
+        FROM requests r
+        JOIN hospitals h ON h.id = r.hospital_id
+        WHERE r.deleted_at IS NULL AND {where_sql}
+        GROUP BY 1, 2, 3, 4, 5, 6
+        ON CONFLICT(day, sector, governorate, service_id, hospital_type, status)
+        DO UPDATE SET count = count + excluded.count
+    """, [delta] + list(params))
+
+def update_request_stats(conn, request_id: int, delta: int):
+    """تحديث جدول التجميع لطلب واحد (يُستدعى بـ -1 قبل التعديل و +1 بعده)"""
+    _apply_request_stats_delta(conn, delta, "r.id = ?", [request_id])
+
+def update_hospital_request_stats(conn, hospital_id: int, delta: int):
+    """تحديث جدول التجميع لكل طلبات مستشفى (عند تعديل قطاعه أو نوعه أو محافظته أو حذفه)"""
+    _apply_request_stats_delta(conn, delta, "r.hospital_id = ?", [hospital_id])
+
+def rebuild_request_stats_daily(conn=None):
+    """إعادة بناء جدول request_stats_daily بالكامل من جدول الطلبات (للإصلاح)"""
+    if conn is None:
+        with get_conn() as own_conn:
+            count = rebuild_request_stats_daily(own_conn)
+            own_conn.commit()
+            return count
+    conn.execute("DELETE FROM request_stats_daily")
+    _apply_request_stats_delta(conn, 1, "1=1", [])
+    return conn.execute("SELECT COUNT(1) as c FROM request_stats_daily").fetchone()['c']
+
+STATS_DIMENSIONS = {
+    "status": ["status"],
+    "service": ["name"],
+    "type": ["type"],
+    "sector": ["sector"],
+    "governorate": ["governorate"],
+}
+
+def _stats_breakdown(base, columns, dropna=False, limit=None):
+    """تجميع إطار العدّ حسب أعمدة محددة وترتيبه تنازلياً بالعدد"""
+    grouped = base.groupby(columns, dropna=dropna, sort=False)["count"].sum().reset_index()
+    grouped = grouped[grouped["count"] > 0].sort_values("count", ascending=False, kind="stable")
+    if limit:
+        grouped = grouped.head(limit)
+    grouped = grouped.astype(object).where(grouped.notna(), None)
+    return [{k: (int(v) if k == "count" else v) for k, v in row.items()} for row in grouped.to_dict("records")]
+
+@query_cache.cached(ttl=300, tags=["requests_stats"])
+def compute_request_statistics_from_rollup(filters: dict) -> dict:
+    """توزيعات لوحة الإحصائيات من جدول request_stats_daily (تكلفتها لا تزيد مع عدد الطلبات).
+
+    filters: sector, governorate, service, type, status (None = الكل) و date_from/date_to.
+    """
+    import pandas as pd
+    conditions, params = [], []
+    for key, column in (("sector", "d.sector"), ("governorate", "d.governorate"), ("service", "s.name"),
+                        ("type", "d.hospital_type"), ("status", "d.status")):
+        if filters.get(key) is not None:
+            conditions.append(f"{column} = ?")
+            params.append(filters[key])
+    date_conditions, date_params = date_range_conditions("d.day", filters.get("date_from"), filters.get("date_to"))
+    conditions.extend(date_conditions)
+    params.extend(date_params)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT NULLIF(d.status, '') AS status, s.name AS name, NULLIF(d.hospital_type, '') AS type,
+               NULLIF(d.sector, '') AS sector, NULLIF(d.governorate, '') AS governorate, SUM(d.count) AS count
+        FROM request_stats_daily d
+        JOIN services s ON s.id = d.service_id
+        {where}
+        GROUP BY d.status, s.name, d.hospital_type, d.sector, d.governorate
+    """
+    with get_conn() as conn:
+        rows = [dict(r) for r in conn.execute(query, params).fetchall()]
+    base = pd.DataFrame(rows, columns=["status", "name", "type", "sector", "governorate", "count"])
+    return {key: _stats_breakdown(base, cols, dropna=(key == "governorate")) for key, cols in STATS_DIMENSIONS.items()}
+
+@query_cache.cached(ttl=300, tags=["requests_stats"])
+def compute_request_statistics(where_clause: str, params: list, gov_column: str) -> dict:
+    """حساب كل توزيعات لوحة الإحصائيات من مسح واحد للطلبات المفلترة.
+
+    يتم التجميع في SQL مرة واحدة على أدق مستوى (الحالة، الخدمة، النوع، القطاع، المحافظة، المستشفى)
+    ثم تُشتق منه كل التوزيعات بـ groupby في pandas. النتيجة مخزنة لكل مجموعة فلاتر.
+    """
+    import pandas as pd
+    query = f"""
+        SELECT r.status AS status, s.name AS name, h.type AS type, h.sector AS sector,
+               {gov_column} AS governorate, h.name AS hospital, COUNT(*) AS count
+        FROM requests r
+        JOIN hospitals h ON r.hospital_id = h.id
+        JOIN services s ON r.service_id = s.id
+        WHERE {where_clause}
+        GROUP BY r.status, s.name, h.type, h.sector, {gov_column}, h.id
+    """
+    with get_conn() as conn:
+        rows = [dict(r) for r in conn.execute(query, params).fetchall()]
+    base = pd.DataFrame(rows, columns=["status", "name", "type", "sector", "governorate", "hospital", "count"])
+
+    stats = {key: _stats_breakdown(base, cols, dropna=(key == "governorate")) for key, cols in STATS_DIMENSIONS.items()}
+    comprehensive = _stats_breakdown(base, ["governorate", "sector", "hospital", "name"], limit=20)
+    stats["comprehensive"] = [
+        {"governorate": r["governorate"], "sector": r["sector"], "hospital": r["hospital"], "service": r["name"], "count": r["count"]}
+        for r in comprehensive
+    ]
+    return stats
+
 def admin_statistics_ui():
+    import pandas as pd
     user = st.session_state.user
     st.markdown("<div class='subheader'>الإحصائيات</div>", unsafe_allow_html=True)
     
@@ -4388,11 +5384,9 @@ def admin_statistics_ui():
         where_conditions.append("h.sector = ?")
         params.append(selected_sector)
     if selected_governorate_stats != "الكل":
-        try:
-            with get_conn() as test_conn:
-                test_conn.execute("SELECT governorate FROM requests LIMIT 1")
+        if get_schema_capabilities().has_column("requests", "governorate"):
             where_conditions.append("COALESCE(r.governorate, h.governorate) = ?")
-        except sqlite3.OperationalError:
+        else:
             where_conditions.append("h.governorate = ?")
         params.append(selected_governorate_stats)
     if selected_service != "الكل":
@@ -4404,103 +5398,37 @@ def admin_statistics_ui():
     if selected_status != "الكل":
         where_conditions.append("r.status = ?")
         params.append(selected_status)
-    if start_date:
-        where_conditions.append("DATE(r.created_at) >= ?")
-        params.append(start_date.isoformat())
-    if end_date:
-        where_conditions.append("DATE(r.created_at) <= ?")
-        params.append(end_date.isoformat())
+    date_conditions, date_params = date_range_conditions("r.created_at", start_date, end_date)
+    where_conditions.extend(date_conditions)
+    params.extend(date_params)
 
     where_clause = " AND ".join(where_conditions) if where_conditions else "1=1"
+    rollup_filters = {
+        "sector": None if selected_sector == "الكل" else selected_sector,
+        "governorate": None if selected_governorate_stats == "الكل" else selected_governorate_stats,
+        "service": None if selected_service == "الكل" else selected_service,
+        "type": None if selected_type == "الكل" else selected_type,
+        "status": None if selected_status == "الكل" else selected_status,
+        "date_from": start_date,
+        "date_to": end_date,
+    }
 
-    with get_conn() as conn:
-        try:
-            query_status = f"""
-                SELECT r.status, COUNT(*) as count
-                FROM requests r
-                JOIN hospitals h ON r.hospital_id = h.id
-                JOIN services s ON r.service_id = s.id
-                WHERE {where_clause}
-                GROUP BY r.status
-                ORDER BY count DESC
-            """
-            status_stats = conn.execute(query_status, params).fetchall()
-        except Exception as e:
-            st.warning(f"خطأ في استعلام الحالات: {e}")
-            status_stats = []
-        
-        try:
-            query_service = f"""
-                SELECT s.name, COUNT(*) as count
-                FROM requests r
-                JOIN hospitals h ON r.hospital_id = h.id
-                JOIN services s ON r.service_id = s.id
-                WHERE {where_clause}
-                GROUP BY s.name
-                ORDER BY count DESC
-            """
-            service_stats = conn.execute(query_service, params).fetchall()
-        except Exception as e:
-            st.warning(f"خطأ في استعلام الخدمات: {e}")
-            service_stats = []
-        
-        try:
-            query_type = f"""
-                SELECT h.type, COUNT(*) as count
-                FROM requests r
-                JOIN hospitals h ON r.hospital_id = h.id
-                JOIN services s ON r.service_id = s.id
-                WHERE {where_clause}
-                GROUP BY h.type
-                ORDER BY count DESC
-            """
-            type_stats = conn.execute(query_type, params).fetchall()
-        except Exception as e:
-            st.warning(f"خطأ في استعلام الأنواع: {e}")
-            type_stats = []
-        
-        try:
-            query_sector = f"""
-                SELECT h.sector, COUNT(*) as count
-                FROM requests r
-                JOIN hospitals h ON r.hospital_id = h.id
-                JOIN services s ON r.service_id = s.id
-                WHERE {where_clause}
-                GROUP BY h.sector
-                ORDER BY count DESC
-            """
-            sector_stats = conn.execute(query_sector, params).fetchall()
-        except Exception as e:
-            st.warning(f"خطأ في استعلام القطاعات: {e}")
-            sector_stats = []
-        
-        try:
-            query_governorate = f"""
-                SELECT COALESCE(r.governorate, h.governorate) as governorate, COUNT(*) as count
-                FROM requests r
-                JOIN hospitals h ON r.hospital_id = h.id
-                JOIN services s ON r.service_id = s.id
-                WHERE {where_clause} AND (r.governorate IS NOT NULL OR h.governorate IS NOT NULL)
-                GROUP BY COALESCE(r.governorate, h.governorate)
-                ORDER BY count DESC
-            """
-            governorate_stats = conn.execute(query_governorate, params).fetchall()
-        except sqlite3.OperationalError:
-            # إذا لم يوجد عمود governorate في requests، استخدم من hospitals
-            try:
-                query_governorate = f"""
-                    SELECT h.governorate as governorate, COUNT(*) as count
-                    FROM requests r
-                    JOIN hospitals h ON r.hospital_id = h.id
-                    JOIN services s ON r.service_id = s.id
-                    WHERE {where_clause} AND h.governorate IS NOT NULL
-                    GROUP BY h.governorate
-                    ORDER BY count DESC
-                """
-                governorate_stats = conn.execute(query_governorate, params).fetchall()
-            except Exception as e:
-                st.warning(f"خطأ في استعلام المحافظات: {e}")
-                governorate_stats = []
+    # التوزيعات من جدول التجميع اليومي، والمسح التفصيلي فقط عند طلب مستوى المستشفى
+    show_hospital_level = st.checkbox("عرض التوزيع الشامل حتى مستوى المستشفى")
+    stats = {key: [] for key in ("status", "service", "type", "sector", "governorate", "comprehensive")}
+    try:
+        stats.update(compute_request_statistics_from_rollup(rollup_filters))
+        if show_hospital_level:
+            has_governorate_column = get_schema_capabilities().has_column("requests", "governorate")
+            gov_column = "COALESCE(r.governorate, h.governorate)" if has_governorate_column else "h.governorate"
+            stats["comprehensive"] = compute_request_statistics(where_clause, params, gov_column)["comprehensive"]
+    except Exception as e:
+        st.warning(f"خطأ في استعلام الإحصائيات: {e}")
+    status_stats = stats["status"]
+    service_stats = stats["service"]
+    type_stats = stats["type"]
+    sector_stats = stats["sector"]
+    governorate_stats = stats["governorate"]
 
     st.markdown("#### إحصائيات مفصلة")
     col1, col2 = st.columns(2)
@@ -4562,35 +5490,14 @@ def admin_statistics_ui():
         st.markdown("---")
         st.markdown("#### 📊 الرسم البياني الشامل")
         
-        # إنشاء رسم بياني شامل يجمع المحافظة والقطاع والمستشفى والخدمة
+        # إنشاء رسم بياني شامل يجمع المحافظة والقطاع والمستشفى والخدمة (من نفس مسح الإحصائيات)
         try:
-            with get_conn() as conn:
-                # التحقق من وجود عمود governorate
-                try:
-                    conn.execute("SELECT governorate FROM requests LIMIT 1")
-                    gov_column = "COALESCE(r.governorate, h.governorate)"
-                except sqlite3.OperationalError:
-                    gov_column = "h.governorate"
-                
-                comprehensive_query = f"""
-                    SELECT 
-                        {gov_column} as governorate,
-                        h.sector,
-                        h.name as hospital,
-                        s.name as service,
-                        COUNT(*) as count
-                    FROM requests r
-                    JOIN hospitals h ON r.hospital_id = h.id
-                    JOIN services s ON r.service_id = s.id
-                    WHERE {where_clause}
-                    GROUP BY {gov_column}, h.sector, h.name, s.name
-                    ORDER BY count DESC
-                    LIMIT 20
-                """
-                comprehensive_data = conn.execute(comprehensive_query, params).fetchall()
+            comprehensive_data = stats["comprehensive"]
             
-            if comprehensive_data and len(comprehensive_data) > 0:
-                df_comprehensive = pd.DataFrame([dict(row) for row in comprehensive_data])
+            if not show_hospital_level:
+                st.info("فعّل خيار 'عرض التوزيع الشامل حتى مستوى المستشفى' لعرض هذا الرسم")
+            elif comprehensive_data and len(comprehensive_data) > 0:
+                df_comprehensive = pd.DataFrame(comprehensive_data)
                 
                 # إنشاء رسم بياني تفاعلي
                 fig = px.sunburst(
@@ -4694,6 +5601,7 @@ def admin_statistics_ui():
 
 def admin_status_permissions_ui():
     """واجهة إدارة صلاحيات تعديل حالات الطلبات حسب الدور"""
+    import pandas as pd
     st.markdown("<div class='subheader'>🔐 إدارة صلاحيات تعديل حالات الطلبات</div>", unsafe_allow_html=True)
     
     user = st.session_state.user
@@ -4796,10 +5704,11 @@ def admin_status_permissions_ui():
                         if allow:
                             conn.execute("INSERT INTO reviewer_status_permissions (role_name, status_name, created_at, updated_at) VALUES (?, ?, ?, ?)", 
                                        ("reviewer_general", status, now_iso, now_iso))
+                    bump_cache_versions(conn, ["perms:reviewer_general"])
                     conn.commit()
                 
-                # مسح الذاكرة المؤقتة عند التحديث
-                st.cache_data.clear()
+                # مسح الذاكرة المؤقتة الخاصة بالصلاحيات فقط
+                invalidate_cache_tags(["perms:reviewer_general"])
                 st.success("✅ تم حفظ الصلاحيات بنجاح")
                 st.rerun()
         
@@ -4824,10 +5733,11 @@ def admin_status_permissions_ui():
                         if allow:
                             conn.execute("INSERT INTO reviewer_status_permissions (role_name, status_name, created_at, updated_at) VALUES (?, ?, ?, ?)", 
                                        ("reviewer_sector", status, now_iso, now_iso))
+                    bump_cache_versions(conn, ["perms:reviewer_sector"])
                     conn.commit()
                 
-                # مسح الذاكرة المؤقتة عند التحديث
-                st.cache_data.clear()
+                # مسح الذاكرة المؤقتة الخاصة بالصلاحيات فقط
+                invalidate_cache_tags(["perms:reviewer_sector"])
                 st.success("✅ تم حفظ الصلاحيات بنجاح")
                 st.rerun()
     
@@ -4858,6 +5768,33 @@ def admin_status_permissions_ui():
         - **التقييد**: التقييد ينطبق فقط على تعديل الحالة، وليس على عرض الحالة
         """)
 
+def current_job_owner():
+    """مالك المهام الخلفية للمستخدم الحالي (الدور مع المعرف لأن المستشفيات والمشرفين في جدولين)"""
+    user = st.session_state.get("user") or {}
+    return f"{user.get('role')}:{user.get('id')}"
+
+def render_background_jobs(kind: str, limit: int = 5, render_result=None, owner=None):
+    """عرض تقدم آخر المهام الخلفية من نوع معين.
+
+    render_result (اختياري): دالة تعرض نتيجة المهمة المكتملة (مثل زر تنزيل الأرشيف).
+    owner (اختياري): عرض مهام هذا المالك فقط (المهام التي تحمل نتائج خاصة بالمستخدم).
+    """
+    jobs = job_manager.list_jobs(kind, owner=owner)[:limit]
+    if not jobs:
+        return
+    for job in jobs:
+        if job['status'] == 'failed':
+            st.error(f"❌ {job['title']}: {job['error']}")
+        elif job['status'] == 'done':
+            st.caption(f"✅ {job['title']} — {job['message']}")
+            if render_result and job['result']:
+                render_result(job)
+        else:
+            st.progress(job['progress'], text=f"⏳ {job['title']} ({job['processed']}/{job['total']}) — {job['rows']} صف")
+    if any(job['status'] in ('queued', 'running') for job in jobs):
+        if st.button("🔄 تحديث حالة المهام", key=f"refresh_jobs_{kind}"):
+            st.rerun()
+
 def admin_lists_ui():
     st.markdown("<div class='subheader'>إدارة الخدمات وأنواع المستشفيات</div>", unsafe_allow_html=True)
 
@@ -4877,12 +5814,11 @@ def admin_lists_ui():
                 with get_conn() as conn:
                     new_status = 0 if service['active'] else 1
                     conn.execute("UPDATE services SET active=? WHERE id=?", (new_status, service['id']))
+                    bump_cache_versions(conn, ["services"])
                     conn.commit()
                 st.success("تم تغيير الحالة")
                 # مسح الذاكرة المؤقتة
-                get_active_services.clear()
-                get_all_services.clear()
-                get_active_service_names.clear()
+                invalidate_cache_tags(["services"])
                 time.sleep(0.5)
                 st.rerun()
 
@@ -4894,14 +5830,14 @@ def admin_lists_ui():
             try:
                 with get_conn() as conn:
                     conn.execute("INSERT INTO services (name, active) VALUES (?,?)", (sname.strip(), 1 if s_active else 0))
+                    bump_cache_versions(conn, ["services"])
                     conn.commit()
                     st.success("تمت الإضافة")
+                # مسح الذاكرة المؤقتة الخاصة بالخدمات
+                invalidate_cache_tags(["services"])
                 st.rerun()
             except sqlite3.IntegrityError:
                 st.error("الخدمة موجودة مسبقًا")
-        # مسح الذاكرة المؤقتة عند إضافة خدمة جديدة
-        if hasattr(st, 'cache_data'):
-            st.cache_data.clear()
 
     st.markdown("#### 🏥 أنواع المستشفيات")
     types = get_hospital_types()
@@ -4960,12 +5896,11 @@ def admin_lists_ui():
                              blocks_service_for_days=excluded.blocks_service_for_days,
                              is_final_state=excluded.is_final_state
                          """, (new_status_name, 1 if prevents_new else 0, blocks_days, 1 if is_final else 0))
+                         bump_cache_versions(conn, ["request_statuses", "status_settings"])
                          conn.commit()
                      st.success(f"تمت إضافة أو تعديل الحالة: {new_status_name}")
                      # مسح الذاكرة المؤقتة وإعادة تحميل الصفحة
-                     get_request_statuses.clear()
-                     get_preventing_statuses.clear()
-                     get_blocking_statuses.clear()
+                     invalidate_cache_tags(["request_statuses", "status_settings"])
                      time.sleep(0.5)
                      st.rerun()
                  except Exception as e:
@@ -4985,12 +5920,11 @@ def admin_lists_ui():
                          else:
                              conn.execute("DELETE FROM status_settings WHERE status_name = ?", (status_to_delete,))
                              conn.execute("DELETE FROM request_statuses WHERE name = ?", (status_to_delete,))
+                             bump_cache_versions(conn, ["request_statuses", "status_settings"])
                              conn.commit()
                              st.success(f"تم حذف الحالة: {status_to_delete}")
                              # مسح الذاكرة المؤقتة
-                             get_request_statuses.clear()
-                             get_preventing_statuses.clear()
-                             get_blocking_statuses.clear()
+                             invalidate_cache_tags(["request_statuses", "status_settings"])
                              time.sleep(0.5)
                              st.rerun()
                  except Exception as e:
@@ -5016,9 +5950,10 @@ def admin_lists_ui():
                         # تحديث المستندات الموجودة في الطلبات
                         conn.execute("UPDATE documents SET display_name = ?, is_video_allowed = ? WHERE doc_type = ?", (new_display_name, 1 if new_is_video_allowed else 0, doc['name']))
                         
+                        bump_cache_versions(conn, ["document_types"])
                         conn.commit()
                     st.success("تم حفظ التعديل وتطبيقه على جميع الطلبات")
-                    get_document_types.clear()
+                    invalidate_cache_tags(["document_types"])
                     time.sleep(0.5)
                     st.rerun()
             
@@ -5039,10 +5974,10 @@ def admin_lists_ui():
                                 conn.execute("DELETE FROM document_types WHERE name = ?", (doc['name'],))
                                 # حذف من إعدادات المستندات الاختيارية
                                 conn.execute("DELETE FROM hospital_type_optional_docs WHERE doc_name = ?", (doc['name'],))
+                                bump_cache_versions(conn, ["document_types", "opt_docs"])
                                 conn.commit()
                                 st.success(f"✅ تم حذف نوع المستند: {doc['display_name']}")
-                                get_document_types.clear()
-                                get_optional_docs_for_type.clear()
+                                invalidate_cache_tags(["document_types", "opt_docs"])
                                 time.sleep(0.5)
                                 st.rerun()
                             except Exception as e:
@@ -5070,8 +6005,10 @@ def admin_lists_ui():
                             conn.execute("INSERT OR IGNORE INTO documents (request_id, doc_type, display_name, required, satisfied, uploaded_at, is_video_allowed, updated_at) VALUES (?, ?, ?, ?, 0, NULL, ?, ?)", 
                                        (req['id'], new_doc_name, new_doc_display_name, is_required, 1 if new_doc_is_video_allowed else 0, datetime.now().isoformat()))
                         
+                        bump_cache_versions(conn, ["document_types"])
                         conn.commit()
                     st.success("تمت إضافة نوع المستند وتطبيقه على الطلبات الموجودة")
+                    invalidate_cache_tags(["document_types"])
                     # إعادة تحميل الصفحة لعرض التغييرات
                     time.sleep(0.5)
                     st.rerun()
@@ -5083,6 +6020,7 @@ def admin_lists_ui():
                 st.warning("يرجى ملء الحقول المطلوبة.")
 
     st.markdown("#### 📄 إدارة المستندات الاختيارية لأنواع المستشفيات")
+    render_background_jobs("optional_docs")
     hospital_types = get_hospital_types()
     all_doc_names = [dt['name'] for dt in get_document_types()]
 
@@ -5100,32 +6038,9 @@ def admin_lists_ui():
                 
                 if st.button(f"💾 حفظ التغييرات لـ {htype}", key=f"save_button_{htype}"):
                     try:
+                        # الحفظ فوري، وتطبيق التغييرات على الطلبات الموجودة يتم كمهمة خلفية
                         set_optional_docs_for_type(htype, selected_optional_docs)
-                        
-                        # تطبيق التغييرات على الطلبات الموجودة فوراً
-                        with get_conn() as conn:
-                            # الحصول على جميع الطلبات لهذا النوع من المستشفيات
-                            requests = conn.execute("SELECT r.id FROM requests r JOIN hospitals h ON r.hospital_id = h.id WHERE h.type = ? AND r.deleted_at IS NULL", (htype,)).fetchall()
-                            
-                            updated_requests = 0
-                            for req in requests:
-                                # تحديث حالة المطلوب/اختياري للمستندات
-                                for doc_name in all_doc_names:
-                                    is_required = 0 if doc_name in selected_optional_docs else 1
-                                    result = conn.execute("UPDATE documents SET required = ? WHERE request_id = ? AND doc_type = ?", (is_required, req['id'], doc_name))
-                                    if result.rowcount > 0:
-                                        updated_requests += 1
-                            
-                            conn.commit()
-                            
-                        # مسح الذاكرة المؤقتة لضمان التحديث
-                        get_optional_docs_for_type.clear()
-                        get_document_types.clear()
-                        
-                        st.success(f"✅ تم حفظ المستندات الاختيارية لـ {htype} وتطبيقها على {len(requests)} طلب موجود")
-                        st.info(f"📋 المستندات الاختيارية الحالية لـ {htype}: {', '.join(selected_optional_docs) if selected_optional_docs else 'لا توجد'}")
-                        # إعادة تحميل الصفحة لعرض التغييرات
-                        time.sleep(0.5)  # انتظار قصير لضمان حفظ البيانات
+                        st.success(f"✅ تم حفظ المستندات الاختيارية لـ {htype} وجاري تطبيقها على الطلبات الموجودة في الخلفية")
                         st.rerun() 
                     except Exception as e:
                         st.error(f"❌ حدث خطأ أثناء الحفظ: {e}")
@@ -5372,6 +6287,7 @@ def admin_backup_ui():
                             if st.session_state.get(f"confirm_restore_{backup['filename']}", False):
                                 with st.spinner("جاري استرجاع النسخة الاحتياطية..."):
                                     try:
+                                        close_db_pool()
                                         success = backup_manager.restore_backup(backup['filename'])
                                         if success:
                                             st.success("✅ تم استرجاع النسخة الاحتياطية بنجاح")
@@ -5529,26 +6445,22 @@ def main():
     )
     
     # --- إضافة البنر في الأعلى ---
-    banner_path = next((p for p in [Path("static/banner.png"), Path("static/banner.jpg")] if p.exists()), None)
-    if "user" in st.session_state and banner_path: # عرض البنر فقط بعد تسجيل الدخول
-        with open(banner_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode()
-        st.markdown(f"<div style='text-align: center;'><img src='data:image/png;base64,{encoded_string}' class='banner-image'></div>", unsafe_allow_html=True)
+    if "user" in st.session_state: # عرض البنر فقط بعد تسجيل الدخول
+        render_banner()
 
 
     # تهيئة قاعدة البيانات وتشغيل migrations (مرة واحدة فقط)
     @st.cache_resource
     def initialize_database():
         try:
+            # التحقق من البنية والترحيلات وجدول الإشعارات (مع مسار سريع إذا كانت البنية محدثة)
             run_ddl()
-            run_migrations()
-            # إنشاء جدول الإشعارات إن لم يكن موجودًا
-            try:
-                ensure_notifications_table()
-            except Exception as ne:
-                print(f"Warning: notifications table creation failed: {ne}")
+            # خادم تنزيل الملفات (روابط موقعة بدلاً من تحميل الملفات في الذاكرة)
+            start_file_server()
             # تنظيف الذاكرة المؤقتة بعد التهيئة لضمان البيانات المحدثة
             force_refresh_cache()
+            # تعبئة سجل إمكانيات البنية مرة واحدة بعد الترحيلات
+            get_schema_capabilities()
             
             # بدء نظام النسخ الاحتياطي التلقائي
             try:
@@ -5567,6 +6479,9 @@ def main():
         st.error("يرجى إعادة تحميل الصفحة أو التواصل مع الدعم الفني")
         return
     
+    # مزامنة الذاكرة المؤقتة مع التعديلات التي تمت في عمليات أخرى (مرة واحدة لكل rerun)
+    sync_cache_versions()
+    
     # التحقق من حالة تسجيل الدخول
     if "user" not in st.session_state:
         # عرض واجهة الدخول